@@ -20,11 +20,18 @@
 # and "fixVersions".
 #
 ###############################################################################
+import getopt
 import json
-import requests
 import sys
 import time
 from collections import defaultdict
+from itertools import chain, izip
+from jira_journal import IssueJournal, journal_events
+from jira_metadata import fetch_metadata, map_versions_by_name
+from jira_json import LOAD_OPTIONS, LOAD_OPTIONS_USAGE, OUTPUT_OPTIONS, OUTPUT_OPTIONS_USAGE, PROJECT, content_hash, \
+    iter_export_data, new_export_writer, open_export, parse_load_options, parse_output_options
+from jira_rest import REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, chunks, get_json, imap_ordered, new_rest_client, parse_rest_options
+from jira_stats import RunStats
 from remap_users import get_user_mappings
 
 # Custom fields. These vary by project. If this doesn't apply to you, just
@@ -35,17 +42,24 @@ CUSTOM_FIELD_IDS = [ "customfield_10060",   # "Target Version/s"
                      "customfield_10058",   # "Code Review"
                     ]
 
-# This "Resolution" map is manually constructed by looking at the output from
-# the REST API calls from the source and destination JIRAs. In this case:
+# The fields of the REST representation of an issue that this script uses.
+# Only these are requested from the source instance, which keeps the responses
+# small for issues with long descriptions and comment threads.
+REST_ISSUE_FIELDS = [ "resolution", "components", "versions", "fixVersions", "attachment" ] + CUSTOM_FIELD_IDS
+
+# The resolutions of the source and destination instances are mapped
+# automatically by name (see jira_metadata.py). This "Resolution" map overrides
+# the automatic mappings, for resolutions whose names don't match, which is
+# common with custom Resolution values. It was manually constructed by looking
+# at the output from the REST API calls from the source and destination JIRAs.
+# In this case:
 #
 # https://issues.cloudera.org/rest/api/2/resolution
 # https://issues.apache.org/jira/rest/api/2/resolution
 #
 # If you are importing from/to other JIRA servers then you will have to come up
-# with your own mappings. This can't be fully automated because the names
-# aren't guaranteed to match (custom Resolution values are common).
-# On the bright side, "Resolution" is "global" for a given JIRA server -- it's
-# not project-specific.
+# with your own overrides, if any. On the bright side, "Resolution" is "global"
+# for a given JIRA server -- it's not project-specific.
 resolution_map = {
     "1" : "1", # Fixed
     "2" : "2", # Won't fix
@@ -88,43 +102,207 @@ resolution_map = {
     # 1000 # "Won't do". This conflicts with "Done" above, so we'll just ignore this.
 }
 
-def get_version_map(src_jira_url, dest_jira_url, project_key):
+# How the oldValue and newValue of the items in the issue history are
+# rewritten, keyed by the name of the field that the item changed. The kinds
+# of rules are:
+#
+#   "resolution"    A resolution id, mapped by name or with resolution_map. An
+#                   unmapped resolution is a fatal error.
+#   "version"       A version id, mapped with the version map of the project.
+#   "version_list"  A JSON-encoded array of version ids (as ints), mapped with
+#                   the version map of the project.
+#
+# Values of "version" fields that are not in the version map are left alone,
+# and reported at the end of the run. To rewrite another field, such as a
+# custom version field of your own, add it here.
+HISTORY_FIELD_RULES = {
+    "resolution" : "resolution",
+    "Version" : "version",
+    "Fix Version" : "version",
+    # Note: This mapping may not apply to all projects.
+    "Target Version/s" : "version_list",
+}
+
+def get_version_map(client, src_jira_url, dest_jira_url, project_key):
+    """ Fetch the versions of a project that was not known up front, and map them by name. """
     version_api_path = "/rest/api/2/project/%s/versions" % (project_key,)
-    version_name_map = defaultdict(list)
-    for root in (src_jira_url, dest_jira_url):
-        url = root + version_api_path
-        r = requests.get(url);
-        versions = r.json()
-        for v in versions:
-            version_name_map[v['name']].append(v['id'])
-    mapping = {}
-    for name in version_name_map:
-        l = version_name_map[name]
-        if len(l) != 2:
-            sys.stderr.write("WARN: Version with name '%s' does not appear in both instances\n" % (name,))
-            continue
-        old, new = l
-        mapping[old] = new
-    return mapping
-
-def get_field_map(src_jira_url):
-    """ Return map of available JIRA fields, keyed by field id. """
-    field_api_path = "/rest/api/2/field"
-    field_name_map = {}
-    url = src_jira_url + field_api_path
-    r = requests.get(url);
-    fields = r.json()
-    for field in fields:
-        if "id" in field:
-            field_name_map[field["id"]] = field
-    return field_name_map
-
-def add_missing_issue_fields(src_jira_url, issue, field_map, user_map):
-    issue_api_path = "/rest/api/2/issue/%s" % (issue["key"],)
-    url = src_jira_url + issue_api_path
-    r = requests.get(url);
-    rest_issue = r.json()
+    return map_versions_by_name(client.get_json(src_jira_url + version_api_path),
+                                client.get_json(dest_jira_url + version_api_path))
+
+def load_metadata(client, src_jira_url, dest_jira_url, project_keys=(), workers=1):
+    """
+    Fetch the metadata of both instances and of the given projects in one
+    round of concurrent requests, with resolution_map as the overrides of the
+    resolution mappings. Returns a MigrationMetadata.
+    """
+    return fetch_metadata(client, src_jira_url, dest_jira_url, project_keys, resolution_map, workers)
+
+def export_project_keys(data):
+    """ Returns the keys of the projects of a loaded dump. """
+    project_keys = []
+    for project in data.get("projects", []):
+        if project.get("key"):
+            project_keys.append(project["key"])
+        elif project.get("issues"):
+            project_keys.append(project["issues"][0]["key"].split("-", 2)[0])
+    return project_keys
+
+def get_rest_issue_request(src_jira_url, issue_key, fields=REST_ISSUE_FIELDS):
+    """ Returns the URL and query parameters to fetch the given fields of a single issue. """
+    issue_api_path = "/rest/api/2/issue/%s" % (issue_key,)
+    return src_jira_url + issue_api_path, { "fields": ",".join(fields) }
+
+def get_rest_issue(client, src_jira_url, issue_key, updated=None, fields=REST_ISSUE_FIELDS):
+    """
+    Fetch a single issue from the source instance's REST API. 'updated' is
+    the issue's last update timestamp from the export, which invalidates any
+    cached copy of an older revision of the issue.
+    """
+    url, params = get_rest_issue_request(src_jira_url, issue_key, fields)
+    return client.get_json(url, params, version=updated)
+
+def search_rest_issues(client, src_jira_url, issue_keys, fields=REST_ISSUE_FIELDS):
+    """
+    Fetch a batch of issues from the source instance's REST API using a JQL
+    search, which takes one request per page instead of one per issue.
+    Returns a list of REST issues in the same order as issue_keys. Search
+    results are not cached; see get_rest_issues().
+    """
+    search_api_path = "/rest/api/2/search"
+    params = { "jql": "key in (%s)" % (",".join(issue_keys),),
+               "fields": ",".join(fields),
+               # Don't fail the whole batch if one of the keys no longer exists.
+               "validateQuery": "false",
+               "startAt": 0,
+               "maxResults": len(issue_keys) }
+    rest_issues = {}
+    while True:
+        result = get_json(client.session, src_jira_url + search_api_path, params, client.stats)
+        for rest_issue in result["issues"]:
+            rest_issues[rest_issue["key"]] = rest_issue
+        params["startAt"] += len(result["issues"])
+        if not result["issues"] or params["startAt"] >= result["total"]:
+            break
+    # Issues that have been moved to another project since the export are
+    # returned under their new key by the search. Fall back to fetching those
+    # one by one, since the issue API follows the move.
+    return [rest_issues[key] if key in rest_issues else get_rest_issue(client, src_jira_url, key, fields=fields)
+            for key in issue_keys]
+
+# The custom fields of CUSTOM_FIELD_IDS are converted from their REST
+# representation to the JSON import format by a converter function, chosen by
+# the custom type of the field, or by its schema type for custom types that
+# have no converter of their own. A converter takes the REST value of the field
+# (None if it is not set) and the user mappings, and returns the value to
+# import, or None to leave the field out. To support another type of field,
+# add a converter for it here. Docs on custom field formats are here:
+# https://confluence.atlassian.com/jira/importing-data-from-json-495976468.html#ImportingDatafromJSON-CustomFields
+SYSTEM_FIELD_TYPE = "com.atlassian.jira.plugin.system.customfieldtypes:"
+
+def convert_plain(value, user_map):
+    return value
+
+def convert_name_list(value, user_map):
+    # Unlike the other converters, this keeps fields that are not set, as an
+    # empty list.
+    return [entry["name"] for entry in value or ()]
+
+def convert_name(value, user_map):
+    return value["name"] if value else None
 
+def convert_option(value, user_map):
+    return value["value"] if value else None
+
+def convert_option_list(value, user_map):
+    return [option["value"] for option in value] if value else None
+
+def convert_cascading_option(value, user_map):
+    if not value:
+        return None
+    options = { "": value["value"] }
+    if value.get("child"):
+        options["1"] = value["child"]["value"]
+    return options
+
+class UnmappedUserError(Exception):
+    """ Raised for a user in a custom field that is not in the user mappings. """
+    pass
+
+def convert_user(value, user_map):
+    if not value:
+        return None
+    if value["name"] not in user_map:
+        raise UnmappedUserError(value["name"])
+    return user_map[value["name"]]
+
+def convert_user_list(value, user_map):
+    return [convert_user(user, user_map) for user in value] if value else None
+
+CUSTOM_FIELD_CONVERTERS = {
+    SYSTEM_FIELD_TYPE + "multiversion" : convert_name_list,
+    SYSTEM_FIELD_TYPE + "version" : convert_name,
+    SYSTEM_FIELD_TYPE + "select" : convert_option,
+    SYSTEM_FIELD_TYPE + "radiobuttons" : convert_option,
+    SYSTEM_FIELD_TYPE + "multiselect" : convert_option_list,
+    SYSTEM_FIELD_TYPE + "multicheckboxes" : convert_option_list,
+    SYSTEM_FIELD_TYPE + "cascadingselect" : convert_cascading_option,
+    SYSTEM_FIELD_TYPE + "userpicker" : convert_user,
+    SYSTEM_FIELD_TYPE + "multiuserpicker" : convert_user_list,
+    SYSTEM_FIELD_TYPE + "datepicker" : convert_plain,
+    SYSTEM_FIELD_TYPE + "datetime" : convert_plain,
+    SYSTEM_FIELD_TYPE + "float" : convert_plain,
+    SYSTEM_FIELD_TYPE + "labels" : convert_plain,
+    # By schema type: text fields, URLs, read-only fields and the like.
+    "string" : convert_plain,
+}
+
+class CustomFieldConverter(object):
+    """
+    Converts the custom fields of CUSTOM_FIELD_IDS from the REST
+    representation of an issue to the "customFieldValues" of the exported
+    issue. The fields are looked up in 'field_map' and bound to their
+    converter once, up front, so converting an issue is a loop over the
+    bound converters. Usernames are mapped with 'user_map'.
+    """
+    def __init__(self, field_map, user_map, field_ids=CUSTOM_FIELD_IDS, converters=CUSTOM_FIELD_CONVERTERS):
+        self.fields = []
+        for field_id in field_ids:
+            if field_id not in field_map:
+                sys.stderr.write("ERROR: Unable to find custom field '%s' in field map\n" % (field_id,))
+                sys.exit(1)
+            field = field_map[field_id]
+            if not field["custom"]:
+                sys.stderr.write("ERROR: Only custom fields are supported in this code path. Field '%s' is not a custom field\n" % (field_id,))
+                sys.exit(1)
+            customtype = field["schema"]["custom"]
+            convert = converters.get(customtype, converters.get(field["schema"]["type"]))
+            if convert is None:
+                sys.stderr.write("ERROR: Handler needed for custom field '%s' with name '%s' of type '%s'; add it to CUSTOM_FIELD_CONVERTERS\n" %
+                                 (field_id, field["name"], customtype))
+                sys.exit(1)
+            self.fields.append((field_id, field["name"], customtype, convert))
+        self.user_map = user_map
+
+    def convert_issue(self, issue, rest_issue):
+        """ Add the custom fields of the REST issue to the issue. """
+        rest_fields = rest_issue["fields"]
+        user_map = self.user_map
+        values = issue["customFieldValues"]
+        for field_id, name, customtype, convert in self.fields:
+            try:
+                value = convert(rest_fields.get(field_id), user_map)
+            except UnmappedUserError as e:
+                sys.stderr.write("ERROR: %s user '%s' of %s not in username map\n" % (name, e, issue["key"]))
+                sys.exit(1)
+            if value is not None:
+                values.append({ "fieldName": name, "fieldType": customtype, "value": value })
+
+def add_missing_issue_fields(issue, rest_issue, custom_fields, user_map):
+    """
+    Fill in the fields of an exported issue that the JSON exporter leaves out,
+    using the REST representation of the same issue. 'custom_fields' is the
+    CustomFieldConverter of the run.
+    """
     # Note: The REST issues API has a different JSON schema than the JSON import/export API.
     # The JSON import/export format is documented here:
     # https://confluence.atlassian.com/jira/importing-data-from-json-495976468.html
@@ -161,7 +339,7 @@ def add_missing_issue_fields(src_jira_url, issue, field_map, user_map):
     for a in attachments:
         author_oldname = a["author"]["name"]
         if author_oldname not in user_map:
-            sys.stderr.write("ERROR: attachment user '%s' not in username map\n" % (author_oldname,))
+            sys.stderr.write("ERROR: attachment user '%s' of %s not in username map\n" % (author_oldname, issue["key"]))
             sys.exit(1)
         issue["attachments"].append({ "name": a["filename"],
                                       "attacher": user_map[author_oldname],
@@ -171,102 +349,313 @@ def add_missing_issue_fields(src_jira_url, issue, field_map, user_map):
 
     # Custom fields. Add the fields you want to pull to the CUSTOM_FIELD_IDS
     # array at the top of this file.
-    # At the time of this writing, support for doing the mapping for different
-    # field types is limited, but this script can easily be augmented to
-    # support different field types. Docs on custom field formats are here:
-    # https://confluence.atlassian.com/jira/importing-data-from-json-495976468.html#ImportingDatafromJSON-CustomFields
-    for custom_field_id in CUSTOM_FIELD_IDS:
-        if custom_field_id not in field_map:
-            sys.stderr.write("ERROR: Unable to find custom field '%s' in field map" % (custom_field_id,))
-            sys.exit(1)
-        field = field_map[custom_field_id]
-        if not field["custom"]:
-            sys.stderr.write("ERROR: Only custom fields are supported in this code path. Field '%s' is not a custom field" % (custom_field_id,))
-            sys.exit(1)
-        custom_field_name = field["name"]
-        custom_field_type = field["schema"]["type"]
-        custom_field_customtype = field["schema"]["custom"]
-
-        # Handle the different types of fields here.
-        custom_field_out = None
-
-        if custom_field_customtype == "com.atlassian.jira.plugin.system.customfieldtypes:multiversion":
-            # Note: This code path would probably also work for generic arrays of strings.
-            custom_field_out = { "fieldName": custom_field_name, "fieldType": custom_field_customtype, "value": [] }
-            if rest_issue["fields"][custom_field_id]:
-                for entry in rest_issue["fields"][custom_field_id]:
-                    custom_field_out["value"].append(entry["name"])
-        elif custom_field_type == "string":
-            if custom_field_id in rest_issue["fields"] and rest_issue["fields"][custom_field_id] is not None:
-                custom_field_out = { "fieldName": custom_field_name,
-                                     "fieldType": custom_field_customtype,
-                                     "value": rest_issue["fields"][custom_field_id] }
-        else:
-            # TODO: Add handling for more custom types here.
-            sys.stderr.write("ERROR: Handler needed for custom field '%s' with name '%s' of type '%s'" % (custom_field_id, custom_field_name, custom_field_customtype))
-            sys.exit(1)
+    custom_fields.convert_issue(issue, rest_issue)
+
+class UnmappedResolutionError(Exception):
+    """ Raised for a resolution in the issue history that could not be mapped. """
+    pass
+
+class HistoryRewriter(object):
+    """
+    Maps resolution and version ids in the issue history to the destination's
+    ids, following HISTORY_FIELD_RULES. The rules are compiled once into a
+    converter function per field, and the result of converting each distinct
+    value is memoized. Values that could not be mapped are counted in
+    'unmapped', a dict keyed by (field, value), which may be shared by
+    several rewriters. 'resolutions' maps the resolution ids, and defaults to
+    resolution_map.
+    """
+    def __init__(self, release_version_map, unmapped=None, rules=HISTORY_FIELD_RULES, resolutions=None):
+        self.release_version_map = release_version_map
+        self.resolutions = resolutions if resolutions is not None else resolution_map
+        self.unmapped = unmapped if unmapped is not None else defaultdict(int)
+        self.converters = {}
+        for field, kind in rules.iteritems():
+            if not hasattr(self, "_convert_" + kind):
+                raise ValueError("Unknown kind of history rule '%s' for field '%s'" % (kind, field))
+            self.converters[field] = self._memoize(field, getattr(self, "_convert_" + kind))
+
+    # Each converter returns the converted value, and a list of the parts of
+    # the value that could not be mapped.
+
+    def _convert_resolution(self, value):
+        if value is None:
+            return value, []
+        if value not in self.resolutions:
+            raise UnmappedResolutionError(value)
+        return self.resolutions[value], []
+
+    def _convert_version(self, value):
+        if value in self.release_version_map:
+            return self.release_version_map[value], []
+        return value, [value] if value else []
+
+    def _convert_version_list(self, value):
+        if value is None:
+            return value, []
+        vals = json.loads(value)
+        unmapped = []
+        for i in range(len(vals)):
+            if str(vals[i]) in self.release_version_map:
+                vals[i] = int(self.release_version_map[str(vals[i])])
+            else:
+                unmapped.append(str(vals[i]))
+        return json.dumps(vals), unmapped
+
+    def _memoize(self, field, convert):
+        cache = {}
+        unmapped = self.unmapped
+        def convert_memoized(value):
+            if value not in cache:
+                cache[value] = convert(value)
+            result, unmapped_parts = cache[value]
+            for part in unmapped_parts:
+                unmapped[(field, part)] += 1
+            return result
+        return convert_memoized
+
+    def rewrite_issue(self, issue):
+        """ Rewrite the history of the issue in place. """
+        converters = self.converters
+        for h in issue["history"]:
+            for item in h.get("items", ()):
+                convert = converters.get(item.get("field"))
+                if convert is None or "newDisplayValue" not in item:
+                    continue
+                try:
+                    if "oldValue" in item:
+                        item["oldValue"] = convert(item["oldValue"])
+                    if "newValue" in item:
+                        item["newValue"] = convert(item["newValue"])
+                except UnmappedResolutionError as e:
+                    sys.stderr.write("ERROR: Resolution '%s' in the history of %s could not be mapped; add it to resolution_map\n" %
+                                     (e, issue["key"]))
+                    sys.exit(1)
+
+def report_unmapped_history_values(unmapped):
+    """ Warn about the values in the issue history that could not be mapped. """
+    if not unmapped:
+        return
+    sys.stderr.write("WARN: %d values in the issue history were left unmapped:\n" % (sum(unmapped.values()),))
+    for (field, value), count in sorted(unmapped.iteritems(), key=lambda entry: (-entry[1], entry[0])):
+        sys.stderr.write("WARN:   %s '%s' (%d times)\n" % (field, value, count))
+
+def get_rest_issues(client, src_jira_url, issues, workers=1, batch_size=1, fields=REST_ISSUE_FIELDS):
+    """
+    Generator yielding (issue, rest_issue) pairs with the REST representation
+    of each of the given issues, in order, with the given fields. Issues are
+    fetched on 'workers' threads, either one by one or in JQL searches of up
+    to 'batch_size' issues. Either way, each issue is cached individually
+    under its own URL, and only the issues that are not in the cache (or that
+    changed since they were cached) are fetched.
+    """
+    if batch_size <= 1:
+        fetch = lambda issue: (issue, get_rest_issue(client, src_jira_url, issue["key"], issue.get("updated"), fields))
+        return imap_ordered(fetch, issues, workers)
+
+    def fetch_batch(batch):
+        issue_requests = [get_rest_issue_request(src_jira_url, issue["key"], fields) for issue in batch]
+        rest_issues = [client.get_cached(url, params, issue.get("updated"))
+                       for issue, (url, params) in izip(batch, issue_requests)]
+        missing = [i for i in range(len(batch)) if rest_issues[i] is None]
+        if missing and client.offline:
+            raise CacheMissError("Not in the cache: %s" % (", ".join(batch[i]["key"] for i in missing),))
+        if missing:
+            fetched = search_rest_issues(client, src_jira_url, [batch[i]["key"] for i in missing], fields)
+            for i, rest_issue in izip(missing, fetched):
+                url, params = issue_requests[i]
+                client.put_cached(url, params, rest_issue, batch[i].get("updated"))
+                rest_issues[i] = rest_issue
+        return zip(batch, rest_issues)
+
+    return (pair
+            for batch in imap_ordered(fetch_batch, chunks(issues, batch_size), workers)
+            for pair in batch)
 
-        if custom_field_out is not None:
-            issue["customFieldValues"].append(custom_field_out)
+def enrich_issues(client, src_jira_url, issues, field_map, user_map, workers=1, batch_size=1, custom_fields=None):
+    """
+    Generator adding the missing fields to each of the given issues.
+    'custom_fields' is the CustomFieldConverter to use, which is built from
+    'field_map' if not given.
+    """
+    # The REST calls run ahead on the worker threads, while the results are
+    # applied here in the original issue order.
+    if custom_fields is None:
+        custom_fields = CustomFieldConverter(field_map, user_map)
+    for issue, rest_issue in get_rest_issues(client, src_jira_url, issues, workers, batch_size):
+        add_missing_issue_fields(issue, rest_issue, custom_fields, user_map)
+        yield issue
+
+def enrich_events(events, client, src_jira_url, field_map, user_map, workers=1, batch_size=1):
+    """ Generator adding the missing fields to the issues in a stream of dump events. """
+    custom_fields = CustomFieldConverter(field_map, user_map)
+    for kind, name, value in events:
+        if kind == PROJECT:
+            value = enrich_issues(client, src_jira_url, value, field_map, user_map, workers, batch_size,
+                                  custom_fields)
+        yield (kind, name, value)
+
+def get_issue_hasher(client, src_jira_url, dest_jira_url, field_map, user_map, version_maps, resolutions=None):
+    """
+    Returns a function that hashes an issue before enrichment, together with
+    all of the configuration that determines how it will be transformed: the
+    user mappings, the resolution mappings, the custom fields and the version map of
+    its project. Two issues with the same hash are transformed identically,
+    as long as the REST data on the source instance is the same, which is the
+    case when the issue's "updated" timestamp is the same. The version maps
+    of the projects are fetched into 'version_maps' as needed.
+    """
+    custom_fields = [field_map.get(custom_field_id) for custom_field_id in CUSTOM_FIELD_IDS]
+    if resolutions is None:
+        resolutions = resolution_map
+    config_hash = content_hash([user_map, resolutions, HISTORY_FIELD_RULES, CUSTOM_FIELD_IDS, custom_fields])
+    project_hashes = {}
+
+    def issue_hash(issue):
+        project_key, _ = issue["key"].split("-", 2)
+        if project_key not in project_hashes:
+            if project_key not in version_maps:
+                version_maps[project_key] = get_version_map(client, src_jira_url, dest_jira_url, project_key)
+            project_hashes[project_key] = content_hash(version_maps[project_key], config_hash)
+        return content_hash(issue, project_hashes[project_key])
+    return issue_hash
+
+def rewrite_project_history(client, src_jira_url, dest_jira_url, issues, version_maps=None, unmapped=None,
+                            resolutions=None):
+    """
+    Generator rewriting the history of each of the issues of a project.
+    'version_maps' is an optional dict of version maps keyed by project key,
+    which is consulted before fetching a project's versions and updated after.
+    Values that could not be mapped are counted in 'unmapped', if given, and
+    resolutions are mapped with 'resolutions' (see HistoryRewriter).
+    """
+    issues = iter(issues)
+    first_issue = next(issues, None)
+    if first_issue is None:
+        return
+    project_key, _ = first_issue["key"].split("-", 2)
+    if version_maps is not None and project_key in version_maps:
+        release_version_map = version_maps[project_key]
+    else:
+        release_version_map = get_version_map(client, src_jira_url, dest_jira_url, project_key)
+        if version_maps is not None:
+            version_maps[project_key] = release_version_map
+    rewriter = HistoryRewriter(release_version_map, unmapped, resolutions=resolutions)
+    for issue in chain([first_issue], issues):
+        rewriter.rewrite_issue(issue)
+        yield issue
+
+def rewrite_history_events(events, client, src_jira_url, dest_jira_url, version_maps=None, unmapped=None,
+                           resolutions=None):
+    """ Generator rewriting the history of the issues in a stream of dump events. """
+    for kind, name, value in events:
+        if kind == PROJECT:
+            value = rewrite_project_history(client, src_jira_url, dest_jira_url, value, version_maps, unmapped,
+                                            resolutions)
+        yield (kind, name, value)
+
+def usage():
+    sys.stderr.write("Usage: %s [--stream] [--journal=FILE] [--workers=N] [--batch-size=N] [--cache=FILE [--offline]] [--output-format=F] [--compress=C] [--stats=FILE] user_mappings.tsv src_jira_url dest_jira_url file.json > out.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --workers=8 --batch-size=100 user_mappings.tsv https://issues.cloudera.org https://issues.apache.org/jira file.json > out.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --stream        Process the dump one issue at a time instead of loading it into memory.\n")
+    sys.stderr.write("  --journal=FILE  Record each transformed issue in FILE as it is done. Issues recorded\n")
+    sys.stderr.write("                  there by a previous (possibly interrupted) run are reused if they\n")
+    sys.stderr.write("                  have not changed since, so only new or changed issues are enriched.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and REST request statistics to FILE.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.stderr.write(LOAD_OPTIONS_USAGE)
+    sys.stderr.write(OUTPUT_OPTIONS_USAGE)
+    sys.exit(1)
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 5:
-        sys.stderr.write("Usage: %s user_mappings.tsv src_jira_url dest_jira_url file.json > out.json\n" % sys.argv[0])
-        sys.stderr.write("Example: %s user_mappings.tsv https://issues.cloudera.org https://issues.apache.org/jira file.json > out.json\n" % sys.argv[0])
-        sys.exit(1)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["stream", "journal=", "stats="] + REST_OPTIONS + LOAD_OPTIONS +
+                                   OUTPUT_OPTIONS)
+        rest_options = parse_rest_options(opts)
+        load_options = parse_load_options(opts)
+        output_options = parse_output_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) != 4:
+        usage()
+
+    stream = False
+    journal_filename = None
+    stats_filename = None
+    for opt, val in opts:
+        if opt == "--stream":
+            stream = True
+        elif opt == "--journal":
+            journal_filename = val
+        elif opt == "--stats":
+            stats_filename = val
 
-    user_mappings_filename = sys.argv[1]
-    src_jira_url = sys.argv[2]
-    dest_jira_url = sys.argv[3]
-    filename = sys.argv[4]
+    user_mappings_filename = args[0]
+    src_jira_url = args[1]
+    dest_jira_url = args[2]
+    filename = args[3]
 
     # Read the username mappings.
     user_map = get_user_mappings(user_mappings_filename)
 
-    # Fetch the global list of fields from the server.
-    field_map = get_field_map(src_jira_url)
-
-    with open(filename, "r") as f:
-        data = json.load(f)
-        for proj in data["projects"]:
-            project_key = None
-            release_version_map = None
-            for issue in proj["issues"]:
-                if project_key is None:
-                    project_key, _ = issue["key"].split("-", 2)
-                    release_version_map = get_version_map(src_jira_url, dest_jira_url, project_key)
-
-                sys.stderr.write("INFO: Processing %s...\n" % (issue["key"],))
-                add_missing_issue_fields(src_jira_url, issue, field_map, user_map)
-
-                for h in issue["history"]:
-                    if "items" in h:
-                        for item in h["items"]:
-                            value_fields = ["oldValue", "newValue"] # correct history as needed
-                            for value_field in value_fields:
-                                if "field" in item and value_field in item and "newDisplayValue" in item:
-                                    # Apply resolution mappings.
-                                    if item["field"] == "resolution":
-                                        item[value_field] = resolution_map[item[value_field]]
-                                    # Apply version mappings.
-                                    if item["field"] == "Version" or item["field"] == "Fix Version":
-                                        if item[value_field] in release_version_map:
-                                            item[value_field] = release_version_map[item[value_field]]
-                                        else:
-                                            # TODO: Potentially crash with error in this case.
-                                            pass
-
-                                    # Note: This mapping may not apply to all projects.
-                                    # Target Version/s is a JSON-encoded array of ints.
-                                    if item["field"] == "Target Version/s":
-                                        vals = json.loads(item[value_field])
-                                        for i in range(len(vals)):
-                                            if str(vals[i]) in release_version_map:
-                                                vals[i] = int(release_version_map[str(vals[i])])
-                                            else:
-                                                # TODO: Potentially crash with error in this case.
-                                                pass
-                                        item[value_field] = json.dumps(vals);
-
-        print json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '))
+    stats = RunStats()
+    client = new_rest_client(rest_options, stats)
+
+    journal = None
+    if journal_filename is not None:
+        journal = IssueJournal(journal_filename)
+        if len(journal):
+            sys.stderr.write("INFO: Resuming with %d issues from journal %s\n" % (len(journal), journal_filename))
+
+    with open_export(filename) as f:
+        project_keys = ()
+        if stream:
+            events = stats.stream_export(f)
+        else:
+            data = stats.load_export(f, load_options)
+            project_keys = export_project_keys(data)
+            events = iter_export_data(data)
+        try:
+            # Fetch the fields, resolutions and versions from both servers at
+            # once. The versions of projects that only show up while streaming
+            # are fetched when they are reached.
+            metadata = stats.run_phase("fetch", load_metadata, client, src_jira_url, dest_jira_url, project_keys,
+                                       rest_options["workers"])
+            field_map = metadata.field_map
+            resolutions = metadata.resolution_map
+            version_maps = metadata.version_maps()
+            unmapped = defaultdict(int)
+            def transform(events):
+                events = enrich_events(events, client, src_jira_url, field_map, user_map,
+                                       rest_options["workers"], rest_options["batch_size"])
+                events = stats.timed_events(events, "fetch")
+                events = rewrite_history_events(events, client, src_jira_url, dest_jira_url, version_maps, unmapped,
+                                                resolutions)
+                return stats.timed_events(events, "history")
+            if journal is not None:
+                issue_hash = get_issue_hasher(client, src_jira_url, dest_jira_url, field_map, user_map, version_maps,
+                                              resolutions)
+                events = stats.timed_events(journal_events(events, journal, transform, issue_hash), "journal")
+            else:
+                events = transform(events)
+
+            writer = new_export_writer(sys.stdout, output_options)
+            writer.write_events(stats.progress_events(events))
+            writer.close()
+            report_unmapped_history_values(unmapped)
+            if journal is not None:
+                journal.compact()
+                sys.stderr.write("INFO: %s\n" % (journal.summary(),))
+        except CacheMissError as e:
+            sys.stderr.write("ERROR: %s\n" % (e,))
+            sys.exit(1)
+        finally:
+            if journal is not None:
+                journal.close()
+
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
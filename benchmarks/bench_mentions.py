@@ -0,0 +1,78 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Micro-benchmark comparing the single-pass at-mention rewriter in
+# remap_users.py against the original approach of calling str.replace() once
+# per user mapping. Also checks that both produce identical results.
+#
+###############################################################################
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from remap_users import compile_mention_rewriter
+
+def replace_mentions_per_user(text, user_mappings):
+    """ The original implementation: one str.replace() per mapping. """
+    for old_name in user_mappings:
+        old_mention = "[~%s]" % (old_name,)
+        new_mention = "[~%s]" % (user_mappings[old_name],)
+        text = text.replace(old_mention, new_mention)
+    return text
+
+def make_user_mappings(num_users):
+    user_mappings = {}
+    for i in range(num_users):
+        old_name = "user%d" % (i,)
+        r = random.random()
+        if r < 0.1:
+            # Chain into another user's old name, the ordering edge case.
+            user_mappings[old_name] = "user%d" % (random.randrange(num_users),)
+        elif r < 0.5:
+            user_mappings[old_name] = "new-user%d" % (i,)
+        else:
+            user_mappings[old_name] = old_name
+    return user_mappings
+
+def make_texts(num_texts, num_users, mentions_per_text):
+    texts = []
+    for _ in range(num_texts):
+        words = ["lorem ipsum dolor sit amet"] * 20
+        for _ in range(mentions_per_text):
+            words.insert(random.randrange(len(words)), "[~user%d]" % (random.randrange(num_users * 2),))
+        texts.append(u" ".join(words))
+    return texts
+
+def timed(func, texts):
+    start = time.time()
+    results = [func(text) for text in texts]
+    return time.time() - start, results
+
+if __name__ == "__main__":
+    random.seed(42)
+    num_texts = 2000
+    print "%8s %8s %12s %12s %8s" % ("users", "texts", "replace (s)", "single (s)", "speedup")
+    for num_users in (10, 100, 1000, 5000):
+        user_mappings = make_user_mappings(num_users)
+        texts = make_texts(num_texts, num_users, 3)
+        old_time, old_results = timed(lambda text: replace_mentions_per_user(text, user_mappings), texts)
+        rewrite_mentions = compile_mention_rewriter(user_mappings)
+        new_time, new_results = timed(rewrite_mentions, texts)
+        if old_results != new_results:
+            sys.stderr.write("ERROR: Results differ for %d users\n" % (num_users,))
+            sys.exit(1)
+        print "%8d %8d %12.3f %12.3f %7.0fx" % (num_users, num_texts, old_time, new_time, old_time / max(new_time, 1e-9))
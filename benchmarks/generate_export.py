@@ -0,0 +1,218 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Generates a synthetic JIRA JSON export for benchmarking, along with matching
+# user mappings and user excludes files. The shape of the export is
+# configurable: the number of issues, projects and users, the depth of the
+# issue histories, the number and size of comments, the density of at-mentions
+# and the fraction of issues with links. The same seed always produces the
+# same export.
+#
+# The version ids and resolutions in the issue histories match the ones
+# served by jira_stub_server.py, so the export can be run through the whole
+# pipeline against the stub server.
+#
+###############################################################################
+import getopt
+import json
+import random
+import string
+import sys
+
+# Defaults for the shape of the generated export.
+DEFAULTS = { "issues": 1000,
+             "projects": 1,
+             "users": 100,
+             "history": 5,
+             "comments": 3,
+             "comment_size": 100,
+             "mentions": 2.0,
+             "links": 0.1,
+             "seed": 42 }
+
+# The number of versions of each project, on both instances. Source version
+# ids start at SRC_VERSION_ID and destination ids at DEST_VERSION_ID.
+NUM_VERSIONS = 20
+SRC_VERSION_ID = 10000
+DEST_VERSION_ID = 20000
+
+# Source resolution ids that appear in the issue histories. These are all in
+# the resolution_map of add_missing_jira_fields.py.
+RESOLUTION_IDS = ["1", "2", "3", "4", "5", "6", "10000", "10001", "10003"]
+
+WORDS = ["the", "build", "fails", "when", "running", "tests", "on", "a", "cluster", "with",
+         "impala", "query", "patch", "review", "please", "take", "look", "fixed", "in", "trunk"]
+
+def username(i):
+    return "user%d" % (i,)
+
+def project_key(i):
+    """ Returns the key of the i'th project: "BA", "BB", ..., "BZ", "CA", ... """
+    return string.ascii_uppercase[1 + i / 26] + string.ascii_uppercase[i % 26]
+
+def version_name(i):
+    return "1.%d.0" % (i,)
+
+def make_text(rand, num_words, num_users, mentions_per_100_words):
+    """ Returns a text of about num_words words, sprinkled with at-mentions. """
+    words = [rand.choice(WORDS) for _ in range(num_words)]
+    for _ in range(int(num_words * mentions_per_100_words / 100.0 + rand.random())):
+        words.insert(rand.randrange(len(words) + 1), "[~%s]" % (username(rand.randrange(num_users)),))
+    return " ".join(words)
+
+def make_history_item(rand, num_users):
+    """ Returns a random item of an issue's change history. """
+    kind = rand.randrange(5)
+    if kind == 0:
+        old, new = rand.sample(RESOLUTION_IDS, 2)
+        return { "fieldType": "jira", "field": "resolution",
+                 "oldValue": old, "oldDisplayValue": "Reopened",
+                 "newValue": new, "newDisplayValue": "Fixed" }
+    if kind == 1 or kind == 2:
+        old, new = rand.sample(range(NUM_VERSIONS), 2)
+        return { "fieldType": "jira", "field": rand.choice(["Version", "Fix Version"]),
+                 "oldValue": str(SRC_VERSION_ID + old), "oldDisplayValue": version_name(old),
+                 "newValue": str(SRC_VERSION_ID + new), "newDisplayValue": version_name(new) }
+    if kind == 3:
+        new = rand.sample(range(NUM_VERSIONS), 2)
+        return { "fieldType": "custom", "field": "Target Version/s",
+                 "oldValue": "[]", "oldDisplayValue": "",
+                 "newValue": json.dumps([SRC_VERSION_ID + i for i in new]),
+                 "newDisplayValue": ", ".join(version_name(i) for i in new) }
+    old, new = rand.sample(range(num_users), 2)
+    return { "fieldType": "jira", "field": "assignee",
+             "oldValue": username(old), "oldDisplayValue": username(old).title(),
+             "newValue": username(new), "newDisplayValue": username(new).title() }
+
+def make_issue(rand, key, options):
+    num_users = options["users"]
+    history = []
+    for i in range(options["history"]):
+        history.append({ "author": username(rand.randrange(num_users)),
+                         "created": "2015-02-%02dT10:00:00.000+0000" % (1 + i % 28,),
+                         "items": [make_history_item(rand, num_users) for _ in range(rand.randint(1, 3))] })
+    comments = []
+    for i in range(options["comments"]):
+        comments.append({ "author": username(rand.randrange(num_users)),
+                          "created": "2015-03-%02dT10:00:00.000+0000" % (1 + i % 28,),
+                          "body": make_text(rand, options["comment_size"], num_users, options["mentions"]) })
+    return { "key": key,
+             "externalId": key,
+             "summary": make_text(rand, 8, num_users, 0),
+             "description": make_text(rand, options["comment_size"], num_users, options["mentions"]),
+             "status": "Resolved",
+             "priority": "Major",
+             "issueType": "Bug",
+             "reporter": username(rand.randrange(num_users)),
+             "assignee": username(rand.randrange(num_users)),
+             "created": "2015-01-01T10:00:00.000+0000",
+             "updated": "2015-04-01T10:00:00.000+0000",
+             "watchers": [username(rand.randrange(num_users)) for _ in range(rand.randint(0, 3))],
+             "voters": [],
+             "history": history,
+             "comments": comments,
+             "attachments": [],
+             "customFieldValues": [] }
+
+def make_export(options):
+    """ Returns a synthetic export with the shape given by the options (see DEFAULTS). """
+    rand = random.Random(options["seed"])
+    num_projects = options["projects"]
+    projects = []
+    keys = []
+    for p in range(num_projects):
+        key = project_key(p)
+        # Spread the issues evenly over the projects.
+        num_issues = options["issues"] / num_projects + (1 if p < options["issues"] % num_projects else 0)
+        issues = [make_issue(rand, "%s-%d" % (key, i + 1), options) for i in range(num_issues)]
+        keys.extend(issue["key"] for issue in issues)
+        projects.append({ "key": key,
+                          "name": "Project %s" % (key,),
+                          "description": "Synthetic project for benchmarks",
+                          "type": "software",
+                          "lead": username(0),
+                          "versions": [{ "name": version_name(i), "released": True } for i in range(NUM_VERSIONS)],
+                          "components": [{ "name": "component%d" % (i,) } for i in range(5)],
+                          "issues": issues })
+    links = []
+    for key in keys:
+        if rand.random() < options["links"]:
+            links.append({ "name": rand.choice(["Blocker", "Duplicate", "Reference"]),
+                           "sourceId": key, "destinationId": rand.choice(keys) })
+    users = [{ "name": username(i), "fullname": username(i).title(), "email": "%s@example.com" % (username(i),) }
+             for i in range(options["users"])]
+    return { "users": users, "projects": projects, "links": links }
+
+def write_user_mappings(filename, num_users):
+    """ Write user mappings for the generated users: half of them are renamed. """
+    with open(filename, "w") as f:
+        for i in range(num_users):
+            if i % 2:
+                f.write("%s\tnew-%s\n" % (username(i), username(i)))
+            else:
+                f.write("%s\n" % (username(i),))
+
+def write_users_to_exclude(filename):
+    with open(filename, "w") as f:
+        f.write("\n")
+
+def usage():
+    sys.stderr.write("Usage: %s [options] > export.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --issues=N          Number of issues (default: %d).\n" % (DEFAULTS["issues"],))
+    sys.stderr.write("  --projects=N        Number of projects to spread them over (default: %d).\n" % (DEFAULTS["projects"],))
+    sys.stderr.write("  --users=N           Number of users (default: %d).\n" % (DEFAULTS["users"],))
+    sys.stderr.write("  --history=N         Change history entries per issue (default: %d).\n" % (DEFAULTS["history"],))
+    sys.stderr.write("  --comments=N        Comments per issue (default: %d).\n" % (DEFAULTS["comments"],))
+    sys.stderr.write("  --comment-size=N    Words per comment and description (default: %d).\n" % (DEFAULTS["comment_size"],))
+    sys.stderr.write("  --mentions=F        At-mentions per 100 words (default: %g).\n" % (DEFAULTS["mentions"],))
+    sys.stderr.write("  --links=F           Fraction of issues with a link (default: %g).\n" % (DEFAULTS["links"],))
+    sys.stderr.write("  --seed=N            Random seed (default: %d).\n" % (DEFAULTS["seed"],))
+    sys.stderr.write("  --user-mappings=F   Also write matching user mappings to file F.\n")
+    sys.stderr.write("  --user-excludes=F   Also write an (empty) user excludes file F.\n")
+    sys.exit(1)
+
+def parse_options(opts):
+    """ Returns the export options in the (option, value) pairs returned by getopt. """
+    options = dict(DEFAULTS)
+    for opt, val in opts:
+        name = opt[2:].replace("-", "_")
+        if name in ("mentions", "links"):
+            options[name] = float(val)
+        elif name in options:
+            options[name] = int(val)
+    return options
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["issues=", "projects=", "users=", "history=", "comments=",
+                                                      "comment-size=", "mentions=", "links=", "seed=",
+                                                      "user-mappings=", "user-excludes="])
+        options = parse_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if args:
+        usage()
+
+    for opt, val in opts:
+        if opt == "--user-mappings":
+            write_user_mappings(val, options["users"])
+        elif opt == "--user-excludes":
+            write_users_to_exclude(val)
+
+    json.dump(make_export(options), sys.stdout, sort_keys=True, indent=2, separators=(',', ': '))
+    sys.stdout.write("\n")
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# A local stand-in for the REST API of a source and a destination JIRA
+# instance, for benchmarking the scripts without touching a live JIRA. It
+# serves the endpoints that the scripts use:
+#
+#   /rest/api/2/issue/<key>              A made-up issue, the same on every call.
+#   /rest/api/2/issue/<key>/watchers     The watchers of an issue.
+#   /rest/api/2/search                   "key in (...)" and "project = ..." JQL
+#                                        searches, paged, with the changelog.
+#                                        Project searches may be limited to
+#                                        ranges of ids, and ordered by
+#                                        descending id.
+#   /rest/api/2/project/<key>            A project with its versions and components.
+#   /rest/api/2/user                     The user with exactly the given "username".
+#   /rest/api/2/user/search              Users whose name or email starts with "username".
+#   /rest/api/2/field                    The custom fields of add_missing_jira_fields.py.
+#   /rest/api/2/resolution               The resolutions used by generate_export.py.
+#   /rest/api/2/project/<key>/versions   The versions of any project.
+#   /secure/attachment/<id>/<name>       Attachment contents.
+#
+# The source instance lives under <server>/src and the destination instance
+# under <server>/dest. Both have the same version and resolution names, with
+# different ids, to match the exports written by generate_export.py. Every request is delayed by
+# a configurable latency, to simulate a remote instance. Every project has the
+# same configurable number of issues. Of the users of generate_export.py, the
+# destination has a quarter under the same name and email, a quarter under
+# another name ("new-" + name) with the same email, and a quarter under the
+# same name with another email; the rest are missing. The number of requests
+# per endpoint and the number of bytes served are available as JSON from
+# <server>/_stats, and are reset by <server>/_stats/reset.
+#
+# The server can either be run from the command line, or started on a
+# background thread with start_server().
+#
+###############################################################################
+import getopt
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate_export import DEST_VERSION_ID, NUM_VERSIONS, SRC_VERSION_ID, username, version_name
+
+# The custom fields that add_missing_jira_fields.py expects.
+FIELDS = [ { "id": "customfield_10060", "name": "Target Version/s", "custom": True,
+             "schema": { "type": "array", "custom": "com.atlassian.jira.plugin.system.customfieldtypes:multiversion" } },
+           { "id": "customfield_10066", "name": "Code Review", "custom": True,
+             "schema": { "type": "string", "custom": "com.atlassian.jira.plugin.system.customfieldtypes:url" } },
+           { "id": "customfield_10177", "name": "Code Review", "custom": True,
+             "schema": { "type": "string", "custom": "com.atlassian.jira.plugin.system.customfieldtypes:url" } },
+           { "id": "customfield_10058", "name": "Code Review", "custom": True,
+             "schema": { "type": "string", "custom": "com.atlassian.jira.plugin.system.customfieldtypes:url" } },
+           { "id": "summary", "name": "Summary", "custom": False, "schema": { "type": "string" } },
+           { "id": "resolution", "name": "Resolution", "custom": False, "schema": { "type": "resolution" } } ]
+
+RESOLUTION_NAMES = ["Fixed", "Won't Fix", "Duplicate", "Incomplete", "Cannot Reproduce"]
+
+# The (source id, destination id, name) of the resolutions of both instances,
+# for the RESOLUTION_IDS of generate_export.py.
+RESOLUTIONS = [("1", "1", "Fixed"), ("2", "2", "Won't Fix"), ("3", "3", "Duplicate"), ("4", "4", "Incomplete"),
+               ("5", "5", "Cannot Reproduce"), ("6", "6", "Invalid"), ("10000", "11", "Done"),
+               ("10001", "8", "Not A Problem"), ("10003", "7", "Later")]
+
+COMPONENT_NAMES = ["Backend", "Frontend", "Docs"]
+
+# The most issues that a search returns per page, like JIRA's own limits,
+# which are lower with the changelog expanded.
+MAX_SEARCH_RESULTS = 100
+MAX_CHANGELOG_SEARCH_RESULTS = 50
+
+# Defaults for the command-line options.
+DEFAULT_PORT = 8765
+DEFAULT_USERS = 100
+DEFAULT_PROJECT_ISSUES = 1000
+
+ISSUE_KEY_RE = re.compile(r"[A-Z][A-Z0-9]*-[0-9]+")
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    The stub JIRA server. 'latency' is the delay of each request in seconds,
+    'num_users' the number of users that attachment authors are drawn from,
+    'links' the fraction of issues with links, 'attachments' the fraction of
+    issues with an attachment, 'attachment_size' the size of each attachment
+    in bytes, 'description_size' the length of the issue descriptions,
+    which only matter when an issue is requested with all of its fields, and
+    'project_issues' the number of issues of each project.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, num_users=DEFAULT_USERS, links=0.1, attachments=0.2,
+                 attachment_size=10000, description_size=2000, project_issues=DEFAULT_PROJECT_ISSUES):
+        HTTPServer.__init__(self, address, StubRequestHandler)
+        self.latency = latency
+        self.num_users = num_users
+        self.links = links
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.description_size = description_size
+        self.project_issues = project_issues
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return "http://%s:%d" % (host, port)
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = { "requests": {}, "bytes": 0 }
+
+    def record(self, endpoint, num_bytes):
+        with self.lock:
+            self.stats["requests"][endpoint] = self.stats["requests"].get(endpoint, 0) + 1
+            self.stats["bytes"] += num_bytes
+
+    def get_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def rest_user(self, i):
+        return { "name": username(i), "displayName": username(i).title(), "emailAddress": "%s@example.com" % (username(i),) }
+
+    def dest_users(self):
+        """ Returns the users of the destination instance. """
+        users = []
+        for i in range(self.num_users):
+            user = self.rest_user(i)
+            if i % 4 == 1:
+                user["name"] = "new-" + user["name"]
+            elif i % 4 == 2:
+                continue
+            elif i % 4 == 3:
+                user["emailAddress"] = "someone-else-%d@example.org" % (i,)
+            users.append(user)
+        return users
+
+    def rest_issue(self, base, key, fields=None, changelog=False):
+        """ Returns the REST representation of an issue, the same on every call. """
+        rand = random.Random(key)
+        project_key, number = key.split("-", 1)
+        number = int(number)
+        versions = [{ "name": version_name(i) } for i in rand.sample(range(NUM_VERSIONS), 2)]
+        attachment = []
+        if rand.random() < self.attachments:
+            attachment_id = number
+            filename = "patch-%d.txt" % (number,)
+            attachment.append({ "id": str(attachment_id),
+                                "author": { "name": username(rand.randrange(self.num_users)) },
+                                "filename": filename,
+                                "created": "2015-03-01T10:00:00.000+0000",
+                                "size": self.attachment_size,
+                                "content": "%s/secure/attachment/%d/%s" % (base, attachment_id, filename) })
+        issuelinks = []
+        if rand.random() < self.links:
+            target = rand.randint(1, number + 1)
+            issuelinks.append({ "id": str(number), "type": { "name": "Blocker" },
+                                "outwardIssue": { "id": str(10000 + target), "key": "%s-%d" % (project_key, target) } })
+        # Every tenth issue is a sub-task of the issue before it.
+        parent = { "key": "%s-%d" % (project_key, number - 1) } if number % 10 == 0 else None
+        subtasks = [{ "key": "%s-%d" % (project_key, number + 1) }] if number % 10 == 9 else []
+        comments = [{ "author": self.rest_user(rand.randrange(self.num_users)),
+                      "created": "2015-03-%02dT10:00:00.000+0000" % (1 + i,),
+                      "body": "Comment %d on %s" % (i, key) } for i in range(rand.randint(0, 3))]
+        all_fields = { "summary": "Issue %s" % (key,),
+                       "status": { "name": "Resolved" },
+                       "priority": { "name": "Major" },
+                       "issuetype": { "name": "Bug" },
+                       "reporter": self.rest_user(rand.randrange(self.num_users)),
+                       "assignee": self.rest_user(rand.randrange(self.num_users)),
+                       "created": "2015-01-01T10:00:00.000+0000",
+                       "labels": [],
+                       "comment": { "startAt": 0, "maxResults": len(comments), "total": len(comments),
+                                    "comments": comments },
+                       "watches": { "watchCount": number % 3 },
+                       "description": "x" * self.description_size,
+                       "resolution": { "name": rand.choice(RESOLUTION_NAMES) } if rand.random() < 0.7 else None,
+                       "components": [{ "name": "component%d" % (rand.randrange(5),) }],
+                       "versions": versions[:1],
+                       "fixVersions": versions[1:],
+                       "attachment": attachment,
+                       "issuelinks": issuelinks,
+                       "subtasks": subtasks,
+                       "updated": "2015-04-01T10:00:00.000+0000",
+                       "customfield_10060": versions,
+                       "customfield_10066": "https://review.example.com/%d" % (number,) if number % 2 else None,
+                       "customfield_10177": None,
+                       "customfield_10058": None }
+        if parent is not None:
+            all_fields["parent"] = parent
+        if fields is not None:
+            all_fields = dict((name, value) for name, value in all_fields.iteritems() if name in fields)
+        rest_issue = { "id": str(10000 + number), "key": key, "self": "%s/rest/api/2/issue/%s" % (base, key),
+                       "fields": all_fields }
+        if changelog:
+            histories = [{ "author": self.rest_user(rand.randrange(self.num_users)),
+                           "created": "2015-02-%02dT10:00:00.000+0000" % (1 + i,),
+                           "items": [{ "field": "resolution", "fieldtype": "jira", "from": None, "fromString": None,
+                                       "to": "1", "toString": "Fixed" }] } for i in range(rand.randint(0, 3))]
+            rest_issue["changelog"] = { "startAt": 0, "maxResults": len(histories), "total": len(histories),
+                                        "histories": histories }
+        return rest_issue
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write, flushed after the request is handled,
+    # with Nagle's algorithm off. Otherwise the status line, headers and body
+    # go out as separate small writes, and on a keep-alive connection Nagle's
+    # algorithm and delayed ACKs hold up every response by about 40ms.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, endpoint, body, content_type="application/json", status=200):
+        self.server.record(endpoint, len(body))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, endpoint, value):
+        self.send_body(endpoint, json.dumps(value))
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        path = url.path
+        if path == "/_stats":
+            return self.send_json("_stats", self.server.get_stats())
+        if path == "/_stats/reset":
+            self.server.reset_stats()
+            return self.send_json("_stats", {})
+
+        time.sleep(self.server.latency)
+        match = re.match(r"^/(src|dest)(/.*)$", path)
+        if match is None:
+            return self.send_body("other", "Not found", "text/plain", 404)
+        instance, path = match.groups()
+        base = "http://%s/%s" % (self.headers.get("Host", "localhost"), instance)
+        fields = None
+        if "fields" in params:
+            fields = frozenset(params["fields"][0].split(","))
+
+        if path == "/rest/api/2/field":
+            return self.send_json("field", FIELDS)
+        if path == "/rest/api/2/user":
+            name = params.get("username", [""])[0]
+            users = self.server.dest_users() if instance == "dest" else \
+                [self.server.rest_user(i) for i in range(self.server.num_users)]
+            for user in users:
+                if user["name"] == name:
+                    return self.send_json("user", user)
+            return self.send_body("user", "User not found", "text/plain", 404)
+        if path == "/rest/api/2/user/search":
+            query = params.get("username", [""])[0].lower()
+            users = self.server.dest_users() if instance == "dest" else \
+                [self.server.rest_user(i) for i in range(self.server.num_users)]
+            return self.send_json("user/search", [user for user in users
+                                                  if user["name"].lower().startswith(query) or
+                                                  user["emailAddress"].lower().startswith(query)])
+        if path == "/rest/api/2/resolution":
+            return self.send_json("resolution", [{ "id": src_id if instance == "src" else dest_id, "name": name }
+                                                 for src_id, dest_id, name in RESOLUTIONS])
+        match = re.match(r"^/rest/api/2/project/([^/]+)/versions$", path)
+        if match is not None:
+            first_id = SRC_VERSION_ID if instance == "src" else DEST_VERSION_ID
+            return self.send_json("versions", [{ "id": str(first_id + i), "name": version_name(i),
+                                                 "released": True } for i in range(NUM_VERSIONS)])
+        changelog = "changelog" in params.get("expand", [""])[0].split(",")
+        match = re.match(r"^/rest/api/2/issue/(%s)$" % (ISSUE_KEY_RE.pattern,), path)
+        if match is not None:
+            return self.send_json("issue", self.server.rest_issue(base, match.group(1), fields, changelog))
+        match = re.match(r"^/rest/api/2/issue/(%s)/watchers$" % (ISSUE_KEY_RE.pattern,), path)
+        if match is not None:
+            rand = random.Random(match.group(1))
+            watchers = [self.server.rest_user(rand.randrange(self.server.num_users))
+                        for _ in range(int(match.group(1).split("-")[1]) % 3)]
+            return self.send_json("watchers", { "watchCount": len(watchers), "watchers": watchers })
+        match = re.match(r"^/rest/api/2/project/([^/]+)$", path)
+        if match is not None:
+            return self.send_json("project", { "key": match.group(1), "name": "Project %s" % (match.group(1),),
+                                               "lead": self.server.rest_user(0),
+                                               "versions": [{ "name": version_name(i), "released": True }
+                                                            for i in range(NUM_VERSIONS)],
+                                               "components": [{ "name": name } for name in COMPONENT_NAMES] })
+        if path == "/rest/api/2/search":
+            jql = params.get("jql", [""])[0]
+            match = re.match(r"^project = ([A-Z][A-Z0-9]*)", jql)
+            if match is not None:
+                keys = ["%s-%d" % (match.group(1), i + 1) for i in range(self.server.project_issues)]
+                # Ranges of issue ids, as export_project.py searches for.
+                for op, bound in re.findall(r"\bid (>=|>|<) ([0-9]+)", jql):
+                    keep = { ">=": lambda i: i >= int(bound),
+                             ">": lambda i: i > int(bound),
+                             "<": lambda i: i < int(bound) }[op]
+                    keys = [key for key in keys if keep(10000 + int(key.split("-")[1]))]
+                if jql.endswith("ORDER BY id DESC"):
+                    keys.reverse()
+            else:
+                keys = ISSUE_KEY_RE.findall(jql)
+            start_at = int(params.get("startAt", ["0"])[0])
+            max_results = min(int(params.get("maxResults", ["50"])[0]),
+                              MAX_CHANGELOG_SEARCH_RESULTS if changelog else MAX_SEARCH_RESULTS)
+            issues = [self.server.rest_issue(base, key, fields, changelog)
+                      for key in keys[start_at:start_at + max_results]]
+            return self.send_json("search", { "startAt": start_at, "maxResults": max_results,
+                                              "total": len(keys), "issues": issues })
+        match = re.match(r"^/secure/attachment/([0-9]+)/", path)
+        if match is not None:
+            size = self.server.attachment_size
+            chunk = "attachment %s\n" % (match.group(1),)
+            return self.send_body("attachment", (chunk * (size / len(chunk) + 1))[:size], "application/octet-stream")
+        return self.send_body("other", "Not found", "text/plain", 404)
+
+def start_server(port=0, **kwargs):
+    """
+    Start a StubServer on a background thread, on the given port of localhost
+    (or any free port if it is 0), and return it. The keyword arguments are
+    passed on to StubServer. Call shutdown() on the result to stop it.
+    """
+    server = StubServer(("127.0.0.1", port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def usage():
+    sys.stderr.write("Usage: %s [options]\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --port=N             Port to listen on (default: %d).\n" % (DEFAULT_PORT,))
+    sys.stderr.write("  --latency=S          Delay of each request in seconds (default: 0).\n")
+    sys.stderr.write("  --users=N            Number of users, as in generate_export.py (default: %d).\n" % (DEFAULT_USERS,))
+    sys.stderr.write("  --links=F            Fraction of issues with links (default: 0.1).\n")
+    sys.stderr.write("  --attachments=F      Fraction of issues with an attachment (default: 0.2).\n")
+    sys.stderr.write("  --attachment-size=N  Size of each attachment in bytes (default: 10000).\n")
+    sys.stderr.write("  --project-issues=N   Number of issues of each project (default: %d).\n" % (DEFAULT_PROJECT_ISSUES,))
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["port=", "latency=", "users=", "links=", "attachments=",
+                                                      "attachment-size=", "project-issues="])
+    except getopt.GetoptError as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if args:
+        usage()
+
+    port = DEFAULT_PORT
+    kwargs = {}
+    for opt, val in opts:
+        if opt == "--port":
+            port = int(val)
+        elif opt == "--latency":
+            kwargs["latency"] = float(val)
+        elif opt == "--users":
+            kwargs["num_users"] = int(val)
+        elif opt == "--links":
+            kwargs["links"] = float(val)
+        elif opt == "--attachments":
+            kwargs["attachments"] = float(val)
+        elif opt == "--attachment-size":
+            kwargs["attachment_size"] = int(val)
+        elif opt == "--project-issues":
+            kwargs["project_issues"] = int(val)
+
+    server = StubServer(("127.0.0.1", port), **kwargs)
+    sys.stderr.write("INFO: Serving the source instance at %s/src and the destination at %s/dest\n" %
+                     (server.url, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
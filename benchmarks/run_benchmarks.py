@@ -0,0 +1,206 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Runs the scripts of this repository on a synthetic export (generated by
+# generate_export.py) against a local stub of the source and destination JIRA
+# REST APIs (jira_stub_server.py), and reports for each one its throughput in
+# issues per second, the number of REST requests it made and its peak memory
+# use. Each script runs in a child process of its own, so the peak memory use
+# is that of the script alone.
+#
+# The results can also be appended to a file as JSON lines with --results, to
+# keep track of them across changes.
+#
+###############################################################################
+import getopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+from generate_export import DEFAULTS, make_export, write_user_mappings, write_users_to_exclude
+from jira_stub_server import start_server
+
+# The benchmarks, in the order they run: (name, script, arguments, output).
+# The arguments may refer to the files of the run by name, and to the source
+# and destination URLs. The output of a benchmark is written to the named file,
+# if any, where the later benchmarks can use it.
+BENCHMARKS = [
+    ("remap_users", "remap_users.py",
+     ["{mappings}", "{excludes}", "{dest}", "{export}"], "remapped.json"),
+    ("remap_users --intern", "remap_users.py",
+     ["--intern", "{mappings}", "{excludes}", "{dest}", "{export}"], None),
+    ("remap_users --intern --compact-history", "remap_users.py",
+     ["--intern", "--compact-history", "{mappings}", "{excludes}", "{dest}", "{export}"], None),
+    ("remap_users --stream", "remap_users.py",
+     ["--stream", "{mappings}", "{excludes}", "{dest}", "{export}"], None),
+    ("add_missing_jira_fields", "add_missing_jira_fields.py",
+     ["{rest_options}", "{mappings}", "{src}", "{dest}", "{remapped}"], None),
+    ("add_missing_jira_fields --stream", "add_missing_jira_fields.py",
+     ["--stream", "{rest_options}", "{mappings}", "{src}", "{dest}", "{remapped}"], None),
+    ("list_issues_with_links", "list_issues_with_links.py",
+     ["{rest_options}", "{src}", "{remapped}"], None),
+    ("migrate --stream", "migrate.py",
+     ["--stream", "{rest_options}", "{mappings}", "{excludes}", "{src}", "{dest}", "{export}"], None),
+]
+
+def expand_args(args, files):
+    """ Fill in the placeholders in the arguments of a benchmark. """
+    expanded = []
+    for arg in args:
+        if arg == "{rest_options}":
+            expanded.extend(files["rest_options"])
+        else:
+            expanded.append(arg.format(**files))
+    return expanded
+
+def run_benchmark(name, script, args, output_filename, log_filename, server, num_issues):
+    """
+    Run one of the scripts in a child process and return a dict with its
+    measurements. Its output is written to output_filename (or discarded), and
+    its error output to log_filename.
+    """
+    server.reset_stats()
+    command = [sys.executable, os.path.join(ROOT_DIR, script)] + args
+    with open(output_filename or os.devnull, "w") as out:
+        with open(log_filename, "w") as log:
+            start = time.time()
+            process = subprocess.Popen(command, stdout=out, stderr=log)
+            # Unlike Popen.wait(), wait4() also returns the resource usage of
+            # the child, including its peak resident set size (in KB on Linux).
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = status
+            elapsed = time.time() - start
+    stats = server.get_stats()
+    return { "name": name,
+             "command": " ".join([script] + args),
+             "status": os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+             "issues": num_issues,
+             "seconds": elapsed,
+             "issues_per_second": num_issues / elapsed if elapsed > 0 else None,
+             "requests": sum(stats["requests"].values()),
+             "requests_by_endpoint": stats["requests"],
+             "bytes_received": stats["bytes"],
+             "max_rss_mb": rusage.ru_maxrss / 1024.0 }
+
+def print_results(results):
+    print "%-40s %8s %10s %9s %9s %9s" % ("benchmark", "seconds", "issues/s", "requests", "MB recv", "RSS MB")
+    for result in results:
+        if result["status"] != 0:
+            print "%-40s FAILED with status %d" % (result["name"], result["status"])
+            continue
+        print "%-40s %8.2f %10.1f %9d %9.1f %9.1f" % (result["name"], result["seconds"], result["issues_per_second"],
+                                                     result["requests"], result["bytes_received"] / 1e6,
+                                                     result["max_rss_mb"])
+
+def usage():
+    sys.stderr.write("Usage: %s [options]\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --issues=N        Number of issues in the synthetic export (default: %d).\n" % (DEFAULTS["issues"],))
+    sys.stderr.write("  --users=N         Number of users (default: %d).\n" % (DEFAULTS["users"],))
+    sys.stderr.write("  --history=N       Change history entries per issue (default: %d).\n" % (DEFAULTS["history"],))
+    sys.stderr.write("  --comment-size=N  Words per comment and description (default: %d).\n" % (DEFAULTS["comment_size"],))
+    sys.stderr.write("  --mentions=F      At-mentions per 100 words (default: %g).\n" % (DEFAULTS["mentions"],))
+    sys.stderr.write("  --latency=S       Latency of each REST request in seconds (default: 0.005).\n")
+    sys.stderr.write("  --workers=N       Passed on to the scripts that make REST calls.\n")
+    sys.stderr.write("  --batch-size=N    Passed on to the scripts that make REST calls.\n")
+    sys.stderr.write("  --only=NAME       Only run the benchmarks whose name starts with NAME (may be repeated).\n")
+    sys.stderr.write("  --results=FILE    Append the results to FILE, one JSON object per benchmark.\n")
+    sys.stderr.write("  --keep            Keep the generated files and logs, and print where they are.\n")
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["issues=", "users=", "history=", "comment-size=", "mentions=",
+                                                      "latency=", "workers=", "batch-size=", "only=", "results=",
+                                                      "keep"])
+    except getopt.GetoptError as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if args:
+        usage()
+
+    export_options = dict(DEFAULTS)
+    latency = 0.005
+    rest_options = []
+    only = []
+    results_filename = None
+    keep = False
+    for opt, val in opts:
+        if opt in ("--issues", "--users", "--history", "--comment-size"):
+            export_options[opt[2:].replace("-", "_")] = int(val)
+        elif opt == "--mentions":
+            export_options["mentions"] = float(val)
+        elif opt == "--latency":
+            latency = float(val)
+        elif opt in ("--workers", "--batch-size"):
+            rest_options.append("%s=%s" % (opt, val))
+        elif opt == "--only":
+            only.append(val)
+        elif opt == "--results":
+            results_filename = val
+        elif opt == "--keep":
+            keep = True
+
+    work_dir = tempfile.mkdtemp(prefix="jira-benchmarks.")
+    server = start_server(latency=latency, num_users=export_options["users"])
+    try:
+        files = { "export": os.path.join(work_dir, "export.json"),
+                  "remapped": os.path.join(work_dir, "remapped.json"),
+                  "mappings": os.path.join(work_dir, "user_mappings.tsv"),
+                  "excludes": os.path.join(work_dir, "user_excludes.lst"),
+                  "src": server.url + "/src",
+                  "dest": server.url + "/dest",
+                  "rest_options": rest_options }
+        sys.stderr.write("INFO: Generating an export with %d issues in %s\n" % (export_options["issues"], work_dir))
+        with open(files["export"], "w") as f:
+            json.dump(make_export(export_options), f, sort_keys=True, indent=2, separators=(',', ': '))
+        write_user_mappings(files["mappings"], export_options["users"])
+        write_users_to_exclude(files["excludes"])
+
+        results = []
+        for name, script, script_args, output in BENCHMARKS:
+            # The benchmarks that produce input for others always run.
+            if only and output is None and not any(name.startswith(prefix) for prefix in only):
+                continue
+            sys.stderr.write("INFO: Running %s\n" % (name,))
+            output_filename = os.path.join(work_dir, output) if output is not None else None
+            log_filename = os.path.join(work_dir, "%s.log" % (name.replace(" ", "").replace("-", "_"),))
+            result = run_benchmark(name, script, expand_args(script_args, files), output_filename, log_filename,
+                                   server, export_options["issues"])
+            if result["status"] != 0:
+                sys.stderr.write("ERROR: %s failed, see %s\n" % (name, log_filename))
+                keep = True
+            result.update(time=time.time(), export=export_options, latency=latency)
+            results.append(result)
+
+        print_results(results)
+        if results_filename is not None:
+            with open(results_filename, "a") as f:
+                for result in results:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+    finally:
+        server.shutdown()
+        if keep:
+            sys.stderr.write("INFO: Kept the files of the run in %s\n" % (work_dir,))
+        else:
+            shutil.rmtree(work_dir)
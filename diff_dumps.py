@@ -0,0 +1,406 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Script to compare two dumps structurally, such as the outputs of two runs of
+# the same step, or a dump before and after enrichment. Instead of diffing the
+# JSON text, which is slow and noisy for large dumps, each dump is reduced to a
+# tree of content hashes over the canonical JSON (see canonical_json() in
+# jira_json.py), so the formatting, compression and key order of the files
+# don't matter:
+#
+#   dump        users (one hash per user), links, other sections, projects
+#   project     metadata (one hash per field), issues in order
+#   issue       fields (one hash per field), history, comments, attachments
+#
+# Every node's hash covers the hashes of its children, so two dumps are the
+# same if and only if their root hashes are. The dumps are streamed, so only
+# the hashes of the issues are kept in memory. With --processes, both dumps
+# are hashed at the same time, each in a process of its own, and the issues of
+# each are hashed on a pool of the remaining processes.
+#
+# The differences are printed one per line, as tab-separated status
+# ("added", "removed", "changed" or "reordered"), what changed and, for
+# changed issues and projects, the sections and fields that differ:
+#
+#   changed   KUDU-12         fields(components,resolution) history
+#   added     KUDU-1001
+#   changed   project:KUDU    versions
+#   removed   user:jdoe
+#
+# Like diff(1), the exit status is 0 if the dumps are the same (ignoring the
+# --ignore'd parts), 1 if they differ and 2 if they could not be compared, so
+# this can be used to check that re-running a step on its own output changes
+# nothing. If the reader of the output goes away early (as with "| head"),
+# the script stops quietly with status 1.
+#
+###############################################################################
+import errno
+import getopt
+import hashlib
+import multiprocessing
+import os
+import Queue
+import sys
+from collections import defaultdict, deque
+from jira_json import PROJECT, PROJECT_END, SECTION, canonical_json, open_export, read_export
+from jira_rest import chunks
+from jira_stats import RunStats
+
+# The parts of an issue that are hashed, and compared, separately from its
+# other fields.
+ISSUE_SECTIONS = ("history", "comments", "attachments")
+FIELDS = "fields"
+
+# Issues sent to a hashing process at a time.
+HASH_BATCH_SIZE = 100
+
+# Exit statuses, as with diff(1).
+EXIT_SAME = 0
+EXIT_DIFFERENT = 1
+EXIT_TROUBLE = 2
+
+class DumpError(Exception):
+    """ Raised when a dump could not be read or hashed. """
+    pass
+
+def leaf_hash(value):
+    """ Returns the (binary) hash of the canonical JSON of a value. """
+    return hashlib.sha1(canonical_json(value)).digest()
+
+def node_hash(children):
+    """ Returns the hash of a node of the tree, given (name, hash) pairs for its children. """
+    h = hashlib.sha1()
+    for name, child_hash in sorted(children):
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        h.update("%s\0%s\0" % (name, child_hash))
+    return h.digest()
+
+def field_hashes(data, exclude=()):
+    """ Returns a dict of the hashes of the fields of an object, leaving out the 'exclude'd ones. """
+    return dict((name, leaf_hash(value)) for name, value in data.iteritems() if name not in exclude)
+
+def hash_issue(issue):
+    """
+    Returns the key of an issue, its hash, and a dict with the hashes of its
+    ISSUE_SECTIONS and of its other fields (a dict of hashes keyed by field).
+    """
+    sections = dict((name, leaf_hash(issue.get(name))) for name in ISSUE_SECTIONS)
+    sections[FIELDS] = field_hashes(issue, ISSUE_SECTIONS)
+    issue_hash = node_hash([(name, sections[name]) for name in ISSUE_SECTIONS] +
+                           [(FIELDS, node_hash(sections[FIELDS].items()))])
+    return issue["key"], issue_hash, sections
+
+def hash_issues(issues):
+    """ hash_issue() for a batch of issues, for the hashing processes. """
+    return [hash_issue(issue) for issue in issues]
+
+def imap_batches(pool, func, batches, lookahead):
+    """
+    Generator yielding func(batch) for each batch, computed on the process
+    pool if there is one, in order. At most 'lookahead' batches are in flight
+    at any time, so the batches may come from a lazy generator.
+    """
+    if pool is None:
+        for batch in batches:
+            yield func(batch)
+        return
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(func, (batch,)))
+        if len(pending) >= lookahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+class DumpHashes(object):
+    """ The tree of hashes of a dump. See hash_dump(). """
+    def __init__(self):
+        # Top-level sections other than "users", "links" and "projects", by name.
+        self.sections = {}
+        # Users by name.
+        self.users = {}
+        # The number of links with each hash, and one of those links.
+        self.links = defaultdict(int)
+        self.link_values = {}
+        # Projects in order, as [key, {field: hash}, [issue keys]] lists. The
+        # key is taken from the issues if the project has none.
+        self.projects = []
+        # Issues by key, as (issue hash, section hashes) tuples.
+        self.issues = {}
+
+    def project_hash(self, project):
+        key, meta, issue_keys = project
+        h = hashlib.sha1()
+        for issue_key in issue_keys:
+            h.update(self.issues[issue_key][0])
+        return node_hash([("meta", node_hash(meta.items())), ("issues", h.digest())])
+
+    def root_hash(self):
+        """ Returns the hex digest of the hash of the whole dump. """
+        h = hashlib.sha1()
+        for project in self.projects:
+            h.update(self.project_hash(project))
+        children = self.sections.items() + [("users", node_hash(self.users.items())),
+                                             ("links", node_hash((link_hash, str(count)) for link_hash, count
+                                                                 in self.links.iteritems())),
+                                             ("projects", h.digest())]
+        return node_hash(children).encode("hex")
+
+def hash_dump(filename, pool=None, lookahead=1, stats=None):
+    """
+    Stream the dump in the given file, and return its DumpHashes. The issues
+    are hashed on the process pool, if given, with up to 'lookahead' batches
+    of issues in flight.
+    """
+    if stats is None:
+        stats = RunStats()
+    hashes = DumpHashes()
+    with open_export(filename) as f:
+        for kind, name, value in read_export(f):
+            if kind == SECTION and name == "users":
+                for user in value:
+                    hashes.users[user.get("name")] = leaf_hash(user)
+            elif kind == SECTION and name == "links":
+                for link in value:
+                    link_hash = leaf_hash(link)
+                    hashes.links[link_hash] += 1
+                    hashes.link_values[link_hash] = link
+            elif kind == SECTION and name != "projects":
+                hashes.sections[name] = leaf_hash(value)
+            elif kind == PROJECT:
+                project = [name.get("key"), field_hashes(name), []]
+                hashes.projects.append(project)
+                batches = chunks(stats.progress_issues(value), HASH_BATCH_SIZE)
+                for batch in imap_batches(pool, hash_issues, batches, lookahead):
+                    for key, issue_hash, sections in batch:
+                        if key in hashes.issues:
+                            sys.stderr.write("WARN: %s: Issue %s appears more than once\n" % (filename, key))
+                        hashes.issues[key] = (issue_hash, sections)
+                        project[2].append(key)
+                if project[0] is None and project[2]:
+                    project[0] = project[2][0].split("-", 1)[0]
+            elif kind == PROJECT_END:
+                hashes.projects[-1][1].update(field_hashes(name))
+    return hashes
+
+def _hash_dump_process(filename, processes, queue):
+    """
+    Hash a dump in a child process, and put its DumpHashes and the report of
+    its RunStats on the queue, or None and the error if that fails.
+    """
+    stats = RunStats(label=filename)
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        hashes = stats.run_phase("hash", hash_dump, filename, pool, 2 * processes, stats)
+    except Exception as e:
+        queue.put((None, "%s: %s" % (type(e).__name__, e)))
+        return
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    queue.put((hashes, stats.report()))
+
+def _get_child_result(child, queue):
+    """ Returns what _hash_dump_process() put on the queue, or None if the child died without a result. """
+    while child.is_alive():
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+    # The child may have put its result on the queue just before it exited.
+    try:
+        return queue.get(timeout=1)
+    except Queue.Empty:
+        return None
+
+def _hash_dump(filename, stats):
+    """ Hash a dump in this process, raising DumpError if that fails. """
+    try:
+        return stats.run_phase("hash", hash_dump, filename, None, 1, stats)
+    except Exception as e:
+        raise DumpError("%s: %s: %s" % (filename, type(e).__name__, e))
+
+def hash_dumps(filenames, processes=1, stats=None):
+    """
+    Returns the DumpHashes of each of the given dumps. With more than one
+    process, each dump is hashed in a process of its own, at the same time,
+    and the issues of each are hashed on its share of the processes. Raises
+    DumpError if a dump could not be read or hashed.
+    """
+    if stats is None:
+        stats = RunStats()
+    if processes <= 1:
+        return [_hash_dump(filename, stats) for filename in filenames]
+    children = []
+    for filename in filenames:
+        # Hashing processes, in addition to the one reading the dump.
+        share = (processes - len(filenames)) / len(filenames)
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_hash_dump_process, args=(filename, share, queue))
+        child.start()
+        children.append((child, queue))
+    results = []
+    errors = []
+    for filename, (child, queue) in zip(filenames, children):
+        # Get the result before joining, or a large result would block the child.
+        result = stats.run_phase("workers", _get_child_result, child, queue)
+        child.join()
+        if result is None:
+            errors.append("%s: the process hashing it exited with status %s" % (filename, child.exitcode))
+        elif result[0] is None:
+            errors.append("%s: %s" % (filename, result[1]))
+        else:
+            stats.merge(result[1])
+            results.append(result[0])
+    if errors:
+        raise DumpError("; ".join(errors))
+    return results
+
+def changed_fields(old, new, ignore=()):
+    """ Returns the sorted names of the fields that differ between two dicts of field hashes. """
+    return sorted(name for name in set(old) | set(new) if name not in ignore and old.get(name) != new.get(name))
+
+def diff_hashes(old, new, ignore=()):
+    """
+    Generator yielding the differences between two DumpHashes, as tuples of
+    status, what changed, and details. Sections, issue fields and top-level
+    sections named in 'ignore' are not compared.
+    """
+    ignore = frozenset(ignore)
+
+    for name in sorted(set(old.sections) | set(new.sections)):
+        if name not in ignore and old.sections.get(name) != new.sections.get(name):
+            status = "added" if name not in old.sections else "removed" if name not in new.sections else "changed"
+            yield (status, "section:" + name, "")
+
+    if "users" not in ignore:
+        for name in sorted(set(old.users) | set(new.users)):
+            if name not in new.users:
+                yield ("removed", "user:%s" % (name,), "")
+            elif name not in old.users:
+                yield ("added", "user:%s" % (name,), "")
+            elif old.users[name] != new.users[name]:
+                yield ("changed", "user:%s" % (name,), "")
+
+    if "links" not in ignore:
+        for link_hash in sorted(set(old.links) | set(new.links)):
+            count = new.links.get(link_hash, 0) - old.links.get(link_hash, 0)
+            if count:
+                values = new.link_values if count > 0 else old.link_values
+                yield ("added" if count > 0 else "removed", "link", "%s x%d" % (canonical_json(values[link_hash]),
+                                                                                 abs(count)))
+
+    old_projects = dict((project[0], project) for project in old.projects)
+    new_projects = dict((project[0], project) for project in new.projects)
+    for key in [project[0] for project in old.projects if project[0] not in new_projects]:
+        yield ("removed", "project:%s" % (key,), "")
+    for key, meta, issue_keys in new.projects:
+        if key not in old_projects:
+            yield ("added", "project:%s" % (key,), "")
+            continue
+        fields = changed_fields(old_projects[key][1], meta, ignore)
+        if fields:
+            yield ("changed", "project:%s" % (key,), ",".join(fields))
+        common = set(old_projects[key][2]) & set(issue_keys)
+        if [k for k in old_projects[key][2] if k in common] != [k for k in issue_keys if k in common]:
+            yield ("reordered", "project:%s" % (key,), "")
+
+    for key in sorted(set(old.issues) - set(new.issues)):
+        yield ("removed", key, "")
+    for key in sorted(set(new.issues) - set(old.issues)):
+        yield ("added", key, "")
+    for key in sorted(set(old.issues) & set(new.issues)):
+        old_hash, old_sections = old.issues[key]
+        new_hash, new_sections = new.issues[key]
+        if old_hash == new_hash:
+            continue
+        details = []
+        fields = changed_fields(old_sections[FIELDS], new_sections[FIELDS], ignore)
+        if fields:
+            details.append("%s(%s)" % (FIELDS, ",".join(fields)))
+        details.extend(name for name in ISSUE_SECTIONS
+                       if name not in ignore and old_sections[name] != new_sections[name])
+        if details:
+            yield ("changed", key, " ".join(details))
+
+def usage():
+    sys.stderr.write("Usage: %s [options] old.json new.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --processes=4 run1/out.json run2/out.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --ignore=attachments,customFieldValues remapped.json enriched.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --processes=N   Number of processes to hash the dumps with (default: 1).\n")
+    sys.stderr.write("  --ignore=NAMES  Comma-separated issue sections (history, comments, attachments),\n")
+    sys.stderr.write("                  issue or project fields, or top-level sections (users, links)\n")
+    sys.stderr.write("                  to leave out of the comparison.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings to FILE.\n")
+    sys.stderr.write("Exit status: 0 if the dumps are the same, 1 if they differ, 2 if they could not be compared.\n")
+    sys.exit(EXIT_TROUBLE)
+
+if __name__ == "__main__":
+
+    processes = 1
+    ignore = []
+    stats_filename = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["processes=", "ignore=", "stats="])
+        for opt, val in opts:
+            if opt == "--processes":
+                processes = int(val)
+            elif opt == "--ignore":
+                ignore.extend(name for name in val.split(",") if name)
+            elif opt == "--stats":
+                stats_filename = val
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) != 2:
+        usage()
+
+    old_filename, new_filename = args
+    stats = RunStats()
+    try:
+        old, new = hash_dumps([old_filename, new_filename], processes, stats)
+    except DumpError as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        sys.exit(EXIT_TROUBLE)
+
+    stats.switch_phase("diff")
+    num_differences = 0
+    counts = defaultdict(int)
+    try:
+        for status, what, details in diff_hashes(old, new, ignore):
+            num_differences += 1
+            if what != "link" and ":" not in what:
+                counts[status] += 1
+            print ("%s\t%s\t%s" % (status, what, details)).rstrip("\t").encode("utf-8")
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # Nothing reads the output anymore. Point stdout at /dev/null so the
+        # flush at exit doesn't fail again, and stop.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(EXIT_DIFFERENT)
+
+    sys.stderr.write("INFO: %s: %d issues, hash %s\n" % (old_filename, len(old.issues), old.root_hash()))
+    sys.stderr.write("INFO: %s: %d issues, hash %s\n" % (new_filename, len(new.issues), new.root_hash()))
+    sys.stderr.write("INFO: Issues: %d added, %d removed, %d changed. %d differences in total\n" %
+                     (counts["added"], counts["removed"], counts["changed"], num_differences))
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
+    sys.exit(EXIT_DIFFERENT if num_differences else EXIT_SAME)
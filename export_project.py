@@ -0,0 +1,339 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Script to export a whole project from the source instance through the REST
+# API, instead of exporting it to JSON by hand from the issue navigator, 1000
+# issues at a time. The issues are fetched from /rest/api/2/search in pages,
+# with several pages in flight at once, and written out as they arrive, in the
+# same format as the JSON export of the issue navigator, so the result can be
+# fed to remap_users.py and the other scripts just like a manual export. Only
+# a few pages have to be in memory at any time.
+#
+# The ids of the issues are listed first, and split into ranges of one page of
+# issues each. Each range is searched for separately, in pages that continue
+# from the last id of the previous page, for as long as JIRA says that there
+# are more. Unlike paging by offset, this doesn't skip any issues when issues
+# are deleted during the export, and a range holds about one page whatever
+# the gaps between the ids. If the number of issues exported doesn't match the
+# number listed, the export fails.
+#
+# The search results are always fetched from the instance, even with
+# --cache. The comments, watchers and changelogs fetched for an issue are
+# cached under its "updated" timestamp, like the issues of
+# add_missing_jira_fields.py.
+#
+# Like the manual export, the attachments and custom fields of the issues are
+# left out; add_missing_jira_fields.py adds them. The watchers of an issue are
+# not part of the search results, so they take one more request for each
+# issue that has any. Voters are not exported.
+#
+###############################################################################
+import getopt
+import sys
+from jira_json import OUTPUT_OPTIONS, OUTPUT_OPTIONS_USAGE, PROJECT, PROJECT_END, SECTION, new_export_writer, \
+    parse_output_options
+from jira_rest import REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, get_json, imap_ordered, new_rest_client, \
+    parse_rest_options
+from jira_stats import RunStats
+
+# The fields of the REST representation of an issue that are exported.
+EXPORT_FIELDS = [ "summary", "description", "status", "priority", "issuetype", "resolution", "resolutiondate",
+                  "reporter", "assignee", "created", "updated", "labels", "components", "versions",
+                  "fixVersions", "issuelinks", "comment", "watches" ]
+
+# Issues per search request. JIRA may return fewer than this per page (its
+# default limit is 100 with the changelog expanded, and may be lower), in
+# which case more pages are fetched.
+DEFAULT_PAGE_SIZE = 100
+
+# Issue ids per search request when listing the ids of the issues.
+ID_PAGE_SIZE = 1000
+
+class IncompleteExportError(Exception):
+    """ Raised when the number of issues exported differs from the number the search matched. """
+    pass
+
+class ProjectExporter(object):
+    """
+    Converts the REST representation of the issues of a project to the JSON
+    export format, fetching the parts that the search results leave out, and
+    collects the users and issue links referenced by the issues. Issues may
+    be converted on several threads at once. The REST calls go through
+    'client' (see jira_rest.py).
+    """
+    def __init__(self, client, jira_url, stats=None):
+        self.client = client
+        self.jira_url = jira_url
+        self.stats = stats
+        # Username -> user entry of the "users" section.
+        self.users = {}
+        self.links = []
+
+    def get_json(self, path, params=None, version=None):
+        return self.client.get_json(self.jira_url + path, params, version)
+
+    def user(self, rest_user):
+        """ Returns the username of a REST user, recording the user, or None. """
+        if not rest_user:
+            return None
+        name = rest_user["name"]
+        if name not in self.users:
+            # setdefault() is atomic, unlike testing and setting.
+            self.users.setdefault(name, { "name": name,
+                                          "fullname": rest_user.get("displayName", name),
+                                          "email": rest_user.get("emailAddress", "") })
+        return name
+
+    def project_meta(self, project_key):
+        """ Returns the project's entry of the "projects" section, without its issues. """
+        project = self.get_json("/rest/api/2/project/%s" % (project_key,))
+        return { "key": project["key"],
+                 "name": project["name"],
+                 "description": project.get("description", ""),
+                 "lead": self.user(project.get("lead")),
+                 "versions": [dict((field, v[field]) for field in ("name", "description", "released", "releaseDate")
+                                   if field in v)
+                              for v in project.get("versions", [])],
+                 "components": [dict((field, c[field]) for field in ("name", "description") if field in c)
+                                for c in project.get("components", [])] }
+
+    def search(self, jql, max_results, fields=EXPORT_FIELDS, expand="changelog"):
+        """
+        Returns the first page of the search results, by default with the
+        changelog of each issue. Search results are never cached, since they
+        can't be keyed on the "updated" timestamps of the issues in them.
+        """
+        params = { "jql": jql, "startAt": 0, "maxResults": max_results, "fields": ",".join(fields) }
+        if expand:
+            params["expand"] = expand
+        return get_json(self.client.session, self.jira_url + "/rest/api/2/search", params, self.client.stats)
+
+    def fetch_missing(self, rest_issue):
+        """
+        Fetch the parts of an issue that are not in the search results: its
+        watchers, and the comments and history entries past the ones that
+        fit in the search results.
+        """
+        key = rest_issue["key"]
+        fields = rest_issue["fields"]
+        # Cached until the issue changes.
+        updated = fields.get("updated")
+        watchers = []
+        if fields.get("watches", {}).get("watchCount"):
+            watchers = self.get_json("/rest/api/2/issue/%s/watchers" % (key,), None, updated)["watchers"]
+        comment = fields.get("comment") or { "comments": [], "total": 0 }
+        while len(comment["comments"]) < comment["total"]:
+            page = self.get_json("/rest/api/2/issue/%s/comment" % (key,), { "startAt": len(comment["comments"]) },
+                                 updated)
+            if not page["comments"]:
+                break
+            comment["comments"].extend(page["comments"])
+        changelog = rest_issue.get("changelog") or { "histories": [], "total": 0 }
+        if len(changelog["histories"]) < changelog["total"]:
+            changelog = self.get_json("/rest/api/2/issue/%s" % (key,), { "expand": "changelog", "fields": "updated" },
+                                      updated)["changelog"]
+        return watchers, comment["comments"], changelog["histories"]
+
+    def export_issue(self, rest_issue):
+        """ Returns an issue in the JSON export format. """
+        watchers, comments, histories = self.fetch_missing(rest_issue)
+        fields = rest_issue["fields"]
+        name = lambda value: value["name"] if value else None
+        issue = { "key": rest_issue["key"],
+                  "externalId": rest_issue["id"],
+                  "summary": fields.get("summary"),
+                  "description": fields.get("description"),
+                  "status": name(fields.get("status")),
+                  "priority": name(fields.get("priority")),
+                  "issueType": name(fields.get("issuetype")),
+                  "reporter": self.user(fields.get("reporter")),
+                  "assignee": self.user(fields.get("assignee")),
+                  "created": fields.get("created"),
+                  "updated": fields.get("updated"),
+                  "labels": fields.get("labels", []),
+                  "components": [c["name"] for c in fields.get("components", [])],
+                  "affectedVersions": [v["name"] for v in fields.get("versions", [])],
+                  "fixedVersions": [v["name"] for v in fields.get("fixVersions", [])],
+                  "watchers": [self.user(w) for w in watchers],
+                  "voters": [],
+                  "comments": [{ "author": self.user(c.get("author")),
+                                 "created": c["created"],
+                                 "body": c["body"] } for c in comments],
+                  "history": [{ "author": self.user(h.get("author")),
+                                "created": h["created"],
+                                "items": [{ "fieldType": item.get("fieldtype"),
+                                            "field": item["field"],
+                                            "oldValue": item.get("from"),
+                                            "oldDisplayValue": item.get("fromString"),
+                                            "newValue": item.get("to"),
+                                            "newDisplayValue": item.get("toString") }
+                                          for item in h["items"]] } for h in histories],
+                  "attachments": [],
+                  "customFieldValues": [] }
+        if fields.get("resolution"):
+            issue["resolution"] = fields["resolution"]["name"]
+            issue["resolutionDate"] = fields.get("resolutiondate")
+        return issue
+
+    def export_page(self, rest_issues):
+        """ Returns the REST issues of a page of the search results, each with its exported issue. """
+        return [(rest_issue, self.export_issue(rest_issue)) for rest_issue in rest_issues]
+
+    def record_links(self, rest_issue):
+        """ Add the issue's outward links to the "links" section, so each link is only recorded once. """
+        for link in rest_issue["fields"].get("issuelinks") or []:
+            if "outwardIssue" in link:
+                self.links.append({ "name": link["type"]["name"],
+                                    "sourceId": rest_issue["id"],
+                                    "destinationId": link["outwardIssue"]["id"] })
+
+    def list_ids(self, jql):
+        """
+        Returns the ids of the issues of a search, in ascending order, listed
+        in pages that continue from the last id of the previous page.
+        """
+        ids = []
+        while True:
+            clause = " AND id > %d" % (ids[-1],) if ids else ""
+            result = self.search("%s%s ORDER BY id ASC" % (jql, clause), ID_PAGE_SIZE, ["id"], None)
+            ids.extend(int(rest_issue["id"]) for rest_issue in result["issues"])
+            if not result["issues"] or len(result["issues"]) >= result["total"]:
+                return ids
+
+    def id_ranges(self, ids, page_size):
+        """
+        Returns [start, end) ranges of issue ids that split the given ids
+        (in ascending order) into ranges of 'page_size' issues.
+        """
+        starts = ids[::page_size]
+        return zip(starts, starts[1:] + [ids[-1] + 1]) if ids else []
+
+    def export_range(self, jql, id_range, page_size):
+        """
+        Generator yielding the pages of the issues of a search with ids in
+        the given range, as lists of REST issues, each with its exported
+        issue, ordered by id. Each page continues from the last id of the
+        previous one, until the response says that there are no more, so
+        pages that JIRA cuts short are not mistaken for the last one.
+        """
+        start, end = id_range
+        while True:
+            result = self.search("%s AND id >= %d AND id < %d ORDER BY id ASC" % (jql, start, end), page_size)
+            rest_issues = result["issues"]
+            yield self.export_page(rest_issues)
+            if not rest_issues or len(rest_issues) >= result["total"]:
+                return
+            start = int(rest_issues[-1]["id"]) + 1
+
+    def export_issues(self, jql, workers=1, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Generator yielding the exported issues of a search, ordered by id.
+        The ids are listed first and split into ranges of one page each (see
+        id_ranges()), whose pages are fetched and converted on up to
+        'workers' threads at once. Raises IncompleteExportError if the
+        number of issues exported differs from the number listed, which
+        happens when issues are deleted or changed to no longer match the
+        search during the export.
+        """
+        ids = self.list_ids(jql)
+        if self.stats is not None:
+            self.stats.expect_issues(len(ids))
+        id_ranges = self.id_ranges(ids, page_size)
+        sys.stderr.write("INFO: Exporting %d issues in %d ranges of ids\n" % (len(ids), len(id_ranges)))
+
+        exported = 0
+        # A range holds about one page of issues, so only a few pages are in
+        # memory at a time.
+        fetch_range = lambda id_range: list(self.export_range(jql, id_range, page_size))
+        for range_pages in imap_ordered(fetch_range, id_ranges, workers):
+            for page in range_pages:
+                for rest_issue, issue in page:
+                    self.record_links(rest_issue)
+                    exported += 1
+                    yield issue
+        if exported != len(ids):
+            raise IncompleteExportError("Exported %d issues, but the search matched %d; the project changed during "
+                                        "the export, run it again" % (exported, len(ids)))
+
+    def export_events(self, project_key, jql, workers=1, page_size=DEFAULT_PAGE_SIZE):
+        """ Generator yielding the events of a dump of the issues of a project that match the search. """
+        yield (PROJECT, self.project_meta(project_key), self.export_issues(jql, workers, page_size))
+        yield (PROJECT_END, {}, None)
+        # The issues must be consumed before these are complete.
+        yield (SECTION, "links", self.links)
+        yield (SECTION, "users", sorted(self.users.itervalues(), key=lambda user: user["name"]))
+
+def project_jql(project_key, extra_jql=None):
+    """ Returns the JQL search for the issues of a project, without an ORDER BY clause. """
+    jql = "project = %s" % (project_key,)
+    if extra_jql:
+        jql += " AND (%s)" % (extra_jql,)
+    return jql
+
+def usage():
+    sys.stderr.write("Usage: %s [options] jira_url project_key > jira.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --workers=8 --jql='level is EMPTY' https://issues.cloudera.org KUDU > kudu.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --jql=CLAUSE    Only export the issues that also match the JQL clause.\n")
+    sys.stderr.write("  --page-size=N   Issues per search request (default: %d).\n" % (DEFAULT_PAGE_SIZE,))
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and REST request statistics to FILE.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.stderr.write(OUTPUT_OPTIONS_USAGE)
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    extra_jql = None
+    page_size = DEFAULT_PAGE_SIZE
+    stats_filename = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["jql=", "page-size=", "stats="] + REST_OPTIONS + OUTPUT_OPTIONS)
+        rest_options = parse_rest_options(opts)
+        output_options = parse_output_options(opts)
+        for opt, val in opts:
+            if opt == "--jql":
+                extra_jql = val
+            elif opt == "--page-size":
+                page_size = int(val)
+            elif opt == "--stats":
+                stats_filename = val
+        if rest_options["offline"]:
+            raise ValueError("--offline can't be used, since the issues are always searched for on the instance")
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) != 2:
+        usage()
+
+    jira_url = args[0].rstrip("/")
+    project_key = args[1]
+
+    stats = RunStats()
+    exporter = ProjectExporter(new_rest_client(rest_options, stats), jira_url, stats)
+    events = exporter.export_events(project_key, project_jql(project_key, extra_jql), rest_options["workers"],
+                                    page_size)
+    writer = new_export_writer(sys.stdout, output_options)
+    try:
+        writer.write_events(stats.progress_events(stats.timed_events(events, "fetch")))
+    except (CacheMissError, IncompleteExportError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        sys.exit(1)
+    writer.close()
+
+    sys.stderr.write("INFO: Exported %d issues of %s, with %d users and %d links\n" %
+                     (stats.issues, project_key, len(exporter.users), len(exporter.links)))
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
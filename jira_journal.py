@@ -0,0 +1,226 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Checkpointing and incremental re-runs of long enrichment runs. As each issue
+# is transformed, the result is appended to a journal file, keyed by issue key,
+# along with a hash of the issue as it was before the transformation (and of
+# the configuration it was transformed with). When the same journal is used
+# again, issues whose hash is unchanged are taken from the journal instead of
+# being fetched and transformed again. This serves two purposes:
+#
+# * Resuming a run that died part-way through (a network failure, or an
+#   unmapped user) from where it left off.
+# * Delta runs: between a test import and the final cutover, keeping the
+#   journal of the previous run means that only the issues that are new or
+#   changed since then are enriched again.
+#
+# The journal has one JSON object per line, with the fields "key", "hash",
+# "updated" (the issue's last update timestamp, for reference) and "issue". To
+# keep the overhead low, it is only fsync'ed every so often; a partially
+# written last line, as left by a crash, is discarded when it is reopened.
+# After a complete run, compact() drops the entries that were superseded or
+# that are no longer part of the export.
+#
+###############################################################################
+import json
+import os
+import time
+from collections import deque
+from jira_json import PROJECT, json_default
+
+# By default, sync the journal to disk after this many issues or this many
+# seconds, whichever comes first.
+DEFAULT_SYNC_EVERY = 100
+DEFAULT_SYNC_INTERVAL = 5.0
+
+class IssueJournal(object):
+    """
+    Append-only journal of transformed issues, keyed by issue key. Only the
+    file offsets and hashes of the journaled issues are kept in memory.
+    """
+    def __init__(self, filename, sync_every=DEFAULT_SYNC_EVERY, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        # Issue key -> (file offset, hash) of its latest entry.
+        self.index = {}
+        # The keys of the issues seen in this run, and how they were handled.
+        self.seen = set()
+        self.reused = 0
+        self.transformed = 0
+        self.f = open(filename, "a+b")
+        self._load()
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def _load(self):
+        """ Index the existing entries, and drop a torn write at the end. """
+        self.f.seek(0)
+        offset = 0
+        while True:
+            line = self.f.readline()
+            if not line.endswith("\n"):
+                break
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            self.index[entry["key"]] = (offset, entry.get("hash"))
+            offset += len(line)
+        self.f.truncate(offset)
+        self.f.seek(offset)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key, source_hash=None):
+        """
+        Returns the journaled issue with the given key, or None if there is
+        none, or if source_hash is given and the issue was journaled with a
+        different hash.
+        """
+        if key not in self.index:
+            return None
+        offset, journaled_hash = self.index[key]
+        if source_hash is not None and journaled_hash != source_hash:
+            return None
+        self.f.flush()
+        end = self.f.tell()
+        self.f.seek(offset)
+        line = self.f.readline()
+        self.f.seek(end)
+        return json.loads(line)["issue"]
+
+    def record(self, key, issue, source_hash=None, updated=None):
+        """ Append a transformed issue to the journal. """
+        self.f.seek(0, os.SEEK_END)
+        offset = self.f.tell()
+        entry = { "key": key, "hash": source_hash, "updated": updated, "issue": issue }
+        self.f.write(json.dumps(entry, separators=(',', ':'), default=json_default))
+        self.f.write("\n")
+        # Always hand the data to the OS, so that it survives the death of this
+        # process. Forcing it to disk is what's expensive, so that is batched.
+        self.f.flush()
+        self.index[key] = (offset, source_hash)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Force the journal to disk. """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the latest entry of each of the issues
+        seen in this run. Call this only after a complete run.
+        """
+        tmp_filename = self.filename + ".tmp"
+        index = {}
+        self.f.flush()
+        with open(tmp_filename, "wb") as out:
+            for key in sorted(self.seen):
+                if key not in self.index:
+                    continue
+                offset, source_hash = self.index[key]
+                self.f.seek(offset)
+                line = self.f.readline()
+                index[key] = (out.tell(), source_hash)
+                out.write(line)
+            out.flush()
+            os.fsync(out.fileno())
+        self.f.close()
+        os.rename(tmp_filename, self.filename)
+        self.f = open(self.filename, "a+b")
+        self.f.seek(0, os.SEEK_END)
+        self.index = index
+
+    def summary(self):
+        """ Returns a one-line description of what happened in this run. """
+        return "Reused %d unchanged issues from journal %s, transformed %d new or changed issues" % \
+            (self.reused, self.filename, self.transformed)
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+def journal_issues(issues, journal, transform_issues, issue_hash=None):
+    """
+    Generator yielding the transformed version of each of the given issues,
+    in order. Issues found in the journal with the same hash are taken from
+    there. The rest are passed through transform_issues, a function that maps
+    an iterator of issues to an iterator of transformed issues, one for one and
+    in order, and the results are added to the journal. 'issue_hash' is a
+    function returning the hash of an untransformed issue; if it is None, any
+    journaled issue with the same key is reused.
+    """
+    # The slots of the output, in order: (issue, key, hash, updated) where the
+    # issue is the journaled one, or None if it is still waiting to come out
+    # of transform_issues.
+    slots = deque()
+
+    def untransformed():
+        for issue in issues:
+            key = issue["key"]
+            source_hash = issue_hash(issue) if issue_hash is not None else None
+            journal.seen.add(key)
+            journaled = journal.get(key, source_hash)
+            slots.append((journaled, key, source_hash, issue.get("updated")))
+            if journaled is None:
+                yield issue
+
+    transformed = transform_issues(untransformed())
+    done = deque()
+    while True:
+        while slots and (slots[0][0] is not None or done):
+            issue, key, source_hash, updated = slots.popleft()
+            if issue is None:
+                issue = done.popleft()
+                journal.record(key, issue, source_hash, updated)
+                journal.transformed += 1
+            else:
+                journal.reused += 1
+            yield issue
+        try:
+            done.append(next(transformed))
+        except StopIteration:
+            break
+    for issue, key, source_hash, updated in slots:
+        journal.reused += 1
+        yield issue
+
+def journal_events(events, journal, transform_events, issue_hash=None):
+    """
+    Generator applying transform_events, a chain of stages that transform
+    the issues in a stream of dump events one for one, to the issues in the
+    given events that are not in the journal yet (or that changed since). See
+    journal_issues() for 'issue_hash'.
+    """
+    def transform_project_issues(meta):
+        def transform_issues(issues):
+            for kind, name, value in transform_events(iter([(PROJECT, meta, issues)])):
+                if kind == PROJECT:
+                    return value
+        return transform_issues
+
+    for kind, name, value in events:
+        if kind == PROJECT:
+            value = journal_issues(value, journal, transform_project_issues(name), issue_hash)
+        yield (kind, name, value)
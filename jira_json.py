@@ -0,0 +1,621 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Reading and writing JIRA JSON export files one issue at a time.
+#
+# A JIRA JSON dump is a single object with top-level "users", "projects" and
+# "links" sections, where nearly all of the bulk is in the "issues" arrays of
+# the projects. The scripts in this repository process a dump as a sequence of
+# events, which can either come from a dump that was loaded into memory with
+# json.load() (iter_export_data), or be parsed incrementally from a file
+# (read_export) so that only one issue at a time has to be in memory:
+#
+#   (SECTION, name, value)     A top-level section other than a non-empty
+#                              "projects", such as "users" or "links".
+#   (PROJECT, meta, issues)    The start of a project. 'meta' holds the
+#                              project's fields that precede its "issues", and
+#                              'issues' is an iterator over its issues, which
+#                              must be consumed before the next event.
+#   (PROJECT_END, meta, None)  The end of a project. 'meta' holds the
+#                              project's fields that follow its "issues".
+#
+# ExportWriter turns such a sequence of events back into a JSON dump. By
+# default, for events produced by iter_export_data, its output is byte-for-byte
+# identical to json.dumps(data, sort_keys=True, indent=2, separators=(',', ': ')),
+# except that every project gets an "issues" array, even if it had none. It can
+# also write compact JSON, which is much faster to produce and about half the
+# size, and compress its output with gzip or zstd (if the zstandard module is
+# installed). open_export() transparently decompresses such files again. With
+# --shards, the output is split into several smaller dumps instead (see
+# jira_shards.py).
+#
+# A dump loaded with json.load() holds a separate copy of every string, so the
+# same usernames, statuses, version names and keys ("oldValue",
+# "newDisplayValue"...) take up memory again in every issue. load_export() can
+# instead intern the keys and short values while loading (--intern), so that
+# repeated strings are shared, and keep the items of the change history, the
+# most numerous objects in a dump, as HistoryItem records instead of dicts
+# (--compact-history). Both are transparent to the scripts, and to the output.
+#
+# Encoding the output is where most of the time goes. If simplejson is
+# installed, it is used instead of the standard library's json module: unlike
+# the latter, its C accelerated encoder also handles indented output, which
+# makes the default output several times faster to produce. The output is the
+# same either way: simplejson is told to write NaN and infinite floats as
+# NaN/Infinity, as the json module does, instead of refusing them.
+#
+###############################################################################
+import gzip
+import hashlib
+import json
+
+try:
+    import simplejson as encoder
+except ImportError:
+    encoder = json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SECTION = "section"
+PROJECT = "project"
+PROJECT_END = "project_end"
+
+# Formatting of the output, matching the historical output of the scripts.
+INDENT = 2
+SEPARATORS = (',', ': ')
+COMPACT_SEPARATORS = (',', ':')
+
+# Output formats and compression methods supported by ExportWriter.
+PRETTY = "pretty"
+COMPACT = "compact"
+OUTPUT_FORMATS = (PRETTY, COMPACT)
+GZIP = "gzip"
+ZSTD = "zstd"
+COMPRESSION_SUFFIXES = { GZIP: ".gz", ZSTD: ".zst" }
+
+# Ways of balancing sharded output (see jira_shards.py).
+BY_BYTES = "bytes"
+BY_ISSUES = "issues"
+SHARD_BY = (BY_BYTES, BY_ISSUES)
+
+# Magic numbers at the start of compressed files, for open_export().
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
+
+# Compression levels, chosen for speed over the last few percent of size.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Command-line options (for getopt) shared by the scripts that write dumps. See
+# parse_output_options().
+OUTPUT_OPTIONS = ["output-format=", "compress=", "shards=", "shard-by=", "shard-dir="]
+OUTPUT_OPTIONS_USAGE = """\
+  --output-format=F  "pretty" (the default) for sorted and indented JSON, or "compact"
+                  for unindented JSON with keys in no particular order, which is
+                  much faster to write and about half the size.
+  --compress=C    Compress the output with "gzip" or "zstd" (requires the zstandard module).
+  --shards=N      Write the output as N self-contained dumps in the --shard-dir directory,
+                  with a manifest, instead of to stdout (see jira_shards.py).
+  --shard-by=B    Balance the shards by "bytes" (the default) or by number of "issues".
+  --shard-dir=D   Directory for the shards.
+"""
+
+# Command-line options (for getopt) shared by the scripts that load dumps into
+# memory. See parse_load_options().
+LOAD_OPTIONS = ["intern", "compact-history"]
+LOAD_OPTIONS_USAGE = """\
+  --intern        Share repeated keys and short strings between the issues when loading
+                  the dump into memory, which takes less memory but a bit more time.
+  --compact-history  Also keep the items of the issue history as compact records.
+"""
+
+# Strings up to this length are interned by load_export(). Longer ones, such
+# as descriptions and comments, are rarely repeated.
+INTERN_MAX_LENGTH = 64
+
+def parse_load_options(opts):
+    """
+    Returns a dict with the values of the LOAD_OPTIONS in the (option, value)
+    pairs returned by getopt, ignoring any other options.
+    """
+    load_options = { "intern": False, "compact_history": False }
+    for opt, val in opts:
+        if opt == "--intern":
+            load_options["intern"] = True
+        elif opt == "--compact-history":
+            load_options["compact_history"] = True
+    return load_options
+
+def parse_output_options(opts):
+    """
+    Returns a dict with the values of the OUTPUT_OPTIONS in the (option, value)
+    pairs returned by getopt, ignoring any other options. Raises ValueError if
+    an option has an unsupported value.
+    """
+    output_options = { "format": PRETTY, "compress": None, "shards": None, "shard_by": BY_BYTES, "shard_dir": None }
+    for opt, val in opts:
+        if opt == "--output-format":
+            if val not in OUTPUT_FORMATS:
+                raise ValueError("Unknown output format '%s'" % (val,))
+            output_options["format"] = val
+        elif opt == "--compress":
+            if val not in COMPRESSION_SUFFIXES:
+                raise ValueError("Unknown compression method '%s'" % (val,))
+            if val == ZSTD and zstandard is None:
+                raise ValueError("--compress=zstd requires the zstandard module")
+            output_options["compress"] = val
+        elif opt == "--shards":
+            output_options["shards"] = int(val)
+            if output_options["shards"] < 1:
+                raise ValueError("--shards must be at least 1")
+        elif opt == "--shard-by":
+            if val not in SHARD_BY:
+                raise ValueError("Unknown way of sharding '%s'" % (val,))
+            output_options["shard_by"] = val
+        elif opt == "--shard-dir":
+            output_options["shard_dir"] = val
+    if output_options["shards"] is not None and output_options["shard_dir"] is None:
+        raise ValueError("--shards requires --shard-dir")
+    return output_options
+
+def output_suffix(output_options):
+    """ Returns the file name suffix for output written with the given options. """
+    return COMPRESSION_SUFFIXES.get(output_options["compress"], "")
+
+def open_export(filename):
+    """
+    Open a dump for reading, decompressing it on the fly if it was written with
+    gzip or zstd compression.
+    """
+    f = open(filename, "rb")
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        f.close()
+        return gzip.GzipFile(filename, "rb")
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            f.close()
+            raise IOError("%s is compressed with zstd, which requires the zstandard module" % (filename,))
+        return _ZstdReader(f)
+    return f
+
+class _ZstdReader(object):
+    """ File-like object decompressing a zstd compressed file. """
+    def __init__(self, f):
+        self.f = f
+        self.reader = zstandard.ZstdDecompressor().stream_reader(f)
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _ZstdWriter(object):
+    """ File-like object compressing everything written to it into 'out'. """
+    def __init__(self, out, level=ZSTD_LEVEL):
+        self.out = out
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def write(self, data):
+        self.out.write(self.compressor.compress(data))
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        """ Finish the compressed stream. This does not close 'out'. """
+        self.out.write(self.compressor.flush())
+        self.out.flush()
+
+def _compressed_output(out, compress):
+    """ Returns a file-like object that compresses its input into 'out'. """
+    if compress == GZIP:
+        # An empty file name and timestamp keep the output reproducible.
+        return gzip.GzipFile(filename="", mode="wb", compresslevel=GZIP_LEVEL, fileobj=out, mtime=0)
+    if compress == ZSTD:
+        return _ZstdWriter(out)
+    raise ValueError("Unknown compression method '%s'" % (compress,))
+
+# The keys of the items of the change history of an issue.
+HISTORY_ITEM_FIELDS = ("fieldType", "field", "oldValue", "oldDisplayValue", "newValue", "newDisplayValue")
+_HISTORY_ITEM_FIELD_SET = frozenset(HISTORY_ITEM_FIELDS)
+
+class HistoryItem(object):
+    """
+    Compact stand-in for the dict of an item of the change history of an
+    issue. It behaves like that dict as far as the scripts use it, and is
+    encoded as that dict by json_default(). A key that the item does not have
+    is missing, not None.
+    """
+    __slots__ = HISTORY_ITEM_FIELDS
+    __hash__ = None
+
+    def __init__(self, pairs=()):
+        for key, value in pairs:
+            self[key] = value
+
+    @staticmethod
+    def accepts(keys):
+        """ Returns True if an object with the given keys can be a HistoryItem. """
+        return "field" in keys and _HISTORY_ITEM_FIELD_SET.issuperset(keys)
+
+    def __contains__(self, key):
+        return key in _HISTORY_ITEM_FIELD_SET and hasattr(self, key)
+
+    def __getitem__(self, key):
+        if key in _HISTORY_ITEM_FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in _HISTORY_ITEM_FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [key for key in HISTORY_ITEM_FIELDS if hasattr(self, key)]
+
+    def iteritems(self):
+        return ((key, getattr(self, key)) for key in self.keys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, HistoryItem):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "HistoryItem(%r)" % (self.to_dict(),)
+
+def json_default(value):
+    """ The 'default' function of the JSON encoders, which encodes HistoryItems. """
+    if isinstance(value, HistoryItem):
+        return value.to_dict()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def load_export(f, intern=False, compact_history=False):
+    """
+    Load a whole dump into memory, like json.load(). With 'intern', repeated
+    keys and strings of up to INTERN_MAX_LENGTH characters are shared. With
+    'compact_history', the items of the change history are HistoryItems.
+    """
+    if not intern and not compact_history:
+        return json.load(f)
+    strings = {}
+
+    def intern_string(s):
+        if len(s) > INTERN_MAX_LENGTH:
+            return s
+        return strings.setdefault(s, s)
+
+    def make_object(pairs):
+        if intern:
+            for i, (key, value) in enumerate(pairs):
+                if isinstance(value, unicode):
+                    value = intern_string(value)
+                elif isinstance(value, list):
+                    # Such as the watchers of an issue.
+                    value[:] = [intern_string(v) if isinstance(v, unicode) else v for v in value]
+                pairs[i] = (strings.setdefault(key, key), value)
+        if compact_history and HistoryItem.accepts([key for key, value in pairs]):
+            return HistoryItem(pairs)
+        return dict(pairs)
+    return json.load(f, object_pairs_hook=make_object)
+
+def canonical_json(value):
+    """
+    Returns a canonical, compact JSON encoding of the value, for hashing. The
+    encoding is the same with simplejson, which is about three times faster
+    at it, including for NaN and infinite floats, as the json module writes
+    them (simplejson refuses them unless told otherwise).
+    """
+    return encoder.dumps(value, sort_keys=True, separators=COMPACT_SEPARATORS, default=json_default,
+                         allow_nan=True)
+
+def content_hash(value, salt=""):
+    """ Returns a hex digest of the canonical JSON encoding of the value. """
+    return hashlib.sha1(salt + canonical_json(value)).hexdigest()
+
+def iter_export_data(data):
+    """ Generator over the events of a dump that has been loaded into memory. """
+    for key in sorted(data):
+        if key == "projects" and data[key]:
+            for proj in data[key]:
+                # Split the project's fields around "issues", which is where
+                # json.dumps(sort_keys=True) would put them.
+                before = dict((k, v) for k, v in proj.iteritems() if k < "issues")
+                after = dict((k, v) for k, v in proj.iteritems() if k > "issues")
+                yield (PROJECT, before, iter(proj.get("issues", [])))
+                yield (PROJECT_END, after, None)
+        else:
+            yield (SECTION, key, data[key])
+
+def section_events(events):
+    """
+    Generator over the SECTION events of a stream of dump events, for
+    consumers that only need the top-level sections. The issues of each
+    project are read and discarded, since they must be consumed before the
+    stream can move on to the sections that follow the projects.
+    """
+    for kind, name, value in events:
+        if kind == SECTION:
+            yield (kind, name, value)
+        elif kind == PROJECT:
+            for _ in value:
+                pass
+
+class _Scanner(object):
+    """
+    Incremental tokenizer over a file containing JSON. Values are decoded with
+    the standard library's (C-accelerated) decoder, which is handed a buffer
+    that grows until it holds the complete value.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """ Read more input, at least doubling the unconsumed part of the buffer. """
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        if not data:
+            self.eof = True
+
+    def peek(self):
+        """ Returns the next non-whitespace character, or "" at the end of the input. """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        """ Consume the next character, which must be one of 'chars'. Returns it. """
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError("Expected one of '%s' but found '%s' in JSON input" % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ Decode and return the next complete JSON value. """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer might continue in the
+                # next chunk, so only trust a value that ends before the end.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def members(self):
+        """ Generator over the keys of the object that starts next. """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        """ Generator over the positions of the elements of the array that starts next. """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+def read_export(f):
+    """
+    Generator over the events of the dump in the given file, parsed
+    incrementally so that at most one issue is held in memory at a time.
+    Sections and project fields are produced in the order they appear in the
+    file.
+    """
+    scanner = _Scanner(f)
+    for key in scanner.members():
+        if key != "projects" or scanner.peek() != "[":
+            yield (SECTION, key, scanner.value())
+            continue
+        empty = True
+        for _ in scanner.elements():
+            empty = False
+            before = {}
+            after = None
+            for proj_key in scanner.members():
+                if proj_key == "issues" and after is None:
+                    issues = _read_issues(scanner)
+                    yield (PROJECT, before, issues)
+                    # Skip whatever the consumer left unread.
+                    for _ in issues:
+                        pass
+                    after = {}
+                elif after is None:
+                    before[proj_key] = scanner.value()
+                else:
+                    after[proj_key] = scanner.value()
+            if after is None:
+                yield (PROJECT, before, iter([]))
+                after = {}
+            yield (PROJECT_END, after, None)
+        if empty:
+            yield (SECTION, key, [])
+    if scanner.peek() != "":
+        raise ValueError("Extra data after the end of the JSON input")
+
+def _read_issues(scanner):
+    for _ in scanner.elements():
+        yield scanner.value()
+
+class ExportWriter(object):
+    """
+    Writes a JSON dump to a file, one event at a time, in one of the
+    OUTPUT_FORMATS and optionally compressed.
+    """
+    def __init__(self, out, output_format=PRETTY, compress=None):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format '%s'" % (output_format,))
+        self.compressed = compress is not None
+        self.out = _compressed_output(out, compress) if self.compressed else out
+        self.pretty = output_format == PRETTY
+        self.key_separator = SEPARATORS[1] if self.pretty else COMPACT_SEPARATORS[1]
+        self.num_sections = 0
+        self.in_projects = False
+        self.num_issues = 0
+
+    def _newline(self, level):
+        """ Returns the line break and indentation before a line 'level' deep. """
+        return "\n" + " " * (INDENT * level) if self.pretty else ""
+
+    def _dumps(self, value, level):
+        """ Encode a value that is nested 'level' deep in the output. """
+        if not self.pretty:
+            return encoder.dumps(value, separators=COMPACT_SEPARATORS, default=json_default, allow_nan=True)
+        s = encoder.dumps(value, sort_keys=True, indent=INDENT, separators=SEPARATORS, default=json_default,
+                          allow_nan=True)
+        return s.replace("\n", self._newline(level))
+
+    def _write_key(self, key, level):
+        self.out.write("%s%s%s" % (self._newline(level), json.dumps(key), self.key_separator))
+
+    def _begin_section(self, name):
+        self._end_projects()
+        self.out.write("," if self.num_sections else "{")
+        self.num_sections += 1
+        self._write_key(name, 1)
+
+    def _end_projects(self):
+        if self.in_projects:
+            self.out.write(self._newline(1) + "]")
+            self.in_projects = False
+
+    def write_section(self, name, value):
+        self._begin_section(name)
+        self.out.write(self._dumps(value, 1))
+
+    def begin_project(self, meta):
+        if self.in_projects:
+            self.out.write(",")
+        else:
+            self._begin_section("projects")
+            self.out.write("[")
+            self.in_projects = True
+        self.out.write(self._newline(2) + "{")
+        for key in sorted(meta):
+            self._write_key(key, 3)
+            self.out.write(self._dumps(meta[key], 3) + ",")
+        self._write_key("issues", 3)
+        self.out.write("[")
+        self.num_issues = 0
+
+    def write_issue(self, issue):
+        if self.num_issues:
+            self.out.write(",")
+        self.out.write(self._newline(4) + self._dumps(issue, 4))
+        self.num_issues += 1
+
+    def end_project(self, meta):
+        self.out.write(self._newline(3) + "]" if self.num_issues else "]")
+        for key in sorted(meta):
+            self.out.write(",")
+            self._write_key(key, 3)
+            self.out.write(self._dumps(meta[key], 3))
+        self.out.write(self._newline(2) + "}")
+
+    def write_events(self, events):
+        """ Write out a whole sequence of events. """
+        for kind, name, value in events:
+            if kind == SECTION:
+                self.write_section(name, value)
+            elif kind == PROJECT:
+                self.begin_project(name)
+                for issue in value:
+                    self.write_issue(issue)
+            elif kind == PROJECT_END:
+                self.end_project(name)
+
+    def close(self):
+        """ Finish the dump. This does not close the underlying file. """
+        self._end_projects()
+        self.out.write(self._newline(0) + "}\n" if self.num_sections else "{}\n")
+        if self.compressed:
+            self.out.close()
+        else:
+            self.out.flush()
+
+def new_export_writer(out, output_options):
+    """
+    Returns an ExportWriter configured by the result of parse_output_options(),
+    or a ShardWriter, which ignores 'out', if the output is to be sharded.
+    """
+    if output_options.get("shards"):
+        # jira_shards builds on this module.
+        from jira_shards import ShardWriter
+        return ShardWriter(output_options["shard_dir"], output_options["shards"], output_options,
+                           output_options["shard_by"])
+    return ExportWriter(out, output_options["format"], output_options["compress"])
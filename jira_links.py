@@ -0,0 +1,191 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# On-disk index of the graph of issue links and parent/sub-task relations of
+# the issues in one or more dumps. The JSON importer recreates neither of
+# them reliably (see "Known issues" in the README), so they have to be
+# recreated on the destination after the import, which needs the whole graph:
+# which issues link to which, which links cross projects, and which point at
+# issues that are not part of the migration at all.
+#
+# The index is a SQLite database with two tables: the indexed issues, with
+# the "updated" timestamp they were indexed at, so that unchanged issues are
+# not fetched again, and the edges between issues. An issue link is stored
+# once, as an edge from its outward to its inward issue, even though it shows
+# up in the REST representation of both of them. A sub-task is stored as an
+# edge from the parent to the sub-task.
+#
+###############################################################################
+import heapq
+import sqlite3
+from collections import defaultdict
+
+# Kinds of edges.
+LINK = "link"
+SUBTASK = "subtask"
+
+# The fields of the REST representation of an issue that hold its edges.
+LINK_FIELDS = [ "issuelinks", "parent", "subtasks" ]
+
+def project_of(issue_key):
+    return issue_key.split("-", 1)[0]
+
+def issue_sort_key(issue_key):
+    """ Sort key that orders issues by project, and then numerically by issue number. """
+    project_key, _, number = issue_key.partition("-")
+    return (project_key, int(number)) if number.isdigit() else (project_key, number)
+
+def rest_issue_edges(rest_issue):
+    """
+    Returns the edges of an issue in its REST representation, as (id, kind,
+    type, source, target) tuples.
+    """
+    key = rest_issue["key"]
+    fields = rest_issue["fields"]
+    edges = []
+    for link in fields.get("issuelinks") or []:
+        link_type = link["type"]["name"]
+        if "outwardIssue" in link:
+            source, target = key, link["outwardIssue"]["key"]
+        else:
+            source, target = link["inwardIssue"]["key"], key
+        edge_id = link.get("id") or "%s:%s:%s" % (link_type, source, target)
+        edges.append((edge_id, LINK, link_type, source, target))
+    if fields.get("parent"):
+        parent = fields["parent"]["key"]
+        edges.append(("%s:%s:%s" % (SUBTASK, parent, key), SUBTASK, "", parent, key))
+    for subtask in fields.get("subtasks") or []:
+        edges.append(("%s:%s:%s" % (SUBTASK, key, subtask["key"]), SUBTASK, "", key, subtask["key"]))
+    return edges
+
+class LinkIndex(object):
+    """
+    SQLite index of issue links and sub-tasks. Edges are returned by the
+    queries as (kind, type, source, target) tuples, where 'type' is the name
+    of the link type, and empty for sub-tasks.
+    """
+    def __init__(self, filename=":memory:"):
+        self.conn = sqlite3.connect(filename)
+        # The index can always be rebuilt from the source instance.
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS issues ("
+                          "  key TEXT PRIMARY KEY,"
+                          "  project TEXT NOT NULL,"
+                          "  updated TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS edges ("
+                          "  id TEXT PRIMARY KEY,"
+                          "  kind TEXT NOT NULL,"
+                          "  type TEXT NOT NULL,"
+                          "  source TEXT NOT NULL,"
+                          "  target TEXT NOT NULL,"
+                          "  source_project TEXT NOT NULL,"
+                          "  target_project TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS edges_source ON edges (source)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS edges_target ON edges (target)")
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0]
+
+    def indexed_versions(self):
+        """ Returns a dict of the "updated" timestamps of the indexed issues, keyed by issue key. """
+        return dict(self.conn.execute("SELECT key, updated FROM issues"))
+
+    def add_issues(self, issues):
+        """
+        Index the edges of an iterable of (key, updated, rest_issue) tuples,
+        replacing the edges of the issues that were indexed before. The
+        changes are committed once all of the issues are added.
+        """
+        for key, updated, rest_issue in issues:
+            # Every edge of the issue is in its REST representation, so any
+            # edges that are not there any more were removed on the source.
+            self.conn.execute("DELETE FROM edges WHERE source = ? OR target = ?", (key, key))
+            self.conn.executemany("INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [edge + (project_of(edge[3]), project_of(edge[4]))
+                                   for edge in rest_issue_edges(rest_issue)])
+            self.conn.execute("INSERT OR REPLACE INTO issues VALUES (?, ?, ?)", (key, project_of(key), updated))
+        self.conn.commit()
+
+    def _edges(self, where="", args=()):
+        return self.conn.execute("SELECT kind, type, source, target FROM edges %s "
+                                 "ORDER BY source, target, kind, type" % (where,), args).fetchall()
+
+    def edges(self):
+        """ Returns all of the edges. """
+        return self._edges()
+
+    def issues_with_edges(self):
+        """ Returns the keys of the indexed issues that have any edges, in order. """
+        rows = self.conn.execute("SELECT key FROM issues WHERE "
+                                 "  EXISTS (SELECT 1 FROM edges WHERE source = key) OR"
+                                 "  EXISTS (SELECT 1 FROM edges WHERE target = key)")
+        return sorted((key for key, in rows), key=issue_sort_key)
+
+    def issue_edges(self, key):
+        """ Returns the edges from and to an issue. """
+        return self._edges("WHERE source = ? OR target = ?", (key, key))
+
+    def cross_project_edges(self):
+        """ Returns the edges between issues of different projects. """
+        return self._edges("WHERE source_project != target_project")
+
+    def dangling_edges(self):
+        """ Returns the edges from or to issues that are not in the index, such as issues of other projects. """
+        return self._edges("WHERE source NOT IN (SELECT key FROM issues) OR target NOT IN (SELECT key FROM issues)")
+
+    def ordered_edges(self):
+        """
+        Generator yielding all of the edges in topological order: an edge is
+        only yielded once all of the edges into its source issue have been,
+        so parents come before their sub-tasks, and blockers before the issues
+        they block. Cycles are broken at the issue with the fewest remaining
+        incoming edges. Issues that are otherwise unordered come in key order.
+        """
+        outgoing = defaultdict(list)
+        indegree = defaultdict(int)
+        for edge in self._edges():
+            kind, link_type, source, target = edge
+            outgoing[source].append(edge)
+            indegree[target] += 1
+            indegree[source] += 0
+        remaining = set(indegree)
+        ready = [(issue_sort_key(key), key) for key in remaining if indegree[key] == 0]
+        heapq.heapify(ready)
+        while remaining:
+            if not ready:
+                key = min(remaining, key=lambda key: (indegree[key], issue_sort_key(key)))
+                ready.append((issue_sort_key(key), key))
+            _, key = heapq.heappop(ready)
+            if key not in remaining:
+                continue
+            remaining.remove(key)
+            for edge in outgoing[key]:
+                yield edge
+                target = edge[3]
+                indegree[target] -= 1
+                if indegree[target] == 0 and target in remaining:
+                    heapq.heappush(ready, (issue_sort_key(target), target))
+
+    def summary(self):
+        """ Returns a one-line summary of the index. """
+        num_issues = len(self)
+        counts = dict(self.conn.execute("SELECT kind, COUNT(*) FROM edges GROUP BY kind"))
+        cross_project = self.conn.execute("SELECT COUNT(*) FROM edges "
+                                          "WHERE source_project != target_project").fetchone()[0]
+        return "Indexed %d issues with %d links and %d sub-tasks, %d of them across projects" % \
+            (num_issues, counts.get(LINK, 0), counts.get(SUBTASK, 0), cross_project)
+
+    def close(self):
+        self.conn.close()
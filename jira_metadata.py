@@ -0,0 +1,145 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Instance metadata needed to transform a dump: the fields and resolutions of
+# the source and destination instances, and the versions of the projects
+# being migrated. All of it is fetched up
+# front, in a single round of requests to both instances (up to --workers at
+# once), instead of one project at a time as the projects are reached. The
+# requests go through the RestClient's cache, so with --cache the metadata is
+# kept on disk, and only fetched again once it is older than --cache-ttl.
+#
+# From the metadata, the resolution and version maps are derived by matching
+# names between the two instances. Entries of the hand-maintained
+# resolution_map in add_missing_jira_fields.py take precedence over the
+# derived resolution mappings, for resolutions that were renamed or merged.
+#
+###############################################################################
+import sys
+from collections import defaultdict
+from jira_rest import imap_ordered
+
+FIELD_API_PATH = "/rest/api/2/field"
+RESOLUTION_API_PATH = "/rest/api/2/resolution"
+VERSION_API_PATH = "/rest/api/2/project/%s/versions"
+
+def map_versions_by_name(src_versions, dest_versions):
+    """
+    Returns a dict mapping the ids of the source versions to the ids of the
+    destination versions with the same name.
+    """
+    version_name_map = defaultdict(list)
+    for versions in (src_versions, dest_versions):
+        for v in versions:
+            version_name_map[v['name']].append(v['id'])
+    mapping = {}
+    for name in version_name_map:
+        l = version_name_map[name]
+        if len(l) != 2:
+            sys.stderr.write("WARN: Version with name '%s' does not appear in both instances\n" % (name,))
+            continue
+        old, new = l
+        mapping[old] = new
+    return mapping
+
+def map_resolutions_by_name(src_resolutions, dest_resolutions, overrides=None):
+    """
+    Returns a dict mapping the ids of the source resolutions to the ids of the
+    destination resolutions with the same name (ignoring case), updated with
+    the 'overrides'. Source resolutions that are left unmapped are reported.
+    """
+    dest_ids = dict((r["name"].lower(), r["id"]) for r in dest_resolutions)
+    mapping = {}
+    for r in src_resolutions:
+        if r["name"].lower() in dest_ids:
+            mapping[r["id"]] = dest_ids[r["name"].lower()]
+    if overrides:
+        mapping.update(overrides)
+    for r in src_resolutions:
+        if r["id"] not in mapping:
+            sys.stderr.write("WARN: Resolution '%s' (id %s) does not appear in the destination instance; "
+                             "add it to resolution_map if it is used\n" % (r["name"], r["id"]))
+    return mapping
+
+class InstanceMetadata(object):
+    """ The metadata of one JIRA instance. """
+    def __init__(self, jira_url):
+        self.jira_url = jira_url
+        # Fields keyed by field id.
+        self.fields = {}
+        self.resolutions = []
+        # Versions keyed by project key.
+        self.versions = {}
+
+    def set(self, kind, project_key, value):
+        """ Store a REST response, as requested by metadata_requests(). """
+        if kind == "fields":
+            self.fields = dict((field["id"], field) for field in value if "id" in field)
+        elif kind == "resolutions":
+            self.resolutions = value
+        elif kind == "versions":
+            self.versions[project_key] = value
+
+    def metadata_requests(self, project_keys):
+        """ Returns the (instance, kind, project_key, path) tuples to fetch its metadata. """
+        fetches = [(self, "fields", None, FIELD_API_PATH),
+                   (self, "resolutions", None, RESOLUTION_API_PATH)]
+        for project_key in project_keys:
+            fetches.append((self, "versions", project_key, VERSION_API_PATH % (project_key,)))
+        return fetches
+
+class MigrationMetadata(object):
+    """ The metadata of the source and destination instances of a migration. """
+    def __init__(self, src, dest, resolution_overrides=None):
+        self.src = src
+        self.dest = dest
+        self.resolution_overrides = resolution_overrides or {}
+        self._resolution_map = None
+
+    @property
+    def field_map(self):
+        """ The fields of the source instance, keyed by field id. """
+        return self.src.fields
+
+    @property
+    def resolution_map(self):
+        """ Map of source to destination resolution ids. """
+        if self._resolution_map is None:
+            self._resolution_map = map_resolutions_by_name(self.src.resolutions, self.dest.resolutions,
+                                                           self.resolution_overrides)
+        return self._resolution_map
+
+    def version_maps(self):
+        """ Returns the version maps of the projects that were fetched, keyed by project key. """
+        return dict((project_key, map_versions_by_name(self.src.versions[project_key], self.dest.versions[project_key]))
+                    for project_key in self.src.versions)
+
+def fetch_metadata(client, src_jira_url, dest_jira_url, project_keys=(), resolution_overrides=None, workers=1):
+    """
+    Fetch the metadata of both instances, including the versions of the
+    given projects, with up to 'workers' concurrent requests, and return a
+    MigrationMetadata.
+    """
+    src = InstanceMetadata(src_jira_url)
+    dest = InstanceMetadata(dest_jira_url)
+    fetches = src.metadata_requests(project_keys) + dest.metadata_requests(project_keys)
+
+    def fetch(request):
+        instance, kind, project_key, path = request
+        return client.get_json(instance.jira_url + path)
+
+    for request, value in zip(fetches, imap_ordered(fetch, fetches, workers)):
+        instance, kind, project_key, path = request
+        instance.set(kind, project_key, value)
+    return MigrationMetadata(src, dest, resolution_overrides)
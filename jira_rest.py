@@ -0,0 +1,273 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Shared helpers for talking to the JIRA REST API: a pooled keep-alive HTTP
+# session that retries transient failures, an optional on-disk cache of REST
+# responses, and an ordered concurrent map used to issue many REST calls at
+# once. The latency, size and retries of each request can be recorded in a
+# jira_stats.RunStats.
+#
+###############################################################################
+import json
+import requests
+import sqlite3
+import threading
+import time
+import urllib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Seconds to wait for a connection or a response before giving up.
+REQUEST_TIMEOUT = 60
+
+# Default number of seconds that cached responses stay fresh: one day.
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# Command-line options (for getopt) shared by the scripts that fetch data from
+# the REST API. See parse_rest_options().
+REST_OPTIONS = ["workers=", "batch-size=", "cache=", "cache-ttl=", "offline"]
+REST_OPTIONS_USAGE = """\
+  --workers=N     Number of concurrent REST requests to the source instance (default: 1).
+  --batch-size=N  Fetch issues N at a time with JQL searches instead of one by one (default: 1).
+  --cache=FILE    Cache REST responses in the given SQLite database across runs.
+  --cache-ttl=N   Seconds that cached instance metadata stays fresh (default: %d).
+                  Cached issues stay valid until their "updated" timestamp changes.
+  --offline       Only use the cache; fail if a response is not cached.
+""" % (DEFAULT_CACHE_TTL,)
+
+# Transient failures that are worth retrying: rate limiting and server errors
+# typically caused by an overloaded instance or a proxy in between.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+def new_session(pool_size=1, retries=5, backoff=0.5):
+    """
+    Returns a requests Session that keeps connections alive across requests,
+    with a connection pool large enough for pool_size concurrent requests per
+    host. Connection errors and the statuses in RETRY_STATUSES are retried up
+    to 'retries' times, sleeping backoff * 2^n seconds between attempts.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=max(pool_size, 1),
+                          pool_maxsize=max(pool_size, 1),
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def parse_rest_options(opts):
+    """
+    Returns a dict with the values of the REST_OPTIONS in the (option, value)
+    pairs returned by getopt, ignoring any other options. Raises ValueError if
+    the options are inconsistent.
+    """
+    rest_options = { "workers": 1,
+                     "batch_size": 1,
+                     "cache": None,
+                     "cache_ttl": DEFAULT_CACHE_TTL,
+                     "offline": False }
+    for opt, val in opts:
+        if opt == "--workers":
+            rest_options["workers"] = int(val)
+        elif opt == "--batch-size":
+            rest_options["batch_size"] = int(val)
+        elif opt == "--cache":
+            rest_options["cache"] = val
+        elif opt == "--cache-ttl":
+            rest_options["cache_ttl"] = int(val)
+        elif opt == "--offline":
+            rest_options["offline"] = True
+    if rest_options["offline"] and rest_options["cache"] is None:
+        raise ValueError("--offline requires --cache")
+    return rest_options
+
+def new_rest_client(rest_options, stats=None):
+    """
+    Returns a RestClient configured by the result of parse_rest_options(),
+    which records its requests in 'stats', if given.
+    """
+    # All REST calls share one pool of keep-alive connections.
+    session = new_session(pool_size=rest_options["workers"])
+    cache = None
+    if rest_options["cache"] is not None:
+        cache = ResponseCache(rest_options["cache"])
+    return RestClient(session, cache, rest_options["offline"], rest_options["cache_ttl"], stats)
+
+def get_json(session, url, params=None, stats=None):
+    """
+    GET the given URL and return the decoded JSON response. The request is
+    recorded in 'stats', if given.
+    """
+    start = time.time()
+    try:
+        r = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException:
+        if stats is not None:
+            stats.record_request(url, time.time() - start, error=True)
+        raise
+    if stats is not None:
+        # The retries done by urllib3 before this response, if any.
+        retries = getattr(r.raw, "retries", None)
+        stats.record_request(url, time.time() - start, len(r.content),
+                             len(retries.history) if retries is not None else 0, not r.ok)
+    r.raise_for_status()
+    return r.json()
+
+def cache_key(url, params=None):
+    """ Returns a canonical form of the URL with the given query parameters. """
+    if not params:
+        return url
+    return url + "?" + urllib.urlencode(sorted(params.items()))
+
+class CacheMissError(Exception):
+    """ Raised in offline mode when a response is not in the cache. """
+    pass
+
+class ResponseCache(object):
+    """
+    Persistent cache of decoded JSON REST responses in a SQLite database,
+    keyed by URL. Each entry may have an expiry time and a version tag. For
+    issues, the version is the issue's "updated" timestamp, so that an entry
+    is invalidated as soon as the issue changes on the source instance.
+    Safe to use from multiple threads.
+    """
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        # Several processes may share the cache, so wait for their writes.
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        # This is a cache, so losing the last few writes in a crash is fine.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                          "  url TEXT PRIMARY KEY,"
+                          "  version TEXT,"
+                          "  expires REAL,"
+                          "  body TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, url, version=None):
+        """
+        Returns the cached value for the URL, or None if there is no entry,
+        the entry has expired, or it was stored with a different version.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT version, expires, body FROM responses WHERE url = ?",
+                                    (url,)).fetchone()
+        if row is None:
+            return None
+        cached_version, expires, body = row
+        if expires is not None and expires < time.time():
+            return None
+        if version is not None and version != cached_version:
+            return None
+        return json.loads(body)
+
+    def put(self, url, value, version=None, ttl=None):
+        """ Store a value for the URL. It never expires if ttl is None. """
+        expires = time.time() + ttl if ttl is not None else None
+        body = json.dumps(value, separators=(',', ':'))
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (url, version, expires, body) VALUES (?, ?, ?, ?)",
+                              (url, version, expires, body))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class RestClient(object):
+    """
+    Fetches JSON from the REST API through a session, consulting an optional
+    ResponseCache first. In offline mode, only the cache is consulted and a
+    miss raises CacheMissError. Requests and cache lookups are recorded in
+    'stats', if given.
+    """
+    def __init__(self, session, cache=None, offline=False, ttl=DEFAULT_CACHE_TTL, stats=None):
+        if offline and cache is None:
+            raise ValueError("Offline mode requires a cache")
+        self.session = session
+        self.cache = cache
+        self.offline = offline
+        self.ttl = ttl
+        self.stats = stats
+
+    def get_cached(self, url, params=None, version=None):
+        """ Returns the cached response for the request, or None. """
+        if self.cache is None:
+            return None
+        value = self.cache.get(cache_key(url, params), version)
+        if self.stats is not None:
+            self.stats.record_cache(value is not None)
+        return value
+
+    def put_cached(self, url, params, value, version=None):
+        """
+        Add a response to the cache. Versioned entries (such as issues keyed on
+        their "updated" timestamp) are kept until the version changes, while
+        other entries expire after the client's TTL.
+        """
+        if self.cache is not None:
+            ttl = None if version is not None else self.ttl
+            self.cache.put(cache_key(url, params), value, version, ttl)
+
+    def get_json(self, url, params=None, version=None):
+        """ GET the given URL and return the decoded JSON response. """
+        value = self.get_cached(url, params, version)
+        if value is not None:
+            return value
+        if self.offline:
+            raise CacheMissError("Not in the cache: %s" % (cache_key(url, params),))
+        value = get_json(self.session, url, params, self.stats)
+        self.put_cached(url, params, value, version)
+        return value
+
+def imap_ordered(func, iterable, workers=1, lookahead=None):
+    """
+    Like itertools.imap(), but calls func on up to 'workers' threads at once.
+    Results are yielded in the same order as the input. At most 'lookahead'
+    items (default: twice the number of workers) are in flight at any time, so
+    the input may be a lazy generator.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    if lookahead is None:
+        lookahead = workers * 2
+    pool = ThreadPool(workers)
+    try:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= lookahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def chunks(iterable, n):
+    """ Generator yielding lists of up to n consecutive items from iterable. """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
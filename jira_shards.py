@@ -0,0 +1,296 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Writing a dump as a number of smaller, self-contained dumps ("shards"),
+# which can be imported one at a time. The JSON importer gets slow on large
+# files, and when an import fails, only the failed shard has to be imported
+# again.
+#
+# ShardWriter takes the same sequence of events as ExportWriter (see
+# jira_json.py). Since the sizes of the shards are only known once all of the
+# issues have been seen, the issues are spooled to a temporary file in the
+# shard directory, as compact JSON, one issue per line. When the writer is
+# closed, the issues are split into contiguous ranges of about the same total
+# size (the size of the compact JSON of the issues) or number of issues, and
+# the shards are written out by a pool of processes. Each shard holds:
+#
+# * the projects of its issues, with all of their metadata,
+# * the users that its issues or projects refer to,
+# * the issue links between two of its own issues, and
+# * any other top-level sections, in the first shard only.
+#
+# Links between issues in different shards can only be imported once both
+# issues are, so they are written to a separate links file, to be imported
+# after all of the shards. A manifest (manifest.json) lists the shards in
+# order, with the issues, projects, size and SHA-1 of each, for scripting the
+# imports.
+#
+###############################################################################
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from jira_json import BY_BYTES, COMPACT_SEPARATORS, PROJECT, PROJECT_END, SECTION, SHARD_BY, encoder, \
+    json_default, new_export_writer, output_suffix
+
+MANIFEST_FILENAME = "manifest.json"
+
+# Fields of issues, comments, history entries and history items that may hold
+# a username. Values of these fields that are not the name of a user in the
+# "users" section are ignored, so this errs on the side of including users.
+USERNAME_FIELDS = ("reporter", "assignee", "author", "attacher", "oldValue", "newValue", "voters", "watchers",
+                   "lead")
+
+def shard_filename(number, output_options):
+    """ Returns the name of the file of the given shard, numbered from 1. """
+    return "shard-%04d.json%s" % (number, output_suffix(output_options))
+
+def links_filename(output_options):
+    """ Returns the name of the file with the links between issues in different shards. """
+    return "links.json" + output_suffix(output_options)
+
+def add_usernames(names, data):
+    """ Add the values of the USERNAME_FIELDS of a dict to the set of names. """
+    for field in USERNAME_FIELDS:
+        value = data.get(field)
+        if isinstance(value, list):
+            names.update(value)
+        elif value is not None:
+            names.add(value)
+
+def issue_usernames(names, issue):
+    """ Add the names of the users an issue may refer to to the set of names. """
+    add_usernames(names, issue)
+    for h in issue.get("history", []):
+        add_usernames(names, h)
+        for item in h.get("items", []):
+            add_usernames(names, item)
+    for section in ("comments", "attachments", "worklogs"):
+        for entry in issue.get(section, []):
+            add_usernames(names, entry)
+
+def partition(sizes, num_parts):
+    """
+    Returns the indexes at which to split a sequence of items with the given
+    sizes into at most 'num_parts' contiguous, non-empty parts of about the
+    same total size. Each split is made at the item boundary closest to the
+    ideal split, so no part is off by more than about the largest item.
+    """
+    num_parts = max(min(num_parts, len(sizes)), 1)
+    ends = []
+    total = 0
+    for size in sizes:
+        total += size
+        ends.append(total)
+    splits = [0]
+    for i in range(1, num_parts):
+        target = total * i / float(num_parts)
+        split = bisect.bisect_left(ends, target)
+        # Either boundary next to the target, whichever is closer.
+        if split < len(ends) and (split == 0 or ends[split] - target < target - ends[split - 1]):
+            split += 1
+        # Leave at least one item for each of the remaining parts.
+        split = min(max(split, splits[-1] + 1), len(sizes) - (num_parts - i))
+        splits.append(split)
+    splits.append(len(sizes))
+    return splits
+
+def write_shard(task):
+    """
+    Write one shard, possibly in a worker process, and return its entry in
+    the manifest. See ShardWriter.close() for the task.
+    """
+    filename, spool_filename, projects, sections, users, output_options = task
+    names = set()
+
+    def spooled_issues(offset, count):
+        with open(spool_filename, "rb") as spool:
+            spool.seek(offset)
+            for _ in xrange(count):
+                yield json.loads(spool.readline())
+
+    def shard_events():
+        # "users" sorts after "projects", so the users that the issues refer
+        # to are known by the time it is written.
+        for name in sorted(set(sections.keys() + ["projects", "users"])):
+            if name == "users":
+                yield (SECTION, name, [user for user in users if user["name"] in names])
+            elif name != "projects":
+                yield (SECTION, name, sections[name])
+            elif not projects:
+                yield (SECTION, name, [])
+            else:
+                for before, after, offset, count in projects:
+                    add_usernames(names, before)
+                    add_usernames(names, after)
+                    yield (PROJECT, before, recorded_issues(spooled_issues(offset, count)))
+                    yield (PROJECT_END, after, None)
+
+    def recorded_issues(issues):
+        for issue in issues:
+            issue_usernames(names, issue)
+            yield issue
+
+    with open(filename, "wb") as out:
+        writer = new_export_writer(out, output_options)
+        writer.write_events(shard_events())
+        writer.close()
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            sha1.update(block)
+    return { "file": os.path.basename(filename),
+             "issues": sum(count for before, after, offset, count in projects),
+             "users": len([user for user in users if user["name"] in names]),
+             "links": len(sections.get("links", [])),
+             "bytes": os.path.getsize(filename),
+             "sha1": sha1.hexdigest() }
+
+class ShardWriter(object):
+    """
+    Writes a sequence of dump events to 'num_shards' shards in a directory,
+    balanced by the size of the issues (BY_BYTES) or by their number
+    (BY_ISSUES), with up to 'processes' shards written at once. Has the same
+    interface as ExportWriter, but nothing is written until close().
+    """
+    def __init__(self, shard_dir, num_shards, output_options, shard_by=BY_BYTES, processes=None):
+        if shard_by not in SHARD_BY:
+            raise ValueError("Unknown way of sharding '%s'" % (shard_by,))
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        self.shard_dir = shard_dir
+        self.num_shards = num_shards
+        # The shards themselves are not sharded again.
+        self.output_options = dict(output_options, shards=None)
+        self.shard_by = shard_by
+        self.processes = processes or multiprocessing.cpu_count()
+        self.spool = tempfile.NamedTemporaryFile(prefix=".spool.", dir=shard_dir)
+        self.sections = {}
+        # For each project: [before, after, index of its first issue, number
+        # of issues, key]. The key is taken from the issues if the project
+        # has none.
+        self.projects = []
+        # For each issue, in order: its key, its id in the "links" section, and
+        # the size and offset of its line in the spool.
+        self.keys = []
+        self.ids = []
+        self.sizes = []
+        self.offsets = []
+
+    def write_events(self, events):
+        """ Spool a whole sequence of events. """
+        for kind, name, value in events:
+            if kind == SECTION:
+                self.sections[name] = value
+            elif kind == PROJECT:
+                project = [name, {}, len(self.keys), 0, name.get("key")]
+                self.projects.append(project)
+                for issue in value:
+                    if project[4] is None:
+                        project[4] = issue["key"].split("-", 1)[0]
+                    line = encoder.dumps(issue, separators=COMPACT_SEPARATORS, default=json_default,
+                                         allow_nan=True) + "\n"
+                    self.offsets.append(self.spool.tell())
+                    self.spool.write(line)
+                    self.keys.append(issue["key"])
+                    self.ids.append(issue.get("externalId", issue["key"]))
+                    self.sizes.append(len(line))
+                    project[3] += 1
+            elif kind == PROJECT_END:
+                self.projects[-1][1] = name
+
+    def shard_tasks(self, splits):
+        """
+        Returns the arguments of write_shard() for each shard, the keys of the
+        projects in each shard, and the links between shards.
+        """
+        users = self.sections.get("users", [])
+        shard_of = {}
+        for number in range(len(splits) - 1):
+            for i in xrange(splits[number], splits[number + 1]):
+                shard_of[self.ids[i]] = number
+        links = [[] for _ in range(len(splits) - 1)]
+        cross_shard_links = []
+        for link in self.sections.get("links", []):
+            source = shard_of.get(link.get("sourceId"))
+            if source is not None and source == shard_of.get(link.get("destinationId")):
+                links[source].append(link)
+            else:
+                cross_shard_links.append(link)
+
+        tasks = []
+        project_keys = []
+        last = len(splits) - 2
+        for number in range(len(splits) - 1):
+            start, end = splits[number], splits[number + 1]
+            projects = []
+            keys = []
+            for before, after, first, count, key in self.projects:
+                lo, hi = max(first, start), min(first + count, end)
+                # Projects without issues go with the issues that follow them.
+                if lo < hi or (count == 0 and (start <= first < end or (first == end and number == last))):
+                    projects.append((before, after, self.offsets[lo] if lo < hi else 0, max(hi - lo, 0)))
+                    keys.append(key)
+            if number == 0:
+                sections = dict((name, value) for name, value in self.sections.iteritems()
+                                if name not in ("users", "links", "projects"))
+            else:
+                sections = {}
+            if "links" in self.sections:
+                sections["links"] = links[number]
+            filename = os.path.join(self.shard_dir, shard_filename(number + 1, self.output_options))
+            tasks.append((filename, self.spool.name, projects, sections, users, self.output_options))
+            project_keys.append(keys)
+        return tasks, project_keys, cross_shard_links
+
+    def close(self):
+        """ Write out the shards, the links between them and the manifest. """
+        self.spool.flush()
+        sizes = self.sizes if self.shard_by == BY_BYTES else [1] * len(self.sizes)
+        splits = partition(sizes, self.num_shards) if self.keys else [0, 0]
+        tasks, project_keys, cross_shard_links = self.shard_tasks(splits)
+        processes = min(self.processes, len(tasks))
+        try:
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+                shards = pool.map(write_shard, tasks, 1)
+                pool.close()
+                pool.join()
+            else:
+                shards = map(write_shard, tasks)
+        finally:
+            self.spool.close()
+        for shard, keys, (start, end) in zip(shards, project_keys, zip(splits, splits[1:])):
+            shard["projects"] = keys
+            shard["firstIssue"] = self.keys[start] if start < end else None
+            shard["lastIssue"] = self.keys[end - 1] if start < end else None
+
+        with open(os.path.join(self.shard_dir, links_filename(self.output_options)), "wb") as out:
+            writer = new_export_writer(out, self.output_options)
+            writer.write_section("links", cross_shard_links)
+            writer.close()
+        manifest = { "shardBy": self.shard_by,
+                     "issues": len(self.keys),
+                     "shards": shards,
+                     "crossShardLinks": { "file": links_filename(self.output_options),
+                                          "links": len(cross_shard_links) } }
+        with open(os.path.join(self.shard_dir, MANIFEST_FILENAME), "w") as f:
+            json.dump(manifest, f, sort_keys=True, indent=2, separators=(',', ': '))
+            f.write("\n")
+        sys.stderr.write("INFO: Wrote %d issues to %d shards of %s issues in %s, with %d links between shards\n" %
+                         (len(self.keys), len(shards), "/".join(str(shard["issues"]) for shard in shards),
+                          self.shard_dir, len(cross_shard_links)))
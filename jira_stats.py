@@ -0,0 +1,334 @@
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Instrumentation of transformation runs: a progress line with the throughput
+# and the estimated time remaining, the time spent in each phase of the run,
+# and the latency, retries and size of the REST requests by endpoint. At the
+# end of a run, all of it can be written out as a JSON report.
+#
+# The stages of a run are chained generators, so their work is interleaved:
+# each issue is pulled through all of the stages before the next one is read.
+# The time of each phase is measured by wrapping the events coming out of its
+# stage with timed_events(), which charges the time spent producing them to the
+# phase, minus the time spent in the stages further upstream. Time that is not
+# spent in any of the wrapped stages, such as writing the output, is charged to
+# the default phase.
+#
+###############################################################################
+import json
+import os
+import re
+import sys
+import threading
+import time
+from jira_json import PROJECT, load_export, read_export
+
+# Seconds between progress lines.
+DEFAULT_PROGRESS_INTERVAL = 5.0
+
+# Phase that time outside of any of the timed stages is charged to.
+DEFAULT_PHASE = "serialize"
+
+# Upper bounds, in milliseconds, of the buckets of the REST latency histograms.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+# Path segments of REST URLs that are replaced by a placeholder when grouping
+# requests by endpoint: issue keys, project keys and numeric ids.
+ID_SEGMENT_RE = re.compile(r"^([A-Z][A-Z0-9_]*(-[0-9]+)?|[0-9]+)$")
+
+def endpoint_name(url):
+    """
+    Returns the REST endpoint of a URL, with ids replaced by placeholders,
+    such as "issue/{id}" for ".../rest/api/2/issue/IMPALA-1234?fields=...".
+    """
+    path = url.split("?", 1)[0]
+    if "/rest/api/" in path:
+        path = path.split("/rest/api/", 1)[1].split("/", 1)[-1]
+    return "/".join("{id}" if ID_SEGMENT_RE.match(segment) else segment for segment in path.split("/"))
+
+def bucket_name(i):
+    """ Returns the name of the i'th bucket of the latency histograms in the report. """
+    if i < len(LATENCY_BUCKETS_MS):
+        return "<=%d" % (LATENCY_BUCKETS_MS[i],)
+    return ">%d" % (LATENCY_BUCKETS_MS[-1],)
+
+def format_duration(seconds):
+    """ Format a number of seconds as H:MM:SS. """
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+class EndpointStats(object):
+    """ Latency histogram and counters of the requests to one REST endpoint. """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # One more bucket than LATENCY_BUCKETS_MS, for everything slower.
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds, num_bytes, retries, error):
+        self.requests += 1
+        self.errors += 1 if error else 0
+        self.retries += retries
+        self.bytes += num_bytes
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        ms = seconds * 1000.0
+        i = 0
+        while i < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[i]:
+            i += 1
+        self.buckets[i] += 1
+
+    def percentile(self, p):
+        """ Returns an upper bound of the p'th percentile latency, in milliseconds. """
+        threshold = self.requests * p / 100.0
+        count = 0
+        for i, n in enumerate(self.buckets):
+            count += n
+            if n and count >= threshold:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_seconds * 1000.0
+        return 0
+
+    def report(self):
+        return { "requests": self.requests,
+                 "errors": self.errors,
+                 "retries": self.retries,
+                 "bytes": self.bytes,
+                 "total_seconds": self.total_seconds,
+                 "mean_ms": self.total_seconds * 1000.0 / self.requests if self.requests else 0,
+                 "max_ms": self.max_seconds * 1000.0,
+                 "p50_ms": self.percentile(50),
+                 "p90_ms": self.percentile(90),
+                 "p99_ms": self.percentile(99),
+                 "histogram_ms": dict((bucket_name(i), n) for i, n in enumerate(self.buckets) if n) }
+
+    def merge(self, report):
+        """ Add in the counters of another EndpointStats, as returned by its report(). """
+        self.requests += report["requests"]
+        self.errors += report["errors"]
+        self.retries += report["retries"]
+        self.bytes += report["bytes"]
+        self.total_seconds += report["total_seconds"]
+        self.max_seconds = max(self.max_seconds, report["max_ms"] / 1000.0)
+        for i in range(len(self.buckets)):
+            self.buckets[i] += report["histogram_ms"].get(bucket_name(i), 0)
+
+class RunStats(object):
+    """
+    Statistics of a transformation run. REST requests may be recorded from
+    any thread, while the phase timers and progress are driven by the thread
+    that runs the stages. Progress lines are written to stderr, at most every
+    'progress_interval' seconds, prefixed with 'label' if given.
+    """
+    def __init__(self, label=None, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        self.label = label
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.endpoints = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.phases = {}
+        self.current_phase = DEFAULT_PHASE
+        self.phase_start = self.start
+        self.issues = 0
+        self.total_issues = None
+        self.input_file = None
+        self.input_size = None
+        self.last_progress = self.start
+
+    # Phase timers.
+
+    def switch_phase(self, phase):
+        """ Charge the time since the last switch to the current phase, and make 'phase' current. Returns the previous phase. """
+        now = time.time()
+        previous = self.current_phase
+        self.phases[previous] = self.phases.get(previous, 0.0) + now - self.phase_start
+        self.current_phase = phase
+        self.phase_start = now
+        return previous
+
+    def timed(self, iterable, phase):
+        """ Generator passing through the items of iterable, charging the time spent producing them to 'phase'. """
+        it = iter(iterable)
+        while True:
+            previous = self.switch_phase(phase)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.switch_phase(previous)
+            yield item
+
+    def timed_events(self, events, phase):
+        """ Like timed(), for the events of a dump and the issues of their projects. """
+        for kind, name, value in self.timed(events, phase):
+            if kind == PROJECT:
+                value = self.timed(value, phase)
+            yield (kind, name, value)
+
+    def run_phase(self, phase, func, *args):
+        """ Call func(*args), charging the time to 'phase', and return its result. """
+        previous = self.switch_phase(phase)
+        try:
+            return func(*args)
+        finally:
+            self.switch_phase(previous)
+
+    # Input.
+
+    def load_export(self, f, load_options=None):
+        """
+        Load the whole dump in the given file into memory, charging the time to
+        the "load" phase, and return it. 'load_options' is the result of
+        parse_load_options().
+        """
+        load_options = load_options or {}
+        data = self.run_phase("load", load_export, f, load_options.get("intern", False),
+                              load_options.get("compact_history", False))
+        self.expect_issues(sum(len(proj.get("issues", [])) for proj in data.get("projects", [])))
+        return data
+
+    def stream_export(self, f):
+        """ Returns the events of the dump in the given file, parsed incrementally in the "load" phase. """
+        self.track_input(f)
+        return self.timed_events(read_export(f), "load")
+
+    # Progress.
+
+    def expect_issues(self, total_issues):
+        """ Set the total number of issues of the run, for the progress estimates. """
+        self.total_issues = total_issues
+
+    def track_input(self, f):
+        """
+        Estimate the progress of the run by how much of the given input file
+        has been read, when the number of issues is not known up front. This
+        only works for uncompressed files.
+        """
+        if isinstance(f, file):
+            self.input_file = f
+            self.input_size = os.fstat(f.fileno()).st_size
+
+    def progress_events(self, events):
+        """ Generator passing through the events of a dump, counting the issues for the progress line. """
+        for kind, name, value in events:
+            if kind == PROJECT:
+                value = self.progress_issues(value)
+            yield (kind, name, value)
+
+    def progress_issues(self, issues):
+        """ Generator passing through issues, counting them for the progress line. """
+        for issue in issues:
+            self.issues += 1
+            now = time.time()
+            if now - self.last_progress >= self.progress_interval:
+                self.last_progress = now
+                self.write_progress(now)
+            yield issue
+
+    def fraction_done(self):
+        """ Returns the estimated fraction of the run that is done, or None if unknown. """
+        if self.total_issues:
+            return min(float(self.issues) / self.total_issues, 1.0)
+        if self.input_size and not self.input_file.closed:
+            return min(float(self.input_file.tell()) / self.input_size, 1.0)
+        return None
+
+    def write_progress(self, now=None):
+        now = now or time.time()
+        elapsed = now - self.start
+        line = "Processed %d issues (%.1f issues/s)" % (self.issues, self.issues / elapsed if elapsed > 0 else 0.0)
+        fraction = self.fraction_done()
+        if fraction:
+            line += ", %.0f%% done, ETA %s" % (fraction * 100, format_duration(elapsed / fraction - elapsed))
+        sys.stderr.write("INFO: %s%s\n" % ("%s: " % (self.label,) if self.label else "", line))
+
+    # REST requests.
+
+    def record_request(self, url, seconds, num_bytes=0, retries=0, error=False):
+        endpoint = endpoint_name(url)
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointStats()
+            self.endpoints[endpoint].record(seconds, num_bytes, retries, error)
+
+    def record_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    # Reports.
+
+    def report(self):
+        """ Returns the statistics of the run as a dict, for the JSON report. """
+        self.switch_phase(self.current_phase)
+        elapsed = time.time() - self.start
+        with self.lock:
+            endpoints = dict((name, stats.report()) for name, stats in self.endpoints.iteritems())
+            cache = { "hits": self.cache_hits, "misses": self.cache_misses }
+        return { "issues": self.issues,
+                 "seconds": elapsed,
+                 "issues_per_second": self.issues / elapsed if elapsed > 0 else 0.0,
+                 "phases": dict(self.phases),
+                 "rest": { "requests": sum(e["requests"] for e in endpoints.itervalues()),
+                           "retries": sum(e["retries"] for e in endpoints.itervalues()),
+                           "errors": sum(e["errors"] for e in endpoints.itervalues()),
+                           "bytes": sum(e["bytes"] for e in endpoints.itervalues()),
+                           "endpoints": endpoints,
+                           "cache": cache } }
+
+    def merge(self, report):
+        """ Add in the statistics of another run, as returned by its report(), such as a worker's. """
+        self.issues += report["issues"]
+        for phase, seconds in report["phases"].iteritems():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        with self.lock:
+            for name, endpoint_report in report["rest"]["endpoints"].iteritems():
+                if name not in self.endpoints:
+                    self.endpoints[name] = EndpointStats()
+                self.endpoints[name].merge(endpoint_report)
+            self.cache_hits += report["rest"]["cache"]["hits"]
+            self.cache_misses += report["rest"]["cache"]["misses"]
+
+    def summary(self, count=None, unit="issues"):
+        """
+        Returns a one-line summary of the run. The rate is of the issues
+        processed, or, for scripts that don't process issues, of 'count'
+        things of the given unit.
+        """
+        report = self.report()
+        phases = ", ".join("%s %.1fs" % (phase, seconds)
+                           for phase, seconds in sorted(report["phases"].iteritems(), key=lambda p: -p[1])
+                           if seconds >= 0.05)
+        if count is None:
+            count = report["issues"]
+            rate = report["issues_per_second"]
+        else:
+            rate = count / report["seconds"] if report["seconds"] > 0 else 0.0
+        line = "Processed %d %s in %.1fs (%.1f %s/s), %d REST requests (%d retries)" % \
+            (count, unit, report["seconds"], rate, unit, report["rest"]["requests"], report["rest"]["retries"])
+        return line + "; " + phases if phases else line
+
+    def write_report(self, filename):
+        """ Write the JSON report of the run to the given file. """
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, sort_keys=True, indent=2, separators=(',', ': '))
+            f.write("\n")
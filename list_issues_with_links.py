@@ -13,88 +13,148 @@
 # limitations under the License.
 ###############################################################################
 #
-# Script to add back fields that are not automatically exported by JIRA export.
-# Also performs mappings between resolutions and versions for history reasons.
-# This uses the REST API for both the old and new servers to figure out the
-# version mappings and to get the latest values for "component", "resolution",
-# and "fixVersions".
+# Script to find the issue links and parent/sub-task relations of the issues
+# in one or more dumps, which the JSON importer does not migrate reliably.
+# Only the link fields of the issues are fetched from the source instance, in
+# batched searches (see the REST options), and stored in a link index (see
+# jira_links.py). By default, the URLs of the issues of the given dumps that
+# have links or sub-tasks are printed. The other queries print one edge per line, as tab-separated
+# kind ("link" or "subtask"), link type, source issue and target issue.
+#
+# With --index, the index is kept in a file, and later runs only fetch the
+# issues that were updated since they were indexed. The index can then also
+# be queried without any input files, in which case the default listing
+# covers every indexed issue.
 #
 ###############################################################################
-import json
-import requests
+import getopt
 import sys
-import time
-from collections import defaultdict
-from remap_users import get_user_mappings
+from add_missing_jira_fields import get_rest_issues
+from jira_json import PROJECT, open_export, read_export
+from jira_links import LINK_FIELDS, LinkIndex
+from jira_rest import REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, new_rest_client, parse_rest_options
+from jira_stats import RunStats
+
+# Issues to index per commit to the index.
+INDEX_CHUNK_SIZE = 1000
 
-def get_version_map(src_jira_url, dest_jira_url, project_key):
-    version_api_path = "/rest/api/2/project/%s/versions" % (project_key,)
-    version_name_map = defaultdict(list)
-    for root in (src_jira_url, dest_jira_url):
-        url = root + version_api_path
-        r = requests.get(url);
-        versions = r.json()
-        for v in versions:
-            version_name_map[v['name']].append(v['id'])
-    mapping = {}
-    for name in version_name_map:
-        l = version_name_map[name]
-        if len(l) != 2:
-            sys.stderr.write("WARN: Version with name '%s' does not appear in both instances\n" % (name,))
-            continue
-        old, new = l
-        mapping[old] = new
-    return mapping
+def iter_dump_issues(filenames, keys=None):
+    """
+    Generator yielding the key and "updated" timestamp of each of the issues
+    in the given dumps. The keys are also added to the set 'keys', if given.
+    """
+    for filename in filenames:
+        with open_export(filename) as f:
+            for kind, name, value in read_export(f):
+                if kind == PROJECT:
+                    for issue in value:
+                        if keys is not None:
+                            keys.add(issue["key"])
+                        yield { "key": issue["key"], "updated": issue.get("updated") }
 
-def get_field_map(src_jira_url):
-    """ Return map of available JIRA fields, keyed by field id. """
-    field_api_path = "/rest/api/2/field"
-    field_name_map = {}
-    url = src_jira_url + field_api_path
-    r = requests.get(url);
-    fields = r.json()
-    for field in fields:
-        if "id" in field:
-            field_name_map[field["id"]] = field
-    return field_name_map
+def index_issues(index, client, src_jira_url, issues, workers=1, batch_size=1):
+    """
+    Fetch the link fields of the issues that are not in the index, or that
+    were updated since they were indexed, and add them to the index. Returns
+    the number of issues that were fetched.
+    """
+    versions = index.indexed_versions()
+    stale = (issue for issue in issues
+             if issue["key"] not in versions or issue["updated"] is None or versions[issue["key"]] != issue["updated"])
+    fetched = 0
+    chunk = []
+    for issue, rest_issue in get_rest_issues(client, src_jira_url, stale, workers, batch_size, LINK_FIELDS):
+        chunk.append((issue["key"], issue["updated"], rest_issue))
+        if len(chunk) >= INDEX_CHUNK_SIZE:
+            index.add_issues(chunk)
+            fetched += len(chunk)
+            chunk = []
+    index.add_issues(chunk)
+    return fetched + len(chunk)
 
-def add_missing_issue_fields(src_jira_url, issue, field_map, user_map):
-    issue_api_path = "/rest/api/2/issue/%s" % (issue["key"],)
-    url = src_jira_url + issue_api_path
-    r = requests.get(url);
-    rest_issue = r.json()
+def write_edges(edges, out):
+    for edge in edges:
+        out.write(("\t".join(edge) + "\n").encode("utf-8"))
 
-    if rest_issue["fields"]["issuelinks"]:
-        print src_jira_url + "/browse/" + issue["key"]
-    return
+def usage():
+    sys.stderr.write("Usage: %s [options] src_jira_url [file.json...]\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --index=links.db --batch-size=100 https://issues.cloudera.org file.json > issues.txt\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --index=links.db --ordered https://issues.cloudera.org > links.tsv\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --index=FILE    Keep the link index in FILE, and only fetch the issues that were\n")
+    sys.stderr.write("                  updated since they were added to it.\n")
+    sys.stderr.write("  --links=KEY     Print the links and sub-tasks of issue KEY.\n")
+    sys.stderr.write("  --cross-project Print the links and sub-tasks between issues of different projects.\n")
+    sys.stderr.write("  --dangling      Print the links and sub-tasks from or to issues that are not in the index.\n")
+    sys.stderr.write("  --ordered       Print all links and sub-tasks in topological order, for recreating them\n")
+    sys.stderr.write("                  in bulk: parents before sub-tasks, and blockers before what they block.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and REST request statistics to FILE.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.exit(1)
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 5:
-        sys.stderr.write("Usage: %s user_mappings.tsv src_jira_url dest_jira_url file.json > out.json\n" % sys.argv[0])
-        sys.stderr.write("Example: %s user_mappings.tsv https://issues.cloudera.org https://issues.apache.org/jira file.json > out.json\n" % sys.argv[0])
-        sys.exit(1)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["index=", "links=", "cross-project", "dangling", "ordered",
+                                                      "stats="] + REST_OPTIONS)
+        rest_options = parse_rest_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) < 1:
+        usage()
 
-    user_mappings_filename = sys.argv[1]
-    src_jira_url = sys.argv[2]
-    dest_jira_url = sys.argv[3]
-    filename = sys.argv[4]
+    index_filename = ":memory:"
+    query = None
+    stats_filename = None
+    for opt, val in opts:
+        if opt == "--index":
+            index_filename = val
+        elif opt == "--links":
+            query = ("links", val)
+        elif opt in ("--cross-project", "--dangling", "--ordered"):
+            query = (opt[2:], None)
+        elif opt == "--stats":
+            stats_filename = val
 
-    # Read the username mappings.
-    user_map = get_user_mappings(user_mappings_filename)
+    src_jira_url = args[0]
+    filenames = args[1:]
+    if not filenames and index_filename == ":memory:":
+        sys.stderr.write("ERROR: Either input files or an existing --index are required\n")
+        usage()
 
-    # Fetch the global list of fields from the server.
-    field_map = get_field_map(src_jira_url)
+    stats = RunStats()
+    client = new_rest_client(rest_options, stats)
+    index = LinkIndex(index_filename)
+    dump_keys = set()
+    try:
+        if filenames:
+            issues = stats.progress_issues(iter_dump_issues(filenames, dump_keys))
+            try:
+                fetched = stats.run_phase("fetch", index_issues, index, client, src_jira_url, issues,
+                                          rest_options["workers"], rest_options["batch_size"])
+            except CacheMissError as e:
+                sys.stderr.write("ERROR: %s\n" % (e,))
+                sys.exit(1)
+            sys.stderr.write("INFO: Fetched %d new or updated issues. %s\n" % (fetched, index.summary()))
 
-    with open(filename, "r") as f:
-        data = json.load(f)
-        for proj in data["projects"]:
-            project_key = None
-            release_version_map = None
-            for issue in proj["issues"]:
-                if project_key is None:
-                    project_key, _ = issue["key"].split("-", 2)
-                    release_version_map = get_version_map(src_jira_url, dest_jira_url, project_key)
+        if query is None:
+            # A persistent index may hold issues of earlier dumps too; only
+            # list the ones of the dumps given on this run.
+            for key in index.issues_with_edges():
+                if not filenames or key in dump_keys:
+                    print src_jira_url + "/browse/" + key
+        elif query[0] == "links":
+            write_edges(index.issue_edges(query[1]), sys.stdout)
+        elif query[0] == "cross-project":
+            write_edges(index.cross_project_edges(), sys.stdout)
+        elif query[0] == "dangling":
+            write_edges(index.dangling_edges(), sys.stdout)
+        elif query[0] == "ordered":
+            write_edges(index.ordered_edges(), sys.stdout)
+    finally:
+        index.close()
 
-                sys.stderr.write("INFO: Processing %s...\n" % (issue["key"],))
-                add_missing_issue_fields(src_jira_url, issue, field_map, user_map)
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
@@ -0,0 +1,477 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Runs the whole transformation of a JSON JIRA export in one process: the
+# username mappings of remap_users.py, followed by the field enrichment and
+# history rewriting of add_missing_jira_fields.py. The stages are chained
+# over a single sequence of issues, so the dump is only parsed and written out
+# once, and the output is the same as running the two scripts in succession.
+#
+# Since JIRA only exports 1000 issues at a time, a migration usually consists
+# of many export files. Any number of files, directories of *.json files, or
+# glob patterns may be given. They are processed on a pool of processes, with
+# the user mappings, field map and version maps loaded once up front and handed
+# to the workers. The results are either written to a directory, one output
+# file per input file, or merged into a single import file. Input files may be
+# compressed with gzip or zstd.
+#
+###############################################################################
+import getopt
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from collections import defaultdict
+from add_missing_jira_fields import enrich_events, export_project_keys, get_issue_hasher, load_metadata, \
+    report_unmapped_history_values, rewrite_history_events
+from jira_journal import IssueJournal, journal_events
+from jira_json import COMPACT, COMPRESSION_SUFFIXES, LOAD_OPTIONS, LOAD_OPTIONS_USAGE, OUTPUT_OPTIONS, \
+    OUTPUT_OPTIONS_USAGE, PROJECT, PROJECT_END, SECTION, iter_export_data, new_export_writer, open_export, \
+    output_suffix, parse_load_options, parse_output_options, read_export
+from jira_rest import REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, new_rest_client, parse_rest_options
+from jira_stats import RunStats
+from remap_users import check_users, filter_hidden_events, get_user_mappings, read_users_to_exclude, remap_events
+
+def migrate_events(events, client, user_map, users_to_exclude, src_jira_url, dest_jira_url, field_map,
+                   rest_options, version_maps=None, journal=None, stats=None, unmapped=None, resolutions=None):
+    """
+    Chain all of the transformation stages over a stream of dump events. If
+    an IssueJournal is given, the issues in it that have not changed skip the
+    REST enrichment and history rewriting, and the other issues are added to
+    it. The time spent in each stage is recorded in 'stats', and the history
+    values that could not be mapped are counted in 'unmapped', if given.
+    Resolutions are mapped with 'resolutions' (see HistoryRewriter).
+    """
+    if version_maps is None:
+        version_maps = {}
+    if stats is None:
+        stats = RunStats()
+    events = remap_events(events, user_map, users_to_exclude, dest_jira_url)
+    events = stats.timed_events(filter_hidden_events(events), "remap")
+
+    def transform(events):
+        events = enrich_events(events, client, src_jira_url, field_map, user_map,
+                               rest_options["workers"], rest_options["batch_size"])
+        events = stats.timed_events(events, "fetch")
+        events = rewrite_history_events(events, client, src_jira_url, dest_jira_url, version_maps, unmapped,
+                                        resolutions)
+        return stats.timed_events(events, "history")
+    if journal is not None:
+        issue_hash = get_issue_hasher(client, src_jira_url, dest_jira_url, field_map, user_map, version_maps,
+                                      resolutions)
+        return stats.timed_events(journal_events(events, journal, transform, issue_hash), "journal")
+    return transform(events)
+
+def open_journal(journal_filename):
+    """ Returns the IssueJournal in the given file, or None if there is no filename. """
+    if journal_filename is None:
+        return None
+    journal = IssueJournal(journal_filename)
+    if len(journal):
+        sys.stderr.write("INFO: Resuming with %d issues from journal %s\n" % (len(journal), journal_filename))
+    return journal
+
+# The names of the files in an input directory that are processed.
+INPUT_PATTERNS = ["*.json"] + ["*.json" + suffix for suffix in sorted(COMPRESSION_SUFFIXES.values())]
+
+def expand_input_paths(paths):
+    """
+    Returns the list of input files named by the given paths, which may be
+    files, directories (meaning all of the *.json files in them, compressed or
+    not) or glob patterns.
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(filename for pattern in INPUT_PATTERNS
+                                    for filename in glob.glob(os.path.join(path, pattern))))
+        elif glob.has_magic(path):
+            filenames.extend(sorted(glob.glob(path)))
+        else:
+            filenames.append(path)
+    return filenames
+
+def output_basename(input_filename, output_options):
+    """
+    Returns the name of the output file for the given input file, with a
+    suffix matching the compression of the output.
+    """
+    basename = os.path.basename(input_filename)
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if basename.endswith(suffix):
+            basename = basename[:-len(suffix)]
+    return basename + output_suffix(output_options)
+
+def peek_project_key(filename):
+    """
+    Returns the key of the first project in the given export file, based on
+    the key of its first issue, or None if there is none. Only the beginning of
+    the file is read.
+    """
+    with open_export(filename) as f:
+        for kind, name, value in read_export(f):
+            if kind == PROJECT:
+                for issue in value:
+                    project_key, _ = issue["key"].split("-", 2)
+                    return project_key
+    return None
+
+class ProjectSummary(object):
+    """
+    Records the project metadata seen in a stream of events, for merging,
+    along with the report of the RunStats of the file's transformation and
+    the counts of the history values that could not be mapped.
+    """
+    def __init__(self):
+        self.sections = {}
+        self.projects = []
+        self.stats = None
+        self.unmapped = defaultdict(int)
+
+    def record_events(self, events):
+        """ Generator passing through the events, while recording the metadata. """
+        for kind, name, value in events:
+            if kind == SECTION:
+                self.sections[name] = value
+            elif kind == PROJECT:
+                project = { "key": name.get("key"), "before": name, "after": None }
+                self.projects.append(project)
+                value = self._record_issues(project, value)
+            elif kind == PROJECT_END:
+                self.projects[-1]["after"] = name
+            yield (kind, name, value)
+
+    def _record_issues(self, project, issues):
+        for issue in issues:
+            if project["key"] is None:
+                project["key"], _ = issue["key"].split("-", 2)
+            yield issue
+
+# Per-process state of the workers of the process pool, set by init_worker().
+_worker = {}
+
+def init_worker(user_map, users_to_exclude, src_jira_url, dest_jira_url, field_map, version_maps, resolutions,
+                rest_options, output_options, stream, load_options=None):
+    _worker.update(user_map=user_map, users_to_exclude=users_to_exclude,
+                   src_jira_url=src_jira_url, dest_jira_url=dest_jira_url,
+                   field_map=field_map, version_maps=version_maps, resolutions=resolutions,
+                   rest_options=rest_options, output_options=output_options, stream=stream,
+                   load_options=load_options)
+    # HTTP connections can't be shared between processes, so each worker has
+    # its own client. A --cache database is shared, though.
+    _worker["client"] = new_rest_client(rest_options)
+
+def migrate_file(filenames):
+    """
+    Transform the input file into the output file, in a worker process,
+    optionally with a journal file. Returns a ProjectSummary of the output,
+    or None if the migration failed, in which case the reason has been written
+    to stderr.
+    """
+    input_filename, output_filename, journal_filename = filenames
+    summary = ProjectSummary()
+    stats = RunStats(label=os.path.basename(input_filename))
+    _worker["client"].stats = stats
+    journal = open_journal(journal_filename)
+    try:
+        with open_export(input_filename) as f:
+            if _worker["stream"]:
+                events = stats.stream_export(f)
+            else:
+                data = stats.load_export(f, _worker["load_options"])
+                check_users(data["users"], _worker["user_map"], _worker["users_to_exclude"],
+                            _worker["dest_jira_url"])
+                events = iter_export_data(data)
+            events = migrate_events(events, _worker["client"], _worker["user_map"], _worker["users_to_exclude"],
+                                    _worker["src_jira_url"], _worker["dest_jira_url"], _worker["field_map"],
+                                    _worker["rest_options"], _worker["version_maps"], journal, stats,
+                                    summary.unmapped, _worker["resolutions"])
+            with open(output_filename, "wb") as out:
+                writer = new_export_writer(out, _worker["output_options"])
+                writer.write_events(summary.record_events(stats.progress_events(events)))
+                writer.close()
+            if journal is not None:
+                journal.compact()
+                sys.stderr.write("INFO: %s\n" % (journal.summary(),))
+    except CacheMissError as e:
+        sys.stderr.write("ERROR: %s: %s\n" % (input_filename, e))
+        return None
+    except SystemExit:
+        # The transformation stages exit on fatal errors, after explaining why.
+        # That would kill the worker, so report the failure to the parent instead.
+        sys.stderr.write("ERROR: Failed to migrate %s\n" % (input_filename,))
+        return None
+    finally:
+        if journal is not None:
+            journal.close()
+    sys.stderr.write("INFO: Wrote %s: %s\n" % (output_filename, stats.summary()))
+    summary.stats = stats.report()
+    return summary
+
+def iter_project_issues(filename, index):
+    """ Generator over the issues of the index'th project in the given file. """
+    with open_export(filename) as f:
+        i = 0
+        for kind, name, value in read_export(f):
+            if kind == PROJECT:
+                if i == index:
+                    for issue in value:
+                        yield issue
+                    return
+                i += 1
+
+def merge_outputs(filenames, summaries, out, output_options):
+    """
+    Merge the given transformed dumps into a single one, written to 'out'
+    with the given output options.
+    Projects with the same key are combined, users are de-duplicated by name,
+    and other top-level sections are concatenated. Issues are streamed from
+    the files, so only one is held in memory at a time.
+    """
+    # Group the projects of all of the files by key, in order of appearance.
+    project_keys = []
+    projects = {}
+    for filename, summary in zip(filenames, summaries):
+        for index, project in enumerate(summary.projects):
+            if project["key"] not in projects:
+                project_keys.append(project["key"])
+                projects[project["key"]] = { "before": project["before"], "after": project["after"], "parts": [] }
+            projects[project["key"]]["parts"].append((filename, index))
+
+    sections = {}
+    for summary in summaries:
+        for name, value in summary.sections.iteritems():
+            if name == "projects":
+                continue
+            if name not in sections:
+                sections[name] = value
+            elif name == "users":
+                seen = frozenset(user["name"] for user in sections[name])
+                sections[name] = sections[name] + [user for user in value if user["name"] not in seen]
+            elif isinstance(value, list):
+                sections[name] = sections[name] + value
+
+    def merged_events():
+        names = sorted(set(sections.keys() + ["projects"]))
+        for name in names:
+            if name != "projects":
+                yield (SECTION, name, sections[name])
+            elif not project_keys:
+                yield (SECTION, name, [])
+            else:
+                for key in project_keys:
+                    project = projects[key]
+                    issues = (issue for filename, index in project["parts"]
+                              for issue in iter_project_issues(filename, index))
+                    yield (PROJECT, project["before"], issues)
+                    yield (PROJECT_END, project["after"], None)
+
+    writer = new_export_writer(out, output_options)
+    writer.write_events(merged_events())
+    writer.close()
+
+def usage():
+    sys.stderr.write("Usage: %s [options] user_mappings.tsv users_to_exclude.lst src_jira_url dest_jira_url jira.json... > out.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --stream --workers=8 user_mappings.tsv users_to_exclude.lst https://issues.cloudera.org https://issues.apache.org/jira infile.json > outfile.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --processes=4 --output-dir=out user_mappings.tsv users_to_exclude.lst https://issues.cloudera.org https://issues.apache.org/jira exports/\n" % sys.argv[0])
+    sys.stderr.write("Input files may also be directories of *.json files or quoted glob patterns.\n")
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --stream        Process the dump one issue at a time instead of loading it into memory.\n")
+    sys.stderr.write("  --journal=FILE  Record each transformed issue in FILE as it is done. Issues recorded\n")
+    sys.stderr.write("                  there by a previous (possibly interrupted) run are reused if they\n")
+    sys.stderr.write("                  have not changed since, so only new or changed issues are enriched.\n")
+    sys.stderr.write("                  With several input files, FILE is a directory of per-file journals.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and REST request statistics to FILE.\n")
+    sys.stderr.write("  --processes=N   Number of input files to process at once (default: 1).\n")
+    sys.stderr.write("  --output-dir=D  Write one output file per input file to directory D, instead of\n")
+    sys.stderr.write("                  merging everything into a single dump on stdout.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.stderr.write(LOAD_OPTIONS_USAGE)
+    sys.stderr.write(OUTPUT_OPTIONS_USAGE)
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["stream", "journal=", "stats=", "processes=", "output-dir="] +
+                                   REST_OPTIONS + LOAD_OPTIONS + OUTPUT_OPTIONS)
+        rest_options = parse_rest_options(opts)
+        load_options = parse_load_options(opts)
+        output_options = parse_output_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) < 5:
+        usage()
+
+    stream = False
+    journal_filename = None
+    stats_filename = None
+    processes = 1
+    output_dir = None
+    for opt, val in opts:
+        if opt == "--stream":
+            stream = True
+        elif opt == "--journal":
+            journal_filename = val
+        elif opt == "--stats":
+            stats_filename = val
+        elif opt == "--processes":
+            processes = int(val)
+        elif opt == "--output-dir":
+            output_dir = val
+
+    user_mappings_filename = args[0]
+    users_to_exclude_filename = args[1]
+    src_jira_url = args[2]
+    dest_jira_url = args[3]
+    json_filenames = expand_input_paths(args[4:])
+    if not json_filenames:
+        sys.stderr.write("ERROR: No input files found\n")
+        sys.exit(1)
+
+    if output_dir is not None and output_options["shards"] is not None:
+        sys.stderr.write("ERROR: --shards can't be combined with --output-dir\n")
+        sys.exit(1)
+
+    user_map = get_user_mappings(user_mappings_filename)
+    users_to_exclude = read_users_to_exclude(users_to_exclude_filename)
+
+    stats = RunStats()
+    client = new_rest_client(rest_options, stats)
+
+    if len(json_filenames) == 1 and output_dir is None:
+        # A single dump is transformed straight to stdout.
+        with open_export(json_filenames[0]) as f:
+            project_keys = ()
+            if stream:
+                events = stats.stream_export(f)
+            else:
+                data = stats.load_export(f, load_options)
+                # Validate the users before making any REST calls.
+                check_users(data["users"], user_map, users_to_exclude, dest_jira_url)
+                project_keys = export_project_keys(data)
+                events = iter_export_data(data)
+
+            journal = open_journal(journal_filename)
+            try:
+                # Fetch the fields, resolutions and versions from both servers at once.
+                metadata = stats.run_phase("fetch", load_metadata, client, src_jira_url, dest_jira_url,
+                                           project_keys, rest_options["workers"])
+
+                unmapped = defaultdict(int)
+                events = migrate_events(events, client, user_map, users_to_exclude,
+                                        src_jira_url, dest_jira_url, metadata.field_map, rest_options,
+                                        metadata.version_maps(), journal, stats, unmapped, metadata.resolution_map)
+                writer = new_export_writer(sys.stdout, output_options)
+                writer.write_events(stats.progress_events(events))
+                writer.close()
+                report_unmapped_history_values(unmapped)
+                if journal is not None:
+                    journal.compact()
+                    sys.stderr.write("INFO: %s\n" % (journal.summary(),))
+            except CacheMissError as e:
+                sys.stderr.write("ERROR: %s\n" % (e,))
+                sys.exit(1)
+            finally:
+                if journal is not None:
+                    journal.close()
+        sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+        if stats_filename is not None:
+            stats.write_report(stats_filename)
+        sys.exit(0)
+
+    # Load the metadata shared by all of the files once, up front, in one
+    # round of requests to both servers.
+    try:
+        project_keys = []
+        for filename in json_filenames:
+            project_key = peek_project_key(filename)
+            if project_key is not None and project_key not in project_keys:
+                project_keys.append(project_key)
+        metadata = stats.run_phase("fetch", load_metadata, client, src_jira_url, dest_jira_url, project_keys,
+                                   rest_options["workers"])
+        field_map = metadata.field_map
+        version_maps = metadata.version_maps()
+        resolutions = metadata.resolution_map
+    except CacheMissError as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        sys.exit(1)
+
+    merge_dir = None
+    if output_dir is None:
+        merge_dir = tempfile.mkdtemp(prefix="migrate.")
+    elif not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    output_filenames = []
+    for i, filename in enumerate(json_filenames):
+        if merge_dir is not None:
+            output_filenames.append(os.path.join(merge_dir, "%05d.json" % (i,)))
+        else:
+            output_filenames.append(os.path.join(output_dir, output_basename(filename, output_options)))
+    journal_filenames = [None] * len(json_filenames)
+    if journal_filename is not None:
+        if not os.path.isdir(journal_filename):
+            os.makedirs(journal_filename)
+        journal_filenames = [os.path.join(journal_filename, os.path.basename(filename) + ".journal")
+                             for filename in json_filenames]
+    if (output_dir is not None or journal_filename is not None) and \
+       len(set(output_basename(filename, output_options) for filename in json_filenames)) != len(json_filenames):
+        sys.stderr.write("ERROR: Input files must have distinct names when using --output-dir or --journal\n")
+        sys.exit(1)
+
+    # The intermediate files of a merge are only read back by this script, so
+    # they are written in the format that is the fastest to write and read.
+    file_output_options = output_options
+    if merge_dir is not None:
+        file_output_options = { "format": COMPACT, "compress": None }
+    worker_args = (user_map, users_to_exclude, src_jira_url, dest_jira_url, field_map, version_maps, resolutions,
+                   rest_options, file_output_options, stream, load_options)
+    tasks = zip(json_filenames, output_filenames, journal_filenames)
+    try:
+        # The time spent in the workers is reported by phase, summed over
+        # the workers, with the wall-clock time in the "workers" phase.
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, init_worker, worker_args)
+            summaries = stats.run_phase("workers", pool.map, migrate_file, tasks, 1)
+            pool.close()
+            pool.join()
+        else:
+            init_worker(*worker_args)
+            summaries = stats.run_phase("workers", map, migrate_file, tasks)
+        unmapped = defaultdict(int)
+        for summary in summaries:
+            if summary is not None:
+                stats.merge(summary.stats)
+                for key, count in summary.unmapped.iteritems():
+                    unmapped[key] += count
+        report_unmapped_history_values(unmapped)
+
+        failed = [filename for filename, summary in zip(json_filenames, summaries) if summary is None]
+        if failed:
+            sys.stderr.write("ERROR: Failed to migrate %d of %d files\n" % (len(failed), len(json_filenames)))
+            sys.exit(1)
+
+        if merge_dir is not None:
+            merge_outputs(output_filenames, summaries, sys.stdout, output_options)
+    finally:
+        if merge_dir is not None:
+            shutil.rmtree(merge_dir)
+
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
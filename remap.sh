@@ -14,11 +14,19 @@
 ###############################################################################
 #
 # Convenience script to run remap_users.py and add_missing_jira_fields.py in
-# succession.
+# succession. Both steps run in a single process (see migrate.py), so the dump
+# is only parsed and written out once. Any extra options, such as --stream or
+# --workers=N, are passed through to migrate.py.
 #
 ###############################################################################
 set -e
 
+OPTIONS=()
+while [[ "$1" == --* ]]; do
+  OPTIONS+=("$1")
+  shift
+done
+
 MAPPINGS=$1
 REMOVE_LIST=$2
 SOURCE_URL=$3
@@ -27,20 +35,15 @@ INFILE=$5
 OUTFILE=$6
 
 if [ -z "$6" -o -n "$7" ]; then
-  echo "Usage: $0 user_mappings.tsv users_to_remove.lst src_jira_url dest_jira_url infile outfile.json"
+  echo "Usage: $0 [options] user_mappings.tsv users_to_remove.lst src_jira_url dest_jira_url infile outfile.json"
   echo "Example: $0 user_mappings.tsv users_to_remove.lst https://issues.cloudera.org https://issues.apache.org/jira infile.json outfile.json"
   exit 1
 fi
 
-TMPFILE=$(mktemp -t "$OUTFILE.tmp.XXXXXX")
 ROOT=$(dirname $0)
 
-echo Remapping users...
-$ROOT/remap_users.py "$MAPPINGS" "$REMOVE_LIST" "$DEST_URL" "$INFILE" > "$TMPFILE"
-
-echo Adding missing fields...
-$ROOT/add_missing_jira_fields.py "$MAPPINGS" "$SOURCE_URL" "$DEST_URL" "$TMPFILE" > "$OUTFILE"
+echo Remapping users and adding missing fields...
+$ROOT/migrate.py "${OPTIONS[@]}" "$MAPPINGS" "$REMOVE_LIST" "$SOURCE_URL" "$DEST_URL" "$INFILE" > "$OUTFILE"
 
-rm "$TMPFILE"
 echo Done
 exit 0
@@ -16,10 +16,14 @@
 # Munge a JSON JIRA export to perform username mappings.
 #
 ###############################################################################
-import json
+import getopt
+import re
 import requests
 import sys
 import time
+from jira_json import LOAD_OPTIONS, LOAD_OPTIONS_USAGE, OUTPUT_OPTIONS, OUTPUT_OPTIONS_USAGE, PROJECT, PROJECT_END, \
+    SECTION, iter_export_data, new_export_writer, open_export, parse_load_options, parse_output_options
+from jira_stats import RunStats
 from list_users import format_user_profile_link
 
 # Fields with exact username matches.
@@ -27,9 +31,14 @@ EXACT_USERNAME_FIELDS = frozenset(["reporter", "name", "assignee", "author", "ol
                                    "newValue", "voters", "watchers", "lead"])
 # Fields with mentions.
 MENTION_FIELDS = frozenset(["description", "body"])
+# An at-mention of a user in one of the MENTION_FIELDS, such as "[~mpercy]".
+MENTION_RE = re.compile(r"\[~([^\[\]]*)\]")
 
-def replace_usernames(data):
-    """ Replace usernames in shallow fields in the given hash struct. """
+def replace_usernames(data, user_mappings, rewrite_mentions):
+    """
+    Replace usernames in shallow fields in the given hash struct.
+    'rewrite_mentions' is the result of compile_mention_rewriter(user_mappings).
+    """
     for field in EXACT_USERNAME_FIELDS:
         if field in data:
             if isinstance(data[field], list):
@@ -43,10 +52,39 @@ def replace_usernames(data):
                     data[field] = user_mappings[data[field]]
     for field in MENTION_FIELDS:
         if field in data:
-            for old_name in user_mappings:
-                old_mention = "[~%s]" % (old_name,)
-                new_mention = "[~%s]" % (user_mappings[old_name],)
-                data[field] = data[field].replace(old_mention, new_mention)
+            data[field] = rewrite_mentions(data[field])
+
+def compile_mention_rewriter(user_mappings):
+    """
+    Returns a function that rewrites all of the at-mentions in a text in a
+    single pass, using the given username mappings.
+
+    The result is the same as calling text.replace("[~old]", "[~new]") for each
+    mapping in turn, in the iteration order of user_mappings. In particular,
+    if one user's new name is another user's old name, a mention is renamed
+    twice if and only if the second mapping comes later in that order. Those
+    chains are resolved once here, so each mention needs one dict lookup.
+    Usernames containing "[" or "]" are not supported.
+    """
+    order = dict((old_name, i) for i, old_name in enumerate(user_mappings))
+    new_mentions = {}
+    for old_name in user_mappings:
+        pos = order[old_name]
+        new_name = user_mappings[old_name]
+        while new_name in order and order[new_name] > pos:
+            pos = order[new_name]
+            new_name = user_mappings[new_name]
+        if new_name != old_name:
+            new_mentions[old_name] = "[~%s]" % (new_name,)
+
+    def replace_mention(m):
+        return new_mentions.get(m.group(1), m.group(0))
+
+    def rewrite_mentions(text):
+        if "[~" not in text:
+            return text
+        return MENTION_RE.sub(replace_mention, text)
+    return rewrite_mentions
 
 def get_user_mappings(user_mappings_filename):
     """
@@ -68,71 +106,137 @@ def get_user_mappings(user_mappings_filename):
             user_mappings[old] = new
     return user_mappings
 
+def check_users(users, user_mappings, users_to_exclude, dest_jira_url):
+    """ Validate that we have accounted for all users in our mappings. Exits if not. """
+    found_all_users = True
+    for user in users:
+        if user["name"] not in users_to_exclude and user["name"] not in user_mappings:
+            if found_all_users:
+                found_all_users = False
+                sys.stderr.write("ERROR: The following users were not found in any mapping / exclusion files:\n")
+                sys.stderr.write("%s\n" % ('='*80,))
+            sys.stderr.write("%s\n" % (format_user_profile_link(user, dest_jira_url),))
+    if not found_all_users:
+        sys.exit(1)
+
+def remap_user_list(users, user_mappings, users_to_exclude, rewrite_mentions):
+    """ Remove users we don't want included in the migration, and rename the rest. """
+    new_users = []
+    for user in users:
+        if user["name"] in users_to_exclude:
+            continue
+        replace_usernames(user, user_mappings, rewrite_mentions)
+        new_users.append(user)
+    return new_users
+
+def remap_issue(issue, user_mappings, rewrite_mentions):
+    """ Replace usernames throughout the issue. """
+    replace_usernames(issue, user_mappings, rewrite_mentions)
+    for h in issue["history"]:
+        replace_usernames(h, user_mappings, rewrite_mentions)
+        if "items" in h:
+            for item in h["items"]:
+                replace_usernames(item, user_mappings, rewrite_mentions)
+    for c in issue["comments"]:
+        replace_usernames(c, user_mappings, rewrite_mentions)
+
+def is_hidden_issue(issue):
+    """ Returns True if the issue is "hidden" and should be left out of the migration. """
+    for h in issue["history"]:
+        if "items" in h:
+            for item in h["items"]:
+                if "field" in item and "newValue" in item and "newDisplayValue" in item:
+                    if item["field"] == "security" and item["newDisplayValue"] == "Hidden":
+                        return True
+    return False
+
+def remap_events(events, user_mappings, users_to_exclude, dest_jira_url):
+    """ Generator applying the username mappings to a stream of dump events. """
+    rewrite_mentions = compile_mention_rewriter(user_mappings)
+
+    def remap_issues(issues):
+        for issue in issues:
+            remap_issue(issue, user_mappings, rewrite_mentions)
+            yield issue
+
+    for kind, name, value in events:
+        if kind == SECTION and name == "users":
+            check_users(value, user_mappings, users_to_exclude, dest_jira_url)
+            value = remap_user_list(value, user_mappings, users_to_exclude, rewrite_mentions)
+        elif kind == PROJECT:
+            replace_usernames(name, user_mappings, rewrite_mentions)
+            value = remap_issues(value)
+        elif kind == PROJECT_END:
+            replace_usernames(name, user_mappings, rewrite_mentions)
+        yield (kind, name, value)
+
+def filter_hidden_events(events):
+    """ Generator dropping the hidden issues from a stream of dump events. """
+    for kind, name, value in events:
+        if kind == PROJECT:
+            value = (issue for issue in value if not is_hidden_issue(issue))
+        yield (kind, name, value)
+
+def read_users_to_exclude(users_to_exclude_filename):
+    """ Returns the set of usernames listed in the given user-excludes file. """
+    return frozenset([line.strip() for line in open(users_to_exclude_filename, "r")])
+
+def usage():
+    sys.stderr.write("Usage: %s [--stream] [--output-format=F] [--compress=C] [--stats=FILE] user_mappings.tsv users_to_exclude.lst dest_jira_url jira.json > out.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s user_mappings.tsv users_to_exclude.lst https://issues.apache.org/jira infile.json > outfile.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --stream        Process the dump one issue at a time instead of loading it into memory.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings to FILE.\n")
+    sys.stderr.write(LOAD_OPTIONS_USAGE)
+    sys.stderr.write(OUTPUT_OPTIONS_USAGE)
+    sys.exit(1)
+
 if __name__ == "__main__":
 
-    if len(sys.argv) != 5:
-        sys.stderr.write("Usage: %s user_mappings.tsv users_to_exclude.lst dest_jira_url jira.json > out.json\n" % sys.argv[0])
-        sys.stderr.write("Example: %s user_mappings.tsv users_to_exclude.lst https://issues.apache.org/jira infile.json > outfile.json\n" % sys.argv[0])
-        sys.exit(1)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["stream", "stats="] + LOAD_OPTIONS + OUTPUT_OPTIONS)
+        load_options = parse_load_options(opts)
+        output_options = parse_output_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) != 4:
+        usage()
+
+    stream = False
+    stats_filename = None
+    for opt, val in opts:
+        if opt == "--stream":
+            stream = True
+        elif opt == "--stats":
+            stats_filename = val
 
-    user_mappings_filename = sys.argv[1]
-    users_to_exclude_filename = sys.argv[2]
-    dest_jira_url = sys.argv[3]
-    json_filename = sys.argv[4]
+    user_mappings_filename = args[0]
+    users_to_exclude_filename = args[1]
+    dest_jira_url = args[2]
+    json_filename = args[3]
 
     user_mappings = get_user_mappings(user_mappings_filename)
-    users_to_exclude = frozenset([line.strip() for line in open(users_to_exclude_filename, "r")])
-
-    with open(json_filename, "r") as f:
-        data = json.load(f)
-
-        # Validate that we have accounted for all users in our mappings.
-        found_all_users = True
-        for user in data["users"]:
-            if user["name"] not in users_to_exclude and user["name"] not in user_mappings:
-                if found_all_users:
-                    found_all_users = False
-                    sys.stderr.write("ERROR: The following users were not found in any mapping / exclusion files:\n")
-                    sys.stderr.write("%s\n" % ('='*80,))
-                sys.stderr.write("%s\n" % (format_user_profile_link(user, dest_jira_url),))
-        if not found_all_users:
-            sys.exit(1)
-
-        # Remove users we don't want included in the migration.
-        new_users = []
-        for user in data["users"]:
-            if user["name"] in users_to_exclude:
-                continue
-            replace_usernames(user)
-            new_users.append(user)
-        data["users"] = new_users
-
-        # Replace usernames throughout the project.
-        for proj in data["projects"]:
-            replace_usernames(proj)
-            proj_prefix = None
-            new_issues = []
-            for issue in proj["issues"]:
-                replace_usernames(issue)
-
-                hidden = False
-                for h in issue["history"]:
-                    replace_usernames(h)
-                    if "items" in h:
-                        for item in h["items"]:
-                            replace_usernames(item)
-                            if "field" in item and "newValue" in item and "newDisplayValue" in item:
-                                # Check if the issue is "hidden". If so, we skip it.
-                                if item["field"] == "security" and item["newDisplayValue"] == "Hidden":
-                                    hidden = True
-                for c in issue["comments"]:
-                    replace_usernames(c)
-
-                if hidden:
-                    # Simply skip this one.
-                    continue
-                # The "normal" case.
-                new_issues.append(issue)
-            proj["issues"] = new_issues
-
-        print json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '))
+    users_to_exclude = read_users_to_exclude(users_to_exclude_filename)
+
+    stats = RunStats()
+    with open_export(json_filename) as f:
+        if stream:
+            # Note: Users are validated when the "users" section is reached,
+            # which may be after some of the issues have been written out.
+            events = stats.stream_export(f)
+        else:
+            data = stats.load_export(f, load_options)
+            # Validate the users before producing any output.
+            check_users(data["users"], user_mappings, users_to_exclude, dest_jira_url)
+            events = iter_export_data(data)
+
+        writer = new_export_writer(sys.stdout, output_options)
+        events = remap_events(events, user_mappings, users_to_exclude, dest_jira_url)
+        events = stats.timed_events(filter_hidden_events(events), "remap")
+        writer.write_events(stats.progress_events(events))
+        writer.close()
+
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
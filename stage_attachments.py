@@ -0,0 +1,259 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Script to stage the attachments of a transformed dump next to the
+# destination instance. add_missing_jira_fields.py points the "uri" of each
+# attachment at the source instance, so during the import the destination
+# downloads every attachment from the source, one at a time. This script
+# downloads them ahead of time, concurrently, into a local directory, and
+# rewrites each "uri" to point at a file server that serves that directory
+# next to the destination instance, for example:
+#
+#   cd attachments && python -m SimpleHTTPServer 8000
+#
+# The attachments are stored by the SHA-256 hash of their content, as
+# <directory>/<first two hex digits>/<hash>, so identical attachments are only
+# stored once. An index of the downloaded URLs is kept in the directory, so an
+# interrupted run can be resumed, and attachments that were downloaded before
+# are not downloaded again. The store takes the place of the REST response
+# cache for the attachments: with --offline, only attachments that are in the
+# store already are staged.
+#
+###############################################################################
+import getopt
+import hashlib
+import json
+import os
+import requests
+import sys
+import threading
+import time
+from jira_json import OUTPUT_OPTIONS, OUTPUT_OPTIONS_USAGE, PROJECT, iter_export_data, new_export_writer, \
+    open_export, parse_output_options
+from jira_rest import REQUEST_TIMEOUT, REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, imap_ordered, \
+    new_rest_client, parse_rest_options
+from jira_stats import RunStats
+
+# Name of the index of downloaded attachments in the store directory.
+INDEX_FILENAME = "index.jsonl"
+
+# Name of the directory of incomplete downloads in the store directory.
+TMP_DIRNAME = "tmp"
+
+# Bytes to read from the network at a time.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+class AttachmentStore(object):
+    """
+    Content-addressed store of attachments in a directory, with an index of
+    the URLs that they were downloaded from. Safe to use from multiple
+    threads, but not from multiple processes at once.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, TMP_DIRNAME)
+        if not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        # Throw away the downloads of an interrupted run.
+        for filename in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, filename))
+        self.lock = threading.Lock()
+        # URL -> (hash, size) of the downloaded attachments.
+        self.index = {}
+        index_filename = os.path.join(directory, INDEX_FILENAME)
+        if os.path.exists(index_filename):
+            with open(index_filename, "r") as f:
+                for line in f:
+                    # A torn last line is ignored; that attachment is
+                    # simply downloaded again.
+                    if line.endswith("\n"):
+                        entry = json.loads(line)
+                        self.index[entry["uri"]] = (entry["sha256"], entry["size"])
+        self.index_file = open(index_filename, "a")
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.duplicates = 0
+        self.reused = 0
+        self.failed = 0
+
+    def relative_path(self, sha256):
+        """ Returns the path of the attachment with the given hash, relative to the store. """
+        return "%s/%s" % (sha256[:2], sha256)
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def lookup(self, uri):
+        """ Returns the (hash, size) of the attachment downloaded from uri, or None. """
+        with self.lock:
+            entry = self.index.get(uri)
+        if entry is not None and os.path.exists(self.path(entry[0])):
+            return entry
+        return None
+
+    def fetch(self, client, uri):
+        """
+        Returns the hash of the attachment at uri, downloading it into the
+        store with the session of the RestClient, unless it has been
+        downloaded before. Raises an exception from requests if the download
+        fails, or CacheMissError if it would have to be downloaded while the
+        client is offline. The download is recorded in the client's stats.
+        """
+        entry = self.lookup(uri)
+        if entry is not None:
+            with self.lock:
+                self.reused += 1
+            return entry[0]
+        if client.offline:
+            raise CacheMissError("Not downloaded yet: %s" % (uri,))
+
+        stats = client.stats
+        start = time.time()
+        size = 0
+        r = None
+        try:
+            r = client.session.get(uri, stream=True, timeout=REQUEST_TIMEOUT)
+            r.raise_for_status()
+            digest = hashlib.sha256()
+            tmp_filename = os.path.join(self.tmp_dir, "%d.%d" % (os.getpid(), threading.current_thread().ident))
+            with open(tmp_filename, "wb") as out:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except requests.RequestException:
+            if stats is not None:
+                stats.record_request(uri, time.time() - start, size, error=True)
+            raise
+        finally:
+            if r is not None:
+                r.close()
+        if stats is not None:
+            retries = getattr(r.raw, "retries", None)
+            stats.record_request(uri, time.time() - start, size, len(retries.history) if retries is not None else 0)
+
+        sha256 = digest.hexdigest()
+        path = self.path(sha256)
+        with self.lock:
+            if os.path.exists(path):
+                # The same content was already downloaded from another URL.
+                os.remove(tmp_filename)
+                self.duplicates += 1
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.rename(tmp_filename, path)
+            self.index[uri] = (sha256, size)
+            self.index_file.write(json.dumps({ "uri": uri, "sha256": sha256, "size": size }) + "\n")
+            self.index_file.flush()
+            self.downloaded += 1
+            self.downloaded_bytes += size
+        return sha256
+
+    def summary(self, elapsed):
+        """ Returns a one-line description of what was done in 'elapsed' seconds. """
+        return ("Downloaded %d attachments (%.1f MB, %.1f MB/s, %d duplicates), reused %d downloaded before, "
+                "%d failed") % (self.downloaded, self.downloaded_bytes / 1e6,
+                                self.downloaded_bytes / 1e6 / elapsed if elapsed > 0 else 0.0,
+                                self.duplicates, self.reused, self.failed)
+
+    def close(self):
+        self.index_file.close()
+
+def stage_issue_attachments(issue, store, client, mirror_url):
+    """
+    Download the attachments of an issue into the store through the
+    RestClient, and point their "uri" at the mirror. The uri of an
+    attachment that fails to download is left alone.
+    """
+    for attachment in issue.get("attachments", []):
+        uri = attachment.get("uri")
+        if not uri or uri.startswith(mirror_url + "/"):
+            continue
+        try:
+            sha256 = store.fetch(client, uri)
+        except Exception as e:
+            sys.stderr.write("WARN: Failed to download attachment '%s' of %s: %s\n" % (uri, issue["key"], e))
+            with store.lock:
+                store.failed += 1
+            continue
+        attachment["uri"] = "%s/%s" % (mirror_url, store.relative_path(sha256))
+    return issue
+
+def stage_attachment_events(events, store, client, mirror_url, workers=1):
+    """
+    Generator staging the attachments of the issues in a stream of dump
+    events. The attachments of up to 'workers' issues are downloaded at once.
+    """
+    stage = lambda issue: stage_issue_attachments(issue, store, client, mirror_url)
+    for kind, name, value in events:
+        if kind == PROJECT:
+            value = imap_ordered(stage, value, workers)
+        yield (kind, name, value)
+
+def usage():
+    sys.stderr.write("Usage: %s [options] attachment_dir mirror_url file.json > out.json\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --workers=8 attachments http://jira-staging.example.com:8000 file.json > out.json\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --stream        Process the dump one issue at a time instead of loading it into memory.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and download statistics to FILE.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.stderr.write(OUTPUT_OPTIONS_USAGE)
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["stream", "stats="] + REST_OPTIONS + OUTPUT_OPTIONS)
+        rest_options = parse_rest_options(opts)
+        output_options = parse_output_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) != 3:
+        usage()
+
+    stream = False
+    stats_filename = None
+    for opt, val in opts:
+        if opt == "--stream":
+            stream = True
+        elif opt == "--stats":
+            stats_filename = val
+
+    store_dir = args[0]
+    mirror_url = args[1].rstrip("/")
+    filename = args[2]
+
+    stats = RunStats()
+    store = AttachmentStore(store_dir)
+    client = new_rest_client(rest_options, stats)
+    try:
+        with open_export(filename) as f:
+            events = stats.stream_export(f) if stream else iter_export_data(stats.load_export(f))
+            events = stage_attachment_events(events, store, client, mirror_url, rest_options["workers"])
+            writer = new_export_writer(sys.stdout, output_options)
+            writer.write_events(stats.progress_events(stats.timed_events(events, "fetch")))
+            writer.close()
+    finally:
+        store.close()
+
+    sys.stderr.write("INFO: %s\n" % (store.summary(time.time() - stats.start),))
+    sys.stderr.write("INFO: %s\n" % (stats.summary(),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)
+    if store.failed:
+        sys.stderr.write("ERROR: %d attachments could not be downloaded; run again to retry them\n" % (store.failed,))
+        sys.exit(1)
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+###############################################################################
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+#
+# Script to draft the user mappings of a migration. It collects the users of
+# one or more JSON dumps, looks each of them up on the destination instance
+# by username and by email address, and prints a draft user-mappings file:
+#
+# * Users with the same username and email on the destination keep their
+#   username.
+# * Users whose email belongs to exactly one account with another username on
+#   the destination are mapped to that account.
+# * Users with neither a username nor an email match keep their username; the
+#   import creates an account for them.
+# * Everything else is a conflict, such as a username that belongs to someone
+#   else on the destination, or an email with several accounts. Conflicts are
+#   left commented out in the draft, and described in the report (--report),
+#   for a human to resolve.
+#
+# The lookups run concurrently, and go through the REST response cache with
+# --cache, so running the script again after adding more dumps only looks up
+# the new users.
+#
+###############################################################################
+import getopt
+import requests
+import sys
+from jira_json import open_export, read_export, section_events
+from jira_rest import REST_OPTIONS, REST_OPTIONS_USAGE, CacheMissError, imap_ordered, new_rest_client, \
+    parse_rest_options
+from jira_stats import RunStats
+from remap_users import get_user_mappings, read_users_to_exclude
+
+# Outcomes of the lookup of a user, in the order they are listed in the draft.
+SAME = "same"
+EMAIL = "email"
+NEW = "new"
+UNVERIFIED = "unverified"
+CONFLICT = "conflict"
+
+SECTION_COMMENTS = [
+    (SAME, "Same username and email on the destination."),
+    (EMAIL, "Matched by email to an account with another username on the destination."),
+    (NEW, "Not on the destination; the import creates an account with the same username."),
+    (UNVERIFIED, "Same username on the destination, but the email could not be compared. Check these."),
+    (CONFLICT, "Conflicts, left commented out. See the report."),
+]
+
+def read_dump_users(filenames):
+    """
+    Returns the users of the "users" sections of the given dumps, keyed by
+    username. A user that is in several dumps is only returned once, with
+    the email and full name of the first dump that has them.
+    """
+    users = {}
+    for filename in filenames:
+        with open_export(filename) as f:
+            # The users section may follow the projects.
+            for kind, name, value in section_events(read_export(f)):
+                if name == "users":
+                    for user in value:
+                        known = users.setdefault(user["name"], dict(user))
+                        for field in ("email", "fullname"):
+                            if not known.get(field) and user.get(field):
+                                known[field] = user[field]
+    return users
+
+def get_dest_user(client, dest_jira_url, name):
+    """
+    Returns the user on the destination with exactly the given username, or
+    None if there is none. Users that don't exist are cached too, as an
+    empty object, so that --offline knows about them.
+    """
+    url = dest_jira_url + "/rest/api/2/user"
+    params = { "username": name }
+    try:
+        user = client.get_json(url, params)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        user = {}
+        client.put_cached(url, params, user)
+    return user or None
+
+def search_dest_users(client, dest_jira_url, query):
+    """
+    Returns the users on the destination whose username, name or email starts
+    with the query. The search returns at most 1000 users, so it is only
+    used for email addresses, which are specific enough.
+    """
+    return client.get_json(dest_jira_url + "/rest/api/2/user/search",
+                           { "username": query, "maxResults": 1000, "includeInactive": "true" })
+
+def lookup_user(client, dest_jira_url, user):
+    """
+    Look up a user of the source instance on the destination, by username
+    and by email. Returns (outcome, destination username or None,
+    description of the candidates).
+    """
+    name = user["name"]
+    email = (user.get("email") or "").lower()
+    # A search by username could miss the exact match among the many users
+    # whose names start with a short username, such as "dev".
+    dest_user = get_dest_user(client, dest_jira_url, name)
+    by_name = [dest_user] if dest_user is not None else []
+    by_email = []
+    if email:
+        by_email = [u for u in search_dest_users(client, dest_jira_url, email)
+                    if (u.get("emailAddress") or "").lower() == email]
+    candidates = ", ".join("%s <%s>" % (u["name"], u.get("emailAddress") or "")
+                           for u in by_name + [u for u in by_email if u["name"] != name])
+
+    if by_name and any(u["name"] == name for u in by_email):
+        return SAME, name, candidates
+    if len(by_email) == 1:
+        return EMAIL, by_email[0]["name"], candidates
+    if len(by_email) > 1:
+        return CONFLICT, None, "email has several accounts: " + candidates
+    if not by_name:
+        return NEW, name, candidates
+    if not email or not by_name[0].get("emailAddress"):
+        return UNVERIFIED, name, candidates
+    return CONFLICT, None, "username belongs to another account: " + candidates
+
+def write_draft(results, out):
+    """ Write the draft user-mappings file for the (user, outcome, new name, candidates) results. """
+    for outcome, comment in SECTION_COMMENTS:
+        entries = [(user, new_name) for user, user_outcome, new_name, _ in results if user_outcome == outcome]
+        if not entries:
+            continue
+        out.write("# %s\n" % (comment,))
+        for user, new_name in entries:
+            if outcome == CONFLICT:
+                line = "# %s\n" % (user["name"],)
+            elif new_name == user["name"]:
+                line = "%s\n" % (user["name"],)
+            else:
+                line = "%s\t%s\n" % (user["name"], new_name)
+            out.write(line.encode("utf-8"))
+        out.write("\n")
+
+def write_conflict_report(results, out):
+    """ Write a tab-separated report of the users that need attention. """
+    out.write("# username\temail\tfull name\toutcome\tcandidates on the destination\n")
+    for user, outcome, new_name, candidates in results:
+        if outcome in (CONFLICT, UNVERIFIED, EMAIL):
+            fields = [user["name"], user.get("email") or "", user.get("fullname") or "", outcome, candidates]
+            out.write(("\t".join(fields) + "\n").encode("utf-8"))
+
+def usage():
+    sys.stderr.write("Usage: %s [options] dest_jira_url jira.json... > user_mappings.tsv\n" % sys.argv[0])
+    sys.stderr.write("Example: %s --workers=8 --cache=cache.db --report=conflicts.tsv https://issues.apache.org/jira exports/*.json > user_mappings.tsv\n" % sys.argv[0])
+    sys.stderr.write("Options:\n")
+    sys.stderr.write("  --mappings=FILE Skip the users that are already mapped in this user-mappings file.\n")
+    sys.stderr.write("  --excludes=FILE Skip the users in this user-excludes file.\n")
+    sys.stderr.write("  --report=FILE   Write the conflicts, unverified and renamed users to FILE, as TSV.\n")
+    sys.stderr.write("  --stats=FILE    Write a JSON report with timings and REST request statistics to FILE.\n")
+    sys.stderr.write(REST_OPTIONS_USAGE)
+    sys.exit(1)
+
+if __name__ == "__main__":
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["mappings=", "excludes=", "report=", "stats="] + REST_OPTIONS)
+        rest_options = parse_rest_options(opts)
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        usage()
+    if len(args) < 2:
+        usage()
+
+    user_map = {}
+    users_to_exclude = frozenset()
+    report_filename = None
+    stats_filename = None
+    for opt, val in opts:
+        if opt == "--mappings":
+            user_map = get_user_mappings(val)
+        elif opt == "--excludes":
+            users_to_exclude = read_users_to_exclude(val)
+        elif opt == "--report":
+            report_filename = val
+        elif opt == "--stats":
+            stats_filename = val
+
+    dest_jira_url = args[0].rstrip("/")
+    filenames = args[1:]
+
+    stats = RunStats()
+    client = new_rest_client(rest_options, stats)
+    users = stats.run_phase("load", read_dump_users, filenames)
+    todo = [users[name] for name in sorted(users) if name not in user_map and name not in users_to_exclude]
+    sys.stderr.write("INFO: Found %d users in %d files, %d of them not mapped or excluded yet\n" %
+                     (len(users), len(filenames), len(todo)))
+
+    lookup = lambda user: (user,) + lookup_user(client, dest_jira_url, user)
+    try:
+        results = list(stats.timed(imap_ordered(lookup, todo, rest_options["workers"]), "lookup"))
+    except CacheMissError as e:
+        sys.stderr.write("ERROR: %s\n" % (e,))
+        sys.exit(1)
+
+    write_draft(results, sys.stdout)
+    if report_filename is not None:
+        with open(report_filename, "w") as f:
+            write_conflict_report(results, f)
+    counts = dict((outcome, sum(1 for result in results if result[1] == outcome)) for outcome, _ in SECTION_COMMENTS)
+    sys.stderr.write("INFO: %d same, %d matched by email, %d new, %d unverified, %d conflicts\n" %
+                     (counts[SAME], counts[EMAIL], counts[NEW], counts[UNVERIFIED], counts[CONFLICT]))
+    if counts[CONFLICT] and report_filename is None:
+        sys.stderr.write("WARN: %d users have conflicts; use --report to list them\n" % (counts[CONFLICT],))
+    sys.stderr.write("INFO: %s\n" % (stats.summary(len(results), "users"),))
+    if stats_filename is not None:
+        stats.write_report(stats_filename)